@@ -0,0 +1,117 @@
+import hashlib
+
+# Many files in one request, their contents back to back in a single stream
+#
+# BATCH_UPLOAD and BATCH_DOWNLOAD exchange a manifest with the name and size of every file
+# first, then the contents of all of them as one DATA stream, like a tar archive without
+# headers. Small files share frames, a batch is compressed as a whole and the sizes in the
+# manifest tell where one file ends and the next one begins.
+
+MAX_BATCH_FILES = 2000          # Files in one batch request, the manifest has to fit into one message
+
+
+# Reads the files of a batch as one stream, each one is opened when the stream reaches it
+class ConcatenatedReader:
+    def __init__(self, sources, hash_files=False):
+        self.sources = sources                      # (open, size) of every file, open() returns an object with read()
+        self.hash_files = hash_files
+        self.index = 0                              # File the stream is in
+        self.current = None                         # Its open file
+        self.remaining = 0                          # Its bytes that have not been read yet
+        self.hasher = None
+        self.position = 0                           # Bytes of the stream read so far
+        self.checksums = []                         # sha256 of every file read to the end, with hash_files
+
+    def read(self, size):
+        pieces, wanted = [], size
+        while self.index < len(self.sources) and (wanted or not self.sources[self.index][1]): # Empty files are passed on the way
+            if self.current is None:
+                opener, self.remaining = self.sources[self.index]
+                self.current = opener()
+                self.hasher = hashlib.sha256() if self.hash_files else None
+            if self.remaining:
+                data = self.current.read(min(wanted, self.remaining))
+                if not data:
+                    raise ValueError("File changed while the batch was being sent")
+                if self.hasher is not None:
+                    self.hasher.update(data)
+                pieces.append(data)
+                self.remaining -= len(data)
+                wanted -= len(data)
+            if not self.remaining:
+                self.next_file()
+        data = b"".join(pieces)
+        self.position += len(data)
+        return data
+
+    def finish(self):
+        # Called at the end of the stream, passes the empty files after the last one with contents
+        self.read(0)
+        return self.checksums
+
+    def next_file(self):
+        self.close()
+        if self.hasher is not None:
+            self.checksums.append(self.hasher.hexdigest())
+        self.index += 1
+
+    def close(self):
+        if self.current is not None and hasattr(self.current, "close"):
+            self.current.close()
+        self.current = None
+
+
+# Writes the stream of a batch into one output per file, hashing every file on the way
+#
+# Outputs are opened as the stream reaches them, finish() creates the empty files at its end.
+class StreamSplitter:
+    def __init__(self, sizes, open_output):
+        self.sizes = sizes
+        self.open_output = open_output              # Called with the index of a file, returns the file its contents go into
+        self.index = 0                              # File the stream is in
+        self.output = None                          # Its open output
+        self.remaining = 0                          # Its bytes that have not been written yet
+        self.hasher = None
+        self.checksums = []                         # sha256 of every file written to the end
+
+    def advance(self):
+        # Open the next file that has contents, empty files are done right away
+        while self.index < len(self.sizes):
+            self.output = self.open_output(self.index)
+            self.remaining = self.sizes[self.index]
+            self.hasher = hashlib.sha256()
+            if self.remaining:
+                return
+            self.finish_file()
+
+    def finish_file(self):
+        self.output.close()
+        self.output = None
+        self.checksums.append(self.hasher.hexdigest())
+        self.index += 1
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.output is None:
+                self.advance()
+                if self.output is None:
+                    raise ValueError("The batch holds more data than its files add up to")
+            piece = view[:self.remaining]
+            self.output.write(piece)
+            self.hasher.update(piece)
+            self.remaining -= len(piece)
+            view = view[len(piece):]
+            if not self.remaining:
+                self.finish_file()
+
+    def finish(self):
+        # Called at the end of the stream, returns True when every file is complete
+        if self.output is None:
+            self.advance()
+        return self.index == len(self.sizes)
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_core import ServerEngine
+from client_core import Connection
+from protocol import ServerError
+
+# Load generator: N simulated users, each on its own connection, run a weighted mix of commands
+#
+# Without --port a server is started on loopback in a temporary folder. The results go to
+# stdout and, with --output, to a JSON file that can be compared between server versions.
+
+COMMANDS = ("list", "upload", "download", "delete")
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1] if text and text[-1] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def parse_weights(text, parse_key=str):
+    # 'list=1,upload=3' or '4K:50,1M:5' into a list of (key, weight)
+    weights = []
+    for part in text.split(","):
+        key, _, weight = part.replace("=", ":").partition(":")
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    return weights
+
+
+def percentile(values, fraction):
+    # Nearest rank percentile of sorted values
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+
+class User(threading.Thread):
+    def __init__(self, index, args, sizes, payloads, deadline):
+        super().__init__(daemon=True)
+        self.index = index
+        self.args = args
+        self.sizes = sizes                          # [(size, weight)]
+        self.payloads = payloads                    # File of every size by size
+        self.deadline = deadline                    # perf_counter time to stop at
+        self.random = random.Random(args.seed + index)
+        self.connect_time = None
+        self.latencies = {command: [] for command in COMMANDS}
+        self.errors = {command: 0 for command in COMMANDS}
+        self.bytes = {command: 0 for command in COMMANDS}
+        self.uploaded = []                          # Names of this user's files on the server, with their size
+        self.counter = 0
+
+    def run(self):
+        name = f"{self.args.prefix}{self.index}"
+        connection = Connection(self.args.host, self.args.port, name, timeout=self.args.timeout)
+        start = time.perf_counter()
+        try:
+            connection.connect()
+        except Exception as e:
+            print(f"{name} could not connect: {str(e)}", file=sys.stderr)
+            return
+        self.connect_time = time.perf_counter() - start
+
+        commands, weights = zip(*self.args.mix)
+        operations = 0
+        try:
+            while time.perf_counter() < self.deadline and (not self.args.operations or operations < self.args.operations):
+                command = self.random.choices(commands, weights)[0]
+                if command in ("download", "delete") and not self.uploaded:
+                    command = "upload"
+                start = time.perf_counter()
+                try:
+                    self.bytes[command] += getattr(self, command)(connection)
+                except (ServerError, TimeoutError, OSError) as e:
+                    self.errors[command] += 1
+                    if isinstance(e, ConnectionError):
+                        break
+                    continue
+                finally:
+                    operations += 1
+                self.latencies[command].append(time.perf_counter() - start)
+        finally:
+            connection.close()
+
+    def list(self, connection):
+        connection.list_page(page_size=self.args.page_size)
+        return 0
+
+    def upload(self, connection):
+        size = self.random.choices(*zip(*self.sizes))[0]
+        filename = f"load_{self.counter}.bin"
+        self.counter += 1
+        connection.upload(self.payloads[size], filename)
+        self.uploaded.append((f"{connection.client_name}_{filename}", size)) # Files are listed under their key
+        return size
+
+    def download(self, connection):
+        file_key, size = self.random.choice(self.uploaded)
+        connection.fetch(connection.client_name, file_key, Discard())
+        return size
+
+    def delete(self, connection):
+        file_key, _ = self.uploaded.pop(self.random.randrange(len(self.uploaded)))
+        connection.delete(connection.client_name, file_key)
+        return 0
+
+
+class Discard:
+    # Sink for downloads, the data is only counted
+    def write(self, data):
+        return len(data)
+
+
+def summarize(users, elapsed):
+    results = {"elapsed": elapsed, "commands": {}}
+    connect_times = sorted(user.connect_time for user in users if user.connect_time is not None)
+    results["connect"] = {"count": len(connect_times), "failed": len(users) - len(connect_times),
+                          "p50": percentile(connect_times, 0.5), "p99": percentile(connect_times, 0.99),
+                          "max": connect_times[-1] if connect_times else None}
+    total = 0
+    for command in COMMANDS:
+        latencies = sorted(latency for user in users for latency in user.latencies[command])
+        transferred = sum(user.bytes[command] for user in users)
+        total += len(latencies)
+        results["commands"][command] = {
+            "count": len(latencies),
+            "errors": sum(user.errors[command] for user in users),
+            "per_second": len(latencies) / elapsed,
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": latencies[-1] if latencies else None,
+            "bytes": transferred,
+            "mb_per_second": transferred / elapsed / (1 << 20),
+        }
+    results["operations_per_second"] = total / elapsed
+    return results
+
+
+def milliseconds(value):
+    return f"{value * 1000:9.2f}" if value is not None else f"{'-':>9}"
+
+
+def report(results):
+    connect = results["connect"]
+    print(f"connections: {connect['count']} ok, {connect['failed']} failed, setup p50 {milliseconds(connect['p50']).strip()} ms, "
+          f"p99 {milliseconds(connect['p99']).strip()} ms")
+    print(f"{'command':<10}{'count':>8}{'errors':>8}{'ops/s':>10}{'MB/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+    for command, stats in results["commands"].items():
+        print(f"{command:<10}{stats['count']:>8}{stats['errors']:>8}{stats['per_second']:>10.1f}{stats['mb_per_second']:>9.1f}"
+              f"{milliseconds(stats['p50'])} {milliseconds(stats['p99'])} {milliseconds(stats['p999'])}")
+    print(f"total {results['operations_per_second']:.1f} operations/s over {results['elapsed']:.1f}s")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the file server")
+    parser.add_argument("--host", default="127.0.0.1", help="server to load")
+    parser.add_argument("--port", type=int, default=0, help="server port, a server on loopback is started when not given")
+    parser.add_argument("--users", type=int, default=16, help="concurrent users, each with its own connection")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--operations", type=int, default=0, help="stop every user after this many commands, 0 for no limit")
+    parser.add_argument("--mix", default="list=1,upload=3,download=5,delete=1", help="command weights")
+    parser.add_argument("--sizes", default="4K:50,64K:30,1M:15,8M:5", help="upload sizes with their weights")
+    parser.add_argument("--page-size", type=int, default=200, help="entries per LIST page")
+    parser.add_argument("--prefix", default="load", help="prefix of the user names")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a reply")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the command and size choices")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+    args.mix = parse_weights(args.mix)
+    for command, _ in args.mix:
+        if command not in COMMANDS:
+            parser.error(f"Unknown command {command} in --mix")
+    args.sizes = parse_weights(args.sizes, parse_size)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as workdir:
+        engine = None
+        if not args.port:
+            storage_path = os.path.join(workdir, "storage")
+            os.mkdir(storage_path)
+            engine = ServerEngine(storage_path, 0, host="127.0.0.1", log=lambda message: None)
+            engine.start()
+            engine.started.wait()
+            args.port = engine.port
+
+        payloads = {}
+        for size, _ in args.sizes:
+            payloads[size] = os.path.join(workdir, f"payload_{size}.bin")
+            with open(payloads[size], "wb") as f:
+                f.write(os.urandom(size))
+
+        start = time.perf_counter()
+        users = [User(index, args, args.sizes, payloads, start + args.duration) for index in range(args.users)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        results = summarize(users, time.perf_counter() - start)
+        results["config"] = {"host": args.host, "users": args.users, "duration": args.duration, "operations": args.operations,
+                             "mix": dict(args.mix), "sizes": {str(size): weight for size, weight in args.sizes}, "seed": args.seed}
+
+        report(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        if engine:
+            engine.stop()
+
+
+if __name__ == "__main__":
+    main()
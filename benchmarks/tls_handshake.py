@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_core import ServerEngine
+from client_core import Connection
+import tls
+
+# Cost of connecting with and without TLS, with full and resumed handshakes, and the bulk throughput of both
+#
+# The servers run on loopback in this process. Their CPU time is the time of the event loop
+# thread, where asyncio does the handshakes. The storm opens many connections at once, like
+# the clients of a server that just came back.
+
+def start_engine(storage_path, tls_cert=None, tls_key=None):
+    engine = ServerEngine(storage_path, 0, host="127.0.0.1", log=lambda message: None, tls_cert=tls_cert, tls_key=tls_key)
+    thread = threading.Thread(target=engine.run, daemon=True)
+    thread.start()
+    engine.started.wait()
+    engine.cpu_clock = time.pthread_getcpuclockid(thread.ident) if hasattr(time, "pthread_getcpuclockid") else None
+    return engine
+
+
+def server_cpu(engine):
+    return time.clock_gettime(engine.cpu_clock) if engine.cpu_clock is not None else float("nan")
+
+
+def connect(engine, name, context):
+    connection = Connection("127.0.0.1", engine.port, name, tls_context=context)
+    connection.connect()
+    resumed = connection.tls_resumed
+    connection.close()
+    return resumed
+
+
+def sequential(engine, label, count, context=None, resume=True):
+    names = (f"{label}-{index}" for index in range(count))
+    connect(engine, next(names), context) # Leaves a session to resume
+    cpu, start, resumed = server_cpu(engine), time.perf_counter(), 0
+    for name in names:
+        if not resume:
+            tls.SESSIONS.clear()
+        resumed += connect(engine, name, context)
+    elapsed, cpu = time.perf_counter() - start, server_cpu(engine) - cpu
+    count -= 1
+    print(f"{label:<18} {1000 * elapsed / count:8.2f} ms per connection   server CPU {1000 * cpu / count:6.2f} ms   resumed {resumed}/{count}")
+
+
+def storm(engine, label, count, context=None, resume=True):
+    if context is not None and not resume:
+        tls.SESSIONS.clear()
+    elif context is not None:
+        connect(engine, f"{label}-warm", context)
+    failed = []
+    def run(index):
+        try:
+            connect(engine, f"{label}-{index}", context)
+        except Exception as e:
+            failed.append(e)
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    cpu, start = server_cpu(engine), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed, cpu = time.perf_counter() - start, server_cpu(engine) - cpu
+    print(f"{label:<18} {count} connections in {elapsed:6.2f} s   server CPU {cpu:6.2f} s   failed {len(failed)}")
+
+
+def throughput(engine, label, filepath, save_path, context=None):
+    connection = Connection("127.0.0.1", engine.port, label, tls_context=context)
+    connection.connect()
+    size = os.path.getsize(filepath) / (1 << 20)
+    start = time.perf_counter()
+    connection.upload(filepath, "data.bin", compress=False)
+    upload_time = time.perf_counter() - start
+    start = time.perf_counter()
+    connection.fetch(label, f"{label}_data.bin", open(save_path, "wb"), compress=False)
+    download_time = time.perf_counter() - start
+    connection.close()
+    print(f"{label:<18} upload {size / upload_time:9.1f} MB/s   download {size / download_time:9.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS handshake cost and throughput benchmark")
+    parser.add_argument("--connections", type=int, default=200, help="connections opened one after another")
+    parser.add_argument("--storm", type=int, default=200, help="connections opened at the same time")
+    parser.add_argument("--size-mb", type=int, default=64, help="size of the transferred file")
+    parser.add_argument("--key-type", choices=("ec", "rsa"), default="ec", help="key of the self-signed server certificate")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        certfile, keyfile = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+        tls.generate_self_signed(certfile, keyfile, key_type=args.key_type)
+        context = tls.client_context(cafile=certfile)
+        filepath, save_path = os.path.join(workdir, "data.bin"), os.path.join(workdir, "download.bin")
+        with open(filepath, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1 << 20))
+        engines = []
+        for name, options in (("plain", {}), ("tls", {"tls_cert": certfile, "tls_key": keyfile})):
+            os.mkdir(os.path.join(workdir, name))
+            engines.append(start_engine(os.path.join(workdir, name), **options))
+        plain, secure = engines
+
+        sequential(plain, "plaintext", args.connections)
+        sequential(secure, "tls full", args.connections, context, resume=False)
+        sequential(secure, "tls resumed", args.connections, context)
+        storm(plain, "storm plaintext", args.storm)
+        storm(secure, "storm tls full", args.storm, context, resume=False)
+        storm(secure, "storm tls resumed", args.storm, context)
+        throughput(plain, "plaintext", filepath, save_path)
+        throughput(secure, "tls", filepath, save_path, context)
+        for engine in engines:
+            engine.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_core import ServerEngine
+from client_core import Connection
+import protocol
+
+# Loopback throughput of the original 1024 byte send/recv loops against sendfile and recv_into transfers
+
+def start_engine(storage_path, buffer_size):
+    engine = ServerEngine(storage_path, 0, host="127.0.0.1", log=lambda message: None, buffer_size=buffer_size)
+    engine.start()
+    engine.started.wait()
+    return engine
+
+
+def legacy_transfer(port, filepath, save_path):
+    # The original client: three sockets, text commands and 1024 byte chunks on both sides
+    command_socket = socket.create_connection(("127.0.0.1", port))
+    command_socket.send("legacy".encode())
+    heartbeat_socket = socket.create_connection(("127.0.0.1", port))
+    notification_socket = socket.create_connection(("127.0.0.1", port))
+    command_socket.recv(1024)
+
+    file_size = os.path.getsize(filepath)
+    start = time.perf_counter()
+    command_socket.send(f"UPLOAD data.bin {file_size}".encode())
+    time.sleep(0.05) # The text protocol has no framing, keep the command apart from the data
+    with open(filepath, "rb") as f:
+        while chunk := f.read(1024):
+            command_socket.sendall(chunk)
+    command_socket.recv(1024)
+    upload_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    command_socket.send("DOWNLOAD legacy legacy_data.bin".encode())
+    file_size = int(command_socket.recv(1024).decode().split(" ", 1)[1])
+    with open(save_path, "wb") as f:
+        received = 0
+        while received < file_size:
+            data = command_socket.recv(1024)
+            f.write(data)
+            received += len(data)
+    download_time = time.perf_counter() - start
+
+    for sock in (command_socket, heartbeat_socket, notification_socket):
+        sock.close()
+    return upload_time, download_time
+
+
+def framed_transfer(port, filepath, save_path, buffer_size):
+    connection = Connection("127.0.0.1", port, "framed", buffer_size=buffer_size)
+    connection.connect()
+
+    start = time.perf_counter()
+    connection.upload(filepath, "data.bin")
+    upload_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    connection.download("framed", "framed_data.bin", save_path)
+    download_time = time.perf_counter() - start
+
+    connection.close()
+    return upload_time, download_time
+
+
+def report(name, size, upload_time, download_time):
+    megabytes = size / (1 << 20)
+    print(f"{name:<28} upload {megabytes / upload_time:9.1f} MB/s   download {megabytes / download_time:9.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback transfer throughput benchmark")
+    parser.add_argument("--size-mb", type=int, default=64, help="size of the transferred file")
+    parser.add_argument("--buffer-size", type=int, default=protocol.BUFFER_SIZE, help="buffer size of the new transfer path")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        storage_path = os.path.join(workdir, "storage")
+        os.mkdir(storage_path)
+        filepath = os.path.join(workdir, "data.bin")
+        save_path = os.path.join(workdir, "download.bin")
+        with open(filepath, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1 << 20))
+        size = os.path.getsize(filepath)
+
+        engine = start_engine(storage_path, args.buffer_size)
+        report("legacy (1024 byte chunks)", size, *legacy_transfer(engine.port, filepath, save_path))
+        report(f"sendfile/recv_into ({args.buffer_size})", size, *framed_transfer(engine.port, filepath, save_path, args.buffer_size))
+        engine.stop()
+
+
+if __name__ == "__main__":
+    main()
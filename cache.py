@@ -0,0 +1,146 @@
+import collections
+import mmap
+
+# Read cache of the files clients download
+#
+# Small files are copied into memory, larger ones are mapped, so a hot download needs no
+# open, stat or read. The budget counts both, files larger than an eighth of it are never
+# cached. A file is only admitted the second time it is requested within the last
+# DOORKEEPER_SIZE misses, one-off downloads pass through without evicting the hot files,
+# and the least recently used entries are evicted when the budget is exceeded.
+#
+# Entries are not revalidated against the disk. The engine invalidates a key whenever it
+# replaces or deletes the file, stored files are never written in place, so a mapping
+# that is still in use keeps showing the old contents until the download ends. With
+# --workers the engine checks entries against the shared catalog as well.
+
+DEFAULT_BUDGET = 256 << 20      # Bytes of file contents the cache holds
+SMALL_FILE_SIZE = 256 << 10     # Files up to this size are copied into memory, larger ones are mapped
+DOORKEEPER_SIZE = 4096          # Keys remembered as requested once
+
+
+def etag_of(stat):
+    # Identifies a version of a file, clients use it to resume transfers
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+# Reads a cached buffer like a file, every download gets its own position
+class BufferReader:
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.position = offset
+
+    def read(self, size):
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+
+# Contents of a file in memory or mapped, shared by every download of it
+class CachedFile:
+    def __init__(self, buffer, etag, checksum, mtime=None):
+        self.buffer = buffer                        # memoryview of the contents
+        self.size = len(buffer)
+        self.etag = etag
+        self.mtime = mtime                          # st_mtime of the file, as the catalog records it
+        self.checksum = checksum                    # sha256 recorded in the catalog, None if it is not known
+        self.choices = {}                           # Compression codec picked for the whole file, by the codecs offered
+
+    def reader(self, offset):
+        return BufferReader(self.buffer, offset)
+
+    def close(self):
+        pass # Mappings are closed when the last download using them lets go
+
+
+# A file the cache does not hold, read from disk
+class DiskFile:
+    def __init__(self, f, stat, checksum):
+        self.file = f
+        self.buffer = None
+        self.size = stat.st_size
+        self.etag = etag_of(stat)
+        self.checksum = checksum
+        self.choices = {}
+
+    def reader(self, offset):
+        self.file.seek(offset)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+
+class FileCache:
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.max_size = budget // 8                 # Larger files are always read from disk
+        self.entries = collections.OrderedDict()    # Cached files by key, least recently used first
+        self.seen = collections.OrderedDict()       # Keys of files that missed once, they are admitted on the next miss
+        self.used = 0                               # Bytes held by the entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, f, stat, checksum, admit=False):
+        # Cache a file that missed, returns the entry or None when it is not admitted
+        #
+        # admit skips the doorkeeper, for files that are known to be hot.
+        if not self.budget or stat.st_size > self.max_size:
+            return None
+        if key not in self.seen and not admit:
+            self.seen[key] = True
+            if len(self.seen) > DOORKEEPER_SIZE:
+                self.seen.popitem(last=False)
+            return None
+        self.seen.pop(key, None)
+
+        if stat.st_size <= SMALL_FILE_SIZE:
+            buffer = memoryview(f.read())
+        else:
+            buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        self.invalidate(key)
+        entry = self.entries[key] = CachedFile(buffer, etag_of(stat), checksum, stat.st_mtime)
+        self.used += entry.size
+        while self.used > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.used -= evicted.size
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used -= entry.size
+
+    def clear(self):
+        self.entries.clear()
+        self.used = 0
+
+    def snapshot(self):
+        # Keys of the cached files, least recently used first, and of the files that missed once
+        return {"entries": list(self.entries), "seen": list(self.seen)}
+
+    def remember(self, keys):
+        # Files that missed once in an earlier process are admitted on their next miss here
+        for key in keys[-DOORKEEPER_SIZE:]:
+            self.seen[key] = True
+        while len(self.seen) > DOORKEEPER_SIZE:
+            self.seen.popitem(last=False)
+
+    def hit_ratio(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
@@ -0,0 +1,248 @@
+import base64
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT PRIMARY KEY,           -- Name of the file in the storage folder, 'owner_filename'
+    owner TEXT NOT NULL,            -- Client that uploaded the file
+    name TEXT NOT NULL,             -- File name as uploaded
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    checksum TEXT                   -- sha256 of the contents, NULL for files imported from an existing folder
+);
+CREATE INDEX IF NOT EXISTS files_by_owner ON files (owner, name);
+CREATE INDEX IF NOT EXISTS files_by_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_by_owner_name_key ON files (owner, name, key);
+CREATE INDEX IF NOT EXISTS files_by_name_key ON files (name, key);
+CREATE INDEX IF NOT EXISTS files_by_size_key ON files (size, key);
+CREATE INDEX IF NOT EXISTS files_by_mtime_key ON files (mtime, key);
+CREATE TABLE IF NOT EXISTS blobs (
+    checksum TEXT PRIMARY KEY,      -- sha256 of the contents, also the name of the blob file
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL           -- Catalog entries that use the blob
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+SORT_KEYS = ("key", "name", "owner", "size", "mtime") # Columns a listing can be sorted by
+
+UPSERT = ("INSERT INTO files (key, owner, name, size, mtime, checksum) VALUES (?, ?, ?, ?, ?, ?) "
+          "ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, name = excluded.name, "
+          "size = excluded.size, mtime = excluded.mtime, checksum = excluded.checksum")
+
+# Persistent catalog of the stored files, kept in SQLite inside the storage folder
+#
+# The catalog is the record of which files exist and who owns them, the storage folder is
+# only scanned once, to import files that were there before the catalog.
+class Catalog:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()              # Every thread gets a connection of its own
+        self.connections = []                       # All of them, so close() can reach them
+        self.connections_lock = threading.Lock()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        # Connection of the calling thread, threads never share a transaction and WAL lets them read at the same time
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")     # Readers never wait for the writer
+            db.execute("PRAGMA synchronous=NORMAL")   # Durable across process crashes, cheap commits
+            self.local.db = db
+            with self.connections_lock:
+                self.connections.append(db)
+        return db
+
+    @contextlib.contextmanager
+    def write_transaction(self):
+        # Takes the write lock up front, a deferred upgrade can fail under contention. Inside another one it joins that one.
+        if self.db.in_transaction:
+            yield self.db
+            return
+        with self.db as db:
+            db.execute("BEGIN IMMEDIATE")
+            yield db
+
+    def close(self):
+        with self.connections_lock:
+            for db in self.connections:
+                db.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+    def get(self, key):
+        row = self.db.execute("SELECT * FROM files WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+
+    def add(self, key, owner, name, size, mtime, checksum=None):
+        self.db.execute(UPSERT, (key, owner, name, size, mtime, checksum))
+
+    def add_many(self, rows):
+        # add() for many (key, owner, name, size, mtime, checksum) rows in one transaction
+        with self.write_transaction():
+            self.db.executemany(UPSERT, rows)
+
+    def remove(self, key):
+        self.db.execute("DELETE FROM files WHERE key = ?", (key,))
+
+    def list(self, owner=None):
+        # Entries ordered by key, optionally only those of one owner
+        if owner is None:
+            cursor = self.db.execute("SELECT * FROM files ORDER BY key")
+        else:
+            cursor = self.db.execute("SELECT * FROM files WHERE owner = ? ORDER BY name", (owner,))
+        for row in cursor:
+            yield dict(row)
+
+    def page(self, owner=None, pattern=None, prefix=None, sort="key", descending=False, limit=100, cursor=None):
+        # One page of a filtered listing, returns the entries and the cursor of the next page (None on the last page)
+        #
+        # Pages use keyset pagination: the cursor holds the sort value and key of the last entry,
+        # so every page is an index range scan no matter how far into the listing it is.
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Cannot sort by {sort}")
+        conditions, params = [], []
+        if owner is not None:
+            conditions.append("owner = ?")
+            params.append(owner)
+        if prefix:
+            conditions.append("name >= ? AND name < ?")
+            params += [prefix, prefix + "\U0010ffff"]
+        if pattern:
+            conditions.append("name GLOB ?")
+            params.append(pattern)
+        if cursor is not None:
+            value, key = decode_cursor(cursor)
+            compare = "<" if descending else ">"
+            if sort == "key":
+                conditions.append(f"key {compare} ?")
+                params.append(key)
+            else:
+                conditions.append(f"({sort}, key) {compare} (?, ?)") # A row value comparison seeks into the index
+                params += [value, key]
+
+        order = "DESC" if descending else "ASC"
+        order_by = f"key {order}" if sort == "key" else f"{sort} {order}, key {order}"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = [dict(row) for row in self.db.execute(f"SELECT * FROM files {where} ORDER BY {order_by} LIMIT ?", params + [limit + 1])]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][sort], rows[-1]["key"])
+        return rows, next_cursor
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def get_blob(self, checksum):
+        row = self.db.execute("SELECT * FROM blobs WHERE checksum = ?", (checksum,)).fetchone()
+        return dict(row) if row else None
+
+    def blob_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def link(self, key, owner, name, size, mtime, checksum):
+        # Point an entry at a blob, returns the checksum of a blob that lost its last reference or None
+        released = self.link_many([(key, owner, name, size, mtime, checksum)])
+        return released[0] if released else None
+
+    def link_many(self, rows):
+        # link() for many (key, owner, name, size, mtime, checksum) rows in one transaction
+        #
+        # Returns the checksums of the blobs that lost their last reference. A later row of the
+        # same batch can refer to one of them again, check get_blob() before removing a blob.
+        released = []
+        with self.write_transaction():
+            for key, owner, name, size, mtime, checksum in rows:
+                old = self.db.execute("SELECT checksum FROM files WHERE key = ?", (key,)).fetchone()
+                self.db.execute(
+                    "INSERT INTO blobs (checksum, size, refs) VALUES (?, ?, 1) ON CONFLICT (checksum) DO UPDATE SET refs = refs + 1",
+                    (checksum, size))
+                self.add(key, owner, name, size, mtime, checksum)
+                if old and old[0] and self.release(old[0]):
+                    released.append(old[0])
+        return released
+
+    def unlink(self, key):
+        # Remove an entry, returns the checksum of a blob that lost its last reference or None
+        with self.write_transaction():
+            old = self.db.execute("SELECT checksum FROM files WHERE key = ?", (key,)).fetchone()
+            self.remove(key)
+            return self.release(old[0]) if old and old[0] else None
+
+    def release(self, checksum):
+        # Drop one reference to a blob, only called inside a transaction
+        self.db.execute("UPDATE blobs SET refs = refs - 1 WHERE checksum = ?", (checksum,))
+        row = self.db.execute("SELECT refs FROM blobs WHERE checksum = ?", (checksum,)).fetchone()
+        if row is None or row[0] > 0: # Entries from the flat backend have a checksum but no blob
+            return None
+        self.db.execute("DELETE FROM blobs WHERE checksum = ?", (checksum,))
+        return checksum
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def is_imported(self):
+        return self.get_meta("imported") == "1"
+
+    def import_directory(self, storage_path, prune=False, batch_size=1000, path=None):
+        # Add the files of an existing storage folder, one transaction per batch
+        #
+        # This is a generator that yields after every batch, so the caller can serve clients in
+        # between. Files of a folder from before the catalog only have their names to go by, the
+        # owner is the part before the first underscore. With prune, entries whose file is gone
+        # are dropped as well, path gives the file of a key when it is not in the storage folder itself.
+        batch = []
+        for entry in os.scandir(storage_path):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            stat = entry.stat()
+            owner, _, name = entry.name.partition("_")
+            batch.append((entry.name, owner, name or entry.name, stat.st_size, stat.st_mtime))
+            if len(batch) >= batch_size:
+                self.insert_missing(batch)
+                batch = []
+                yield
+        self.insert_missing(batch)
+        if prune:
+            yield from self.prune_missing(path or (lambda key: os.path.join(storage_path, key)), batch_size)
+        self.set_meta("imported", "1")
+
+    def insert_missing(self, rows):
+        with self.write_transaction():
+            self.db.executemany("INSERT OR IGNORE INTO files (key, owner, name, size, mtime) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def prune_missing(self, path, batch_size):
+        keys = [row[0] for row in self.db.execute("SELECT key FROM files")]
+        for start in range(0, len(keys), batch_size):
+            missing = [(key,) for key in keys[start:start + batch_size] if not os.path.exists(path(key))]
+            with self.write_transaction():
+                self.db.executemany("DELETE FROM files WHERE key = ?", missing)
+            yield
+
+
+def encode_cursor(value, key):
+    return base64.urlsafe_b64encode(json.dumps([value, key]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    return value, key
@@ -1,356 +1,474 @@
-import socket
-import os
-from tkinter import Tk, Label, Entry, Button, Listbox, filedialog, END, Frame
-import threading
-import time
-
-# Client class
-class Client:
-    def __init__(self):
-        self.command_socket = None
-        self.heartbeat_socket = None
-        self.notification_socket = None
-        self.is_connected = False  # Initialize the connection state
-        self.gui_setup()
-    
-    # GUI Setup
-    def gui_setup(self):
-        self.root = Tk()
-        self.root.title("Client GUI")
-
-        # Server Connection Fields
-        Label(self.root, text="Server IP:").grid(row=0, column=0)
-        self.server_ip_entry = Entry(self.root)
-        self.server_ip_entry.grid(row=0, column=1)
-
-        Label(self.root, text="Server Port:").grid(row=1, column=0)
-        self.server_port_entry = Entry(self.root)
-        self.server_port_entry.grid(row=1, column=1)
-
-        Label(self.root, text="Your Name:").grid(row=2, column=0)
-        self.client_name_entry = Entry(self.root)
-        self.client_name_entry.grid(row=2, column=1)
-
-        # Create a frame to hold the buttons
-        button_frame = Frame(self.root)
-        button_frame.grid(row=3, column=0, columnspan=2)  # Place the frame in the grid
-
-        # Connect Button
-        self.connect_button = Button(button_frame, text="Connect", command=self.connect_to_server)
-        self.connect_button.grid(row=0, column=0, padx=(0, 2))  # No padding on the right
-
-        # Disconnect Button
-        self.disconnect_button = Button(button_frame, text="Disconnect", command=self.disconnect_from_server, state="disabled")
-        self.disconnect_button.grid(row=0, column=1, padx=(2, 0))  # No padding on the left
-
-        # Configure the button frame to center the buttons
-        button_frame.grid_columnconfigure(0, weight=1)  # Allow the first column to expand
-        button_frame.grid_columnconfigure(1, weight=1)  # Allow the second column to expand
-
-        # Upload Button
-        self.upload_button = Button(self.root, text="Upload File", command=self.upload_file, state="disabled")
-        self.upload_button.grid(row=4, column=0, columnspan=2)
-
-        # List Button
-        self.list_button = Button(self.root, text="List Files", command=self.list_files, state="disabled")
-        self.list_button.grid(row=5, column=0, columnspan=2)
-
-        # Download Button
-        self.download_button = Button(self.root, text="Download File", command=self.download_file, state="disabled")
-        self.download_button.grid(row=6, column=0, columnspan=2)
-
-        # Delete button
-        self.delete_button = Button(self.root, text="Delete File", command=self.delete_file, state="disabled")
-        self.delete_button.grid(row=7, column=0, columnspan=2)
-
-        # Client Log
-        Label(self.root, text="Client Log:").grid(row=8, column=0, columnspan=2)
-        self.log_listbox = Listbox(self.root, width=50, height=20)
-        self.log_listbox.grid(row=9, column=0, columnspan=2)
-
-
-    def connect_to_server(self):
-        if self.is_connected:
-            self.log("Disconnecting from the current server...")
-            self.close_connections()  # Close existing connections
-
-        try:
-            # Get the necessary information of the server
-            server_ip = self.server_ip_entry.get()
-            server_port = int(self.server_port_entry.get())
-            client_name = self.client_name_entry.get()
-
-            # Create command socket (for sending commands to the server)
-            self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.command_socket.connect((server_ip, server_port))
-            self.command_socket.send(client_name.encode())
-
-            # Create heartbeat socket (for making sure the server is running)
-            self.heartbeat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.heartbeat_socket.connect((server_ip, server_port))
-
-            # Create notification socket (for receiving notifications from the server)
-            self.notification_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.notification_socket.connect((server_ip, server_port))
-
-            # Start heartbeat listener in a separate thread
-            threading.Thread(target=self.listen_for_heartbeat, daemon=True).start()
-
-            # Start notification listener in a separate thread
-            threading.Thread(target=self.listen_for_notifications, daemon=True).start()
-
-            response = self.command_socket.recv(1024).decode()
-            if "ERROR" in response: # If there is an error close the sockets and write the error in log and close sockets
-                self.log(response)
-                self.close_connections()  # Close sockets on error
-            else:
-                self.log(response)
-                self.is_connected = True  # Set connected state to True
-                self.upload_button.config(state="normal")       # Enable the upload button
-                self.list_button.config(state="normal")         # Enable the list button
-                self.download_button.config(state="normal")     # Enable the download button
-                self.delete_button.config(state="normal")       # Enable the delete button
-                self.disconnect_button.config(state="normal")   # Enable the disconnect button
-                self.connect_button.config(state="disabled")    # Disable the connect button
-                self.log("Connected successfully.")
-
-        except Exception as e:
-            self.log(f"Connection failed: {str(e)}")
-
-    def listen_for_heartbeat(self):
-        while True: # Keep listening for the heartbeat message to make sure the server is running
-            try: 
-                heartbeat_message = self.heartbeat_socket.recv(1024).decode()
-                """ if heartbeat_message == "HEARTBEAT":
-                    self.log("Received heartbeat from server.")
-                else:
-                    self.log("Unexpected message on heartbeat connection.") """
-            except Exception as e:
-                # self.log("Connection to server has been lost")
-                self.disconnect_from_server()
-                break
-
-
-    def download_file(self):
-        try:
-            # Request the list of files from the server
-            self.command_socket.send("LIST".encode())   
-            file_list = self.command_socket.recv(4096).decode().strip()
-            
-            # Check if the file list is empty
-            if not file_list:
-                self.log("No files available for download.")
-                return
-
-            # Open a new window to display the list of files
-            self.open_file_selection_window(file_list)
-        except Exception as e:
-            self.log(f"Failed to request file list: {str(e)}")
-    
-    def open_file_selection_window(self, file_list):
-        # Create a new window
-        window = Tk()
-        window.title("Select a File to Download")
-
-        # Display the list of files
-        Label(window, text="Available Files:").pack()
-        file_listbox = Listbox(window, width=50, height=20)
-        file_listbox.pack()
-
-        # Populate the listbox
-        files = file_list.split("\n")
-        for file_entry in files:
-            file_listbox.insert(END, file_entry)
-
-        def confirm_download():
-            selected = file_listbox.get(file_listbox.curselection()) # Get the selected file
-            if selected:
-                filename, owner = selected.split(": ", 1)
-                window.destroy()  # Close the selection window
-                self.download_selected_file(owner.strip(), filename.strip()) # Download the selected file
-
-        Button(window, text="Download", command=confirm_download).pack()
-
-        # Run the window's event loop
-        window.mainloop()
-
-    def download_selected_file(self, owner, filename):
-        try:
-            # Send the download request
-            self.log(f"Requesting download for {owner}: {filename}")
-            self.command_socket.send(f"DOWNLOAD {owner} {filename}".encode())
-            
-            response = self.command_socket.recv(1024).decode() # Get the response of the server
-            
-            if response.startswith("ERROR"): # Check if there are any errors
-                self.log(response)
-                return
-
-            # Get the file size
-            _, file_size = response.split(" ", 1)
-            file_size = int(file_size)
-
-            # Save the file with the original filename
-            save_path = filedialog.asksaveasfilename(defaultextension=".txt", initialfile=filename)
-            if not save_path:
-                return
-
-            with open(save_path, "wb") as f: # Open the file in binary write mode
-                received = 0  
-                while received < file_size: # Loop until all data is received
-                    data = self.command_socket.recv(1024) # Receive data in chunks of 1024 bytes
-                    f.write(data) 
-                    received += len(data) # Update the amount of data received
-
-            self.log(f"File {filename} downloaded successfully.")
-        except Exception as e:
-            self.log(f"Download failed: {str(e)}")
-
-
-    def upload_file(self):
-        try:
-            filepath = filedialog.askopenfilename(filetypes=[("Text files", "*.txt")]) # Prompt the user to select a file to upload
-            if not filepath:
-                return # Exit if no file is selected
-
-            filename = os.path.basename(filepath) # Extract the filename 
-            filename = filename.replace(" ", "_") # Replace spaces with underscores
-            file_size = os.path.getsize(filepath) # Extract the file size
-
-            self.command_socket.send(f"UPLOAD {filename} {file_size}".encode()) # Send the filename and file size to the server
-
-            with open(filepath, "rb") as f:
-                while chunk := f.read(1024):  # Read the file in chunks of 1024 bytes
-                    self.command_socket.send(chunk) # Send each chunk to the server
-
-            response = self.command_socket.recv(1024).decode() # Receive the server's response to the upload
-            self.log(response)
-        except Exception as e:
-            self.log(f"Upload failed: {str(e)}") 
-
-
-    def list_files(self):
-        try:
-            self.log("Requesting file list...")
-            # Send the LIST command to the server to request the file list
-            self.command_socket.send("LIST".encode())
-            # Receive the file list from the server
-            file_list = self.command_socket.recv(4096).decode()
-            
-            # Log the received file list with each file on a different line
-            self.log("Available files:")
-            for file in file_list.split("\n"):
-                self.log(file)
-        
-        except Exception as e:
-            self.log(f"Failed to list files: {str(e)}")
-
-    def log(self, message):
-        self.log_listbox.insert(END, message)
-        self.log_listbox.see(END)
-        self.root.update_idletasks() # Force the GUI to update
-
-    def delete_file(self):
-        try:
-            # Request and recieve the list of files 
-            self.command_socket.send("LIST".encode())
-            file_list = self.command_socket.recv(4096).decode().strip()
-            
-            # Check if the list is empty
-            if not file_list:
-                self.log("No files available for deletion.")
-                return
-
-            # Open a new window to display the list of files
-            self.open_file_deletion_window(file_list)
-        except Exception as e:
-            self.log(f"Failed to request file list for deletion: {str(e)}")
-
-    def open_file_deletion_window(self, file_list):
-        # Create a new window
-        window = Tk()
-        window.title("Select a File to Delete")
-
-        # Display the list of files
-        Label(window, text="Uploaded Files:").pack()
-        file_listbox = Listbox(window, width=50, height=20)
-        file_listbox.pack()
-
-        # Populate the listbox
-        files = file_list.split("\n")
-        for file_entry in files:
-            file_listbox.insert(END, file_entry)
-
-        def confirm_delete():
-            selected = file_listbox.get(file_listbox.curselection()) # Get the selection
-            if selected:
-                filename, owner = selected.split(": ", 1)
-                window.destroy()  # Close the selection window
-                self.delete_selected_file(owner.strip(), filename.strip())
-
-        Button(window, text="Delete", command=confirm_delete).pack()
-
-        # Run the window's event loop
-        window.mainloop()
-
-    def delete_selected_file(self, owner, filename):
-        try:
-            self.log(f"Requesting delete for {owner}: {filename}") # Write the request in the log
-
-            self.command_socket.send(f"DELETE {owner} {filename}".encode()) # Send the delete request to server
-            response = self.command_socket.recv(1024).decode() # Recieve the response from the server
-
-            if response.startswith("ERROR"): # Check if there is an error in the response
-                self.log(response)
-                return
-            
-            self.log(response)
-            
-        except Exception as e:
-            self.log(f"Deletion failed: {str(e)}")
-
-    def listen_for_notifications(self):
-        while True: # Listen for any notifications from the server
-            try:
-                notification = self.notification_socket.recv(1024).decode()
-                if notification:
-                    self.log(notification)  # Display the notification in the client log
-            except Exception as e:
-                """ self.log(f"Error while listening for notifications: {str(e)}") """
-                break
-
-    def run(self):
-        # Start the GUI main loop
-        self.root.mainloop()
-
-    def close_connections(self):
-        # Close all sockets and reset connection state
-        if self.command_socket:
-            self.command_socket.close()
-            self.command_socket = None
-        if self.heartbeat_socket:
-            self.heartbeat_socket.close()
-            self.heartbeat_socket = None
-        if self.notification_socket:
-            self.notification_socket.close()
-            self.notification_socket = None
-        self.is_connected = False  # Reset connection state
-
-    def disconnect_from_server(self):
-        if self.is_connected:
-            self.log("Disconnecting from the server...")
-            self.close_connections()  # Close existing connections
-            self.disconnect_button.config(state="disabled")     # Disable the disconnect button
-            self.connect_button.config(state="normal")          # Enable the connect button
-            self.upload_button.config(state="disabled")         # Disable the upload button
-            self.list_button.config(state="disabled")           # Disable the list button
-            self.download_button.config(state="disabled")       # Disable the download button
-            self.delete_button.config(state="disabled")         # Disable the delete button
-            self.log("Disconnected successfully.")
-        else:
-            self.log("Not connected to any server.")
-
-
-if __name__ == "__main__":
-    client = Client()
-    client.run()
+import os
+import queue
+import threading
+from tkinter import Tk, Toplevel, Label, Entry, Button, Checkbutton, BooleanVar, Listbox, Scrollbar, filedialog, END, Frame
+from client_core import Connection, TransferQueue
+import tls
+
+# Client class
+class Client:
+    def __init__(self):
+        self.connection = None      # Framed connection to the server
+        self.transfers = None       # Runs uploads and downloads in the background
+        self.gui_calls = queue.Queue() # Calls from other threads, run by the GUI thread
+        self.transfer_events = queue.Queue() # Progress of the transfers, shown by the GUI thread
+        self.shown_transfers = []   # Transfers in the transfer list, in the order of its rows
+        self.is_connected = False  # Initialize the connection state
+        self.tls_contexts = {}      # CA file -> TLS context, kept so a reconnect resumes the TLS session
+        self.gui_setup()
+        self.poll_gui_calls()
+    
+    # GUI Setup
+    def gui_setup(self):
+        self.root = Tk()
+        self.root.title("Client GUI")
+
+        # Server Connection Fields
+        Label(self.root, text="Server IP:").grid(row=0, column=0)
+        self.server_ip_entry = Entry(self.root)
+        self.server_ip_entry.grid(row=0, column=1)
+
+        Label(self.root, text="Server Port:").grid(row=1, column=0)
+        self.server_port_entry = Entry(self.root)
+        self.server_port_entry.grid(row=1, column=1)
+
+        Label(self.root, text="Your Name:").grid(row=2, column=0)
+        self.client_name_entry = Entry(self.root)
+        self.client_name_entry.grid(row=2, column=1)
+
+        # TLS, the CA file is only needed for a server with a self-signed certificate
+        self.use_tls = BooleanVar(self.root)
+        Checkbutton(self.root, text="TLS, CA File:", variable=self.use_tls).grid(row=3, column=0)
+        self.ca_file_entry = Entry(self.root)
+        self.ca_file_entry.grid(row=3, column=1)
+
+        # Create a frame to hold the buttons
+        button_frame = Frame(self.root)
+        button_frame.grid(row=4, column=0, columnspan=2)  # Place the frame in the grid
+
+        # Connect Button
+        self.connect_button = Button(button_frame, text="Connect", command=self.connect_to_server)
+        self.connect_button.grid(row=0, column=0, padx=(0, 2))  # No padding on the right
+
+        # Disconnect Button
+        self.disconnect_button = Button(button_frame, text="Disconnect", command=self.disconnect_from_server, state="disabled")
+        self.disconnect_button.grid(row=0, column=1, padx=(2, 0))  # No padding on the left
+
+        # Configure the button frame to center the buttons
+        button_frame.grid_columnconfigure(0, weight=1)  # Allow the first column to expand
+        button_frame.grid_columnconfigure(1, weight=1)  # Allow the second column to expand
+
+        # Upload Button
+        self.upload_button = Button(self.root, text="Upload File", command=self.upload_file, state="disabled")
+        self.upload_button.grid(row=5, column=0, columnspan=2)
+
+        # List Button
+        self.list_button = Button(self.root, text="List Files", command=self.list_files, state="disabled")
+        self.list_button.grid(row=6, column=0, columnspan=2)
+
+        # Download Button
+        self.download_button = Button(self.root, text="Download File", command=self.download_file, state="disabled")
+        self.download_button.grid(row=7, column=0, columnspan=2)
+
+        # Delete button
+        self.delete_button = Button(self.root, text="Delete File", command=self.delete_file, state="disabled")
+        self.delete_button.grid(row=8, column=0, columnspan=2)
+
+        # Transfers in progress
+        Label(self.root, text="Transfers:").grid(row=9, column=0, columnspan=2)
+        self.transfer_listbox = Listbox(self.root, width=50, height=5)
+        self.transfer_listbox.grid(row=10, column=0, columnspan=2)
+
+        # Cancel button
+        self.cancel_button = Button(self.root, text="Cancel Transfer", command=self.cancel_transfer)
+        self.cancel_button.grid(row=11, column=0, columnspan=2)
+
+        # Client Log
+        Label(self.root, text="Client Log:").grid(row=12, column=0, columnspan=2)
+        self.log_listbox = Listbox(self.root, width=50, height=20)
+        self.log_listbox.grid(row=13, column=0, columnspan=2)
+
+
+    def connect_to_server(self):
+        if self.is_connected:
+            self.log("Disconnecting from the current server...")
+            self.close_connections()  # Close existing connections
+
+        try:
+            # Get the necessary information of the server
+            server_ip = self.server_ip_entry.get()
+            server_port = int(self.server_port_entry.get())
+            client_name = self.client_name_entry.get()
+            tls_context = self.get_tls_context() if self.use_tls.get() else None
+
+            # Open the connection, commands, heartbeats and notifications all share it
+            self.connection = Connection(server_ip, server_port, client_name, tls_context=tls_context,
+                                         on_notice=lambda notice: self.run_on_gui(self.log, notice),
+                                         on_disconnect=lambda error: self.run_on_gui(self.connection_lost, error))
+        except Exception as e:
+            self.log(f"Connection failed: {str(e)}")
+            return
+
+        # The handshake waits for the server on a thread of its own, up to the connect timeout when it cannot be reached
+        self.log(f"Connecting to {server_ip}:{server_port}...")
+        self.connect_button.config(state="disabled")
+        threading.Thread(target=self.open_connection, args=(self.connection,), daemon=True).start()
+
+    def open_connection(self, connection):
+        try:
+            response = connection.connect()
+            connection.subscribe(["download", "upload", "overwrite", "delete"]) # Show what other clients do in the log
+        except Exception as e: # Errors from the server, such as a name that is in use, end up here as well
+            connection.close()
+            self.run_on_gui(self.connection_failed, connection, e)
+            return
+        self.run_on_gui(self.connection_opened, connection, response)
+
+    def connection_opened(self, connection, response):
+        if connection is not self.connection: # Closed while it was connecting
+            connection.close()
+            return
+        self.transfers = TransferQueue(connection, parallelism=4, events=self.transfer_events)
+
+        self.log(response)
+        self.is_connected = True  # Set connected state to True
+        self.upload_button.config(state="normal")       # Enable the upload button
+        self.list_button.config(state="normal")         # Enable the list button
+        self.download_button.config(state="normal")     # Enable the download button
+        self.delete_button.config(state="normal")       # Enable the delete button
+        self.disconnect_button.config(state="normal")   # Enable the disconnect button
+        self.log("Connected successfully.")
+
+    def connection_failed(self, connection, error):
+        if connection is not self.connection:
+            return
+        self.connection = None
+        self.connect_button.config(state="normal")
+        self.log(f"Connection failed: {str(error)}")
+
+    def get_tls_context(self):
+        cafile = self.ca_file_entry.get() or None
+        if cafile not in self.tls_contexts:
+            self.tls_contexts[cafile] = tls.client_context(cafile)
+        return self.tls_contexts[cafile]
+
+    def connection_lost(self, error):
+        # Called by the connection when the server stops responding
+        # self.log("Connection to server has been lost")
+        self.disconnect_from_server()
+
+
+    def download_file(self):
+        # The first page is requested on a thread of its own, the window opens once it has arrived
+        threading.Thread(target=self.request_first_page, args=(self.connection, self.show_download_list), daemon=True).start()
+
+    def request_first_page(self, connection, show, **filters):
+        # Request the first page of the file list, the rest is fetched as the user scrolls
+        try:
+            pages = connection.iter_pages(**filters)
+            file_list = self.format_file_list(next(pages))
+            self.run_on_gui(show, file_list, pages)
+        except Exception as e:
+            self.run_on_gui(self.log, f"Failed to request file list: {str(e)}")
+
+    def show_download_list(self, file_list, pages):
+        # Check if the file list is empty
+        if not file_list:
+            self.log("No files available for download.")
+            return
+
+        # Open a new window to display the list of files
+        self.open_file_selection_window(file_list, pages)
+
+    def open_file_selection_window(self, file_list, pages):
+        # Create a new window, its events are handled by the main loop
+        window = Toplevel(self.root)
+        window.title("Select Files to Download")
+
+        # Display the list of files
+        Label(window, text="Available Files:").pack()
+        file_listbox = self.file_listbox(window, pages)
+
+        # Populate the listbox
+        for file_entry in file_list:
+            file_listbox.insert(END, file_entry)
+
+        def confirm_download():
+            selected = [file_listbox.get(index).split(": ", 1) for index in file_listbox.curselection()] # Get the selected files
+            if not selected:
+                return
+            window.destroy()  # Close the selection window
+            if len(selected) == 1:
+                filename, owner = selected[0]
+                self.download_selected_file(owner.strip(), filename.strip()) # Download the selected file
+            else:
+                self.download_selected_files([filename.strip() for filename, _ in selected])
+
+        Button(window, text="Download", command=confirm_download).pack()
+
+    def download_selected_file(self, owner, filename):
+        try:
+            # Save the file with the original filename
+            save_path = filedialog.asksaveasfilename(defaultextension=".txt", initialfile=filename)
+            if not save_path:
+                return
+
+            # Queue the download, its progress is shown in the transfer list and the result is logged when it finishes
+            self.log(f"Requesting download for {owner}: {filename}")
+            self.transfers.download(owner, filename, save_path, resume=True)
+        except Exception as e:
+            self.log(f"Download failed: {str(e)}")
+
+
+    def download_selected_files(self, filenames):
+        try:
+            # The files are saved under their names in one folder
+            folder = filedialog.askdirectory()
+            if not folder:
+                return
+
+            # Queue all of them as one batch, they arrive as one stream
+            self.log(f"Requesting download of {len(filenames)} files")
+            self.transfers.download_batch(filenames, folder)
+        except Exception as e:
+            self.log(f"Download failed: {str(e)}")
+
+    def upload_file(self):
+        try:
+            filepaths = filedialog.askopenfilenames(filetypes=[("Text files", "*.txt")]) # Prompt the user to select the files to upload
+            if not filepaths:
+                return # Exit if no file is selected
+            if len(filepaths) > 1:
+                # Several files go as one batch, their contents as one stream
+                files = [(filepath, os.path.basename(filepath).replace(" ", "_")) for filepath in filepaths]
+                self.log(f"Uploading {len(files)} files...")
+                self.transfers.upload_batch(files)
+                return
+
+            filepath = filepaths[0]
+            filename = os.path.basename(filepath) # Extract the filename 
+            filename = filename.replace(" ", "_") # Replace spaces with underscores
+
+            # Queue the upload, its progress is shown in the transfer list and the server's response is logged when it finishes
+            self.log(f"Uploading {filename}...")
+            self.transfers.upload(filepath, filename, resume=True, skip_existing=True, delta=True) # Edited files only send what changed
+        except Exception as e:
+            self.log(f"Upload failed: {str(e)}") 
+
+    def transfer_finished(self, transfer):
+        if transfer.state == "done" and isinstance(transfer.result, list): # A batch, with the result of every file
+            failed = [result for result in transfer.result if result["status"] != "ok"]
+            done = "Uploaded" if transfer.kind == "upload" else "Downloaded"
+            self.log(f"{done} {len(transfer.result) - len(failed)} of {len(transfer.result)} files.")
+            for result in failed:
+                self.log(f"{result['filename']}: {result['message']}")
+        elif transfer.state == "done" and transfer.kind == "upload":
+            self.log(transfer.result)
+        elif transfer.state == "done":
+            self.log(f"File {transfer.name} downloaded successfully.")
+        elif transfer.state == "cancelled":
+            self.log(f"{transfer.kind.capitalize()} of {transfer.name} cancelled.")
+        else:
+            self.log(f"{transfer.kind.capitalize()} failed: {str(transfer.error)}")
+
+    def cancel_transfer(self):
+        selection = self.transfer_listbox.curselection()
+        if not selection:
+            self.log("Select a transfer to cancel.")
+            return
+        self.shown_transfers[selection[0]].cancel()
+
+
+    def list_files(self):
+        # The pages are requested on a thread of their own, the GUI stays responsive while a long list arrives
+        self.log("Requesting file list...")
+        threading.Thread(target=self.request_file_list, args=(self.connection,), daemon=True).start()
+
+    def request_file_list(self, connection):
+        try:
+            # Request the file list from the server one page at a time
+            files = [file for page in connection.iter_pages() for file in self.format_file_list(page)]
+            self.run_on_gui(self.show_file_list, files)
+        except Exception as e:
+            self.run_on_gui(self.log, f"Failed to list files: {str(e)}")
+
+    def show_file_list(self, files):
+        # Log the received file list with each file on a different line
+        self.log("Available files:")
+        for file in files:
+            self.log(file)
+        if not files:
+            self.log("No files available.")
+
+    def run_on_gui(self, func, *args):
+        # Tk widgets may only be touched from the GUI thread
+        self.gui_calls.put((func, args))
+
+    def poll_gui_calls(self):
+        while not self.gui_calls.empty():
+            func, args = self.gui_calls.get_nowait()
+            func(*args)
+        self.show_transfers()
+        self.root.after(50, self.poll_gui_calls)
+
+    def show_transfers(self):
+        # Update the rows of the transfers that reported since the last poll, finished ones are logged and removed
+        updated = {}
+        while not self.transfer_events.empty():
+            transfer = self.transfer_events.get_nowait()
+            updated[transfer.id] = transfer # Its fields are the latest, one update per poll is enough
+        for transfer in updated.values():
+            finished = transfer.state in ("done", "failed", "cancelled")
+            if transfer in self.shown_transfers:
+                row = self.shown_transfers.index(transfer)
+                self.transfer_listbox.delete(row)
+                if finished:
+                    del self.shown_transfers[row]
+                else:
+                    self.transfer_listbox.insert(row, self.format_transfer(transfer))
+            elif not finished:
+                self.shown_transfers.append(transfer)
+                self.transfer_listbox.insert(END, self.format_transfer(transfer))
+            if finished:
+                self.transfer_finished(transfer)
+
+    def format_transfer(self, transfer):
+        text = f"{transfer.kind.capitalize()} {transfer.name}: {transfer.state}"
+        if transfer.state == "running" and transfer.size:
+            text += f" {100 * transfer.done // transfer.size}% at {format_size(transfer.rate)}/s"
+            eta = transfer.eta()
+            if eta is not None:
+                text += f", {int(eta) // 60}:{int(eta) % 60:02d} left"
+        return text
+
+    def file_listbox(self, window, pages):
+        # Listbox that requests the next page of the file list when it is scrolled close to the last loaded entry
+        frame = Frame(window)
+        frame.pack()
+        file_listbox = Listbox(frame, width=50, height=20, selectmode="extended") # Shift and Ctrl select several files
+        scrollbar = Scrollbar(frame, command=file_listbox.yview)
+        loading = threading.Event() # Set while a page is requested, the pages come one at a time
+
+        def request_page():
+            try:
+                page = next(pages, None) # None once the last page has been loaded
+            except Exception as e:
+                self.run_on_gui(self.log, f"Failed to request file list: {str(e)}")
+                loading.clear() # Scrolling again retries
+                return
+            self.run_on_gui(show_page, page)
+
+        def show_page(page):
+            if file_listbox.winfo_exists(): # The window may have been closed in the meantime
+                for file_entry in self.format_file_list(page or []):
+                    file_listbox.insert(END, file_entry)
+            if page:
+                loading.clear()
+
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            if float(last) < 0.9 or loading.is_set():
+                return
+            loading.set() # Stays set after the last page, there is nothing more to request
+            threading.Thread(target=request_page, daemon=True).start()
+
+        file_listbox.config(yscrollcommand=on_scroll)
+        file_listbox.pack(side="left")
+        scrollbar.pack(side="right", fill="y")
+        return file_listbox
+
+    def format_file_list(self, files):
+        return [f"{entry['filename']}: {entry['owner']}" for entry in files]
+
+    def log(self, message):
+        # Only called on the GUI thread, Tk redraws once the current callback returns
+        self.log_listbox.insert(END, message)
+        self.log_listbox.see(END)
+
+    def delete_file(self):
+        # Only the client's own files can be deleted, the first page of them is requested on a thread of its own
+        threading.Thread(target=self.request_first_page, args=(self.connection, self.show_deletion_list),
+                         kwargs={"owner": self.connection.client_name}, daemon=True).start()
+
+    def show_deletion_list(self, file_list, pages):
+        # Check if the list is empty
+        if not file_list:
+            self.log("No files available for deletion.")
+            return
+
+        # Open a new window to display the list of files
+        self.open_file_deletion_window(file_list, pages)
+
+    def open_file_deletion_window(self, file_list, pages):
+        # Create a new window, its events are handled by the main loop
+        window = Toplevel(self.root)
+        window.title("Select Files to Delete")
+
+        # Display the list of files
+        Label(window, text="Uploaded Files:").pack()
+        file_listbox = self.file_listbox(window, pages)
+
+        # Populate the listbox
+        for file_entry in file_list:
+            file_listbox.insert(END, file_entry)
+
+        def confirm_delete():
+            selected = [file_listbox.get(index).split(": ", 1) for index in file_listbox.curselection()] # Get the selection
+            if selected:
+                window.destroy()  # Close the selection window
+                for filename, owner in selected:
+                    self.delete_selected_file(owner.strip(), filename.strip())
+
+        Button(window, text="Delete", command=confirm_delete).pack()
+
+    def delete_selected_file(self, owner, filename):
+        self.log(f"Requesting delete for {owner}: {filename}") # Write the request in the log
+        threading.Thread(target=self.request_delete, args=(self.connection, owner, filename), daemon=True).start()
+
+    def request_delete(self, connection, owner, filename):
+        try:
+            response = connection.delete(owner, filename) # Send the delete request, errors from the server are raised
+            self.run_on_gui(self.log, response)
+        except Exception as e:
+            self.run_on_gui(self.log, f"Deletion failed: {str(e)}")
+
+    def run(self):
+        # Start the GUI main loop
+        self.root.mainloop()
+
+    def close_connections(self):
+        # Close the connection and reset connection state
+        if self.transfers:
+            self.transfers.shutdown(wait=False)
+            self.transfers = None
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+        self.is_connected = False  # Reset connection state
+
+    def disconnect_from_server(self):
+        if self.is_connected:
+            self.log("Disconnecting from the server...")
+            self.close_connections()  # Close existing connections
+            self.disconnect_button.config(state="disabled")     # Disable the disconnect button
+            self.connect_button.config(state="normal")          # Enable the connect button
+            self.upload_button.config(state="disabled")         # Disable the upload button
+            self.list_button.config(state="disabled")           # Disable the list button
+            self.download_button.config(state="disabled")       # Disable the download button
+            self.delete_button.config(state="disabled")         # Disable the delete button
+            self.log("Disconnected successfully.")
+        else:
+            self.log("Not connected to any server.")
+
+
+def format_size(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1000:
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1000
+    return f"{count:.1f} TB"
+
+
+if __name__ == "__main__":
+    client = Client()
+    client.run()
@@ -0,0 +1,894 @@
+import concurrent.futures
+import functools
+import hashlib
+import io
+import socket
+import os
+import itertools
+import queue
+import threading
+import time
+import protocol
+import compression
+import delta
+import batch
+import tls
+from protocol import MAGIC, PREFACE_SIZE, HELLO, WELCOME, REQUEST, RESPONSE, DATA, END, ERROR, HEARTBEAT, NOTICE, ProtocolError, ServerError, ChecksumError, TransferCancelled
+
+CANCEL_POLL = 0.2           # Seconds between looks at the cancel flag while a download is waiting for data
+REPORT_INTERVAL = 0.25      # Seconds between the progress reports of a queued transfer
+RATE_SMOOTHING = 0.3        # Weight of the latest interval in the smoothed transfer rate
+CLOSE_TIMEOUT = 5           # Seconds close() waits for the receiver thread to stop
+RECONNECT_ATTEMPTS = 5      # Connection attempts after the server asked its clients to reconnect
+RECONNECT_DELAY = 0.2       # Seconds before the second attempt, doubled for every further one
+
+def hash_range(f, hasher, offset, count, buffer):
+    # Feed `count` bytes of a file from offset into hasher, through a reused buffer
+    view = memoryview(buffer)
+    f.seek(offset)
+    while count > 0:
+        read = f.readinto(view[:min(len(view), count)])
+        if not read:
+            raise ValueError("File changed while it was being read")
+        hasher.update(view[:read])
+        count -= read
+
+
+def checkpoint(progress, cancel, size):
+    # Called between the DATA frames of an upload with the bytes of the file done so far
+    #
+    # Reports them to progress(done, size) and stops the upload once cancel is set.
+    def check(done):
+        if cancel is not None and cancel.is_set():
+            raise TransferCancelled("Transfer cancelled")
+        if progress is not None:
+            progress(done, size)
+    return check
+
+
+# A request in flight, the receiver thread hands it the frames carrying its request id
+class Call:
+    def __init__(self, request_id, sink=None, hasher=None, progress=None):
+        self.request_id = request_id
+        self.replies = queue.Queue()    # RESPONSE, END and ERROR frames, or the exception that ended the connection
+        self.sink = sink                # File object the DATA payloads are written into
+        self.hasher = hasher            # Updated with the DATA payloads, to check them against the file's checksum
+        self.progress = progress        # Called with the DATA bytes received so far, on the receiver thread
+        self.received = 0               # DATA bytes received so far
+        self.error = None               # Error while writing to the sink, the payload is still drained
+        self.decompressor = None        # Set by the first compressed DATA frame
+        self.open_sink = None           # Called with the first reply on the receiver thread, returns the sink when it depends on the reply
+
+    def write(self, data):
+        self.received += len(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.error is None:
+            try:
+                self.sink.write(data)
+            except (OSError, ValueError) as e:
+                self.error = e
+        if self.progress is not None:
+            self.progress(self.received)
+
+    def write_compressed(self, data, codec_id):
+        # Payload of a DATA frame compressed with the codec named by its flags
+        if self.error is not None:
+            return
+        try:
+            if self.decompressor is None:
+                self.decompressor = compression.decompressor(codec_id, protocol.BUFFER_SIZE)
+            self.decompressor.feed(data, self.write)
+        except ProtocolError as e:
+            self.error = e
+
+    def end_data(self):
+        # Called with the END frame, before the reply is handed on
+        if self.decompressor is not None and self.error is None:
+            try:
+                self.decompressor.finish(self.write)
+            except ProtocolError as e:
+                self.error = e
+
+    def wait(self, timeout=None):
+        # Next reply frame, ERROR replies are raised as ServerError
+        try:
+            frame = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No reply to request {self.request_id}")
+        if isinstance(frame, Exception):
+            raise frame
+        if frame.type == ERROR:
+            raise ServerError(frame.message().get("error"))
+        return frame
+
+
+# Connection to the file server over the framed protocol, usable without the GUI
+#
+# Commands, heartbeats and notifications share one socket. A receiver thread reads every
+# frame and routes it: heartbeats and notices go to the callbacks, everything else to the
+# Call waiting for its request id.
+#
+# When the server restarts it asks its clients to reconnect. The requests in flight finish on
+# the old connection and new ones wait until the connection has moved to the new server process.
+class Connection:
+    def __init__(self, host, port, client_name, timeout=None, buffer_size=protocol.BUFFER_SIZE,
+                 on_notice=None, on_heartbeat=None, on_disconnect=None, codecs=tuple(compression.CODECS), tls_context=None):
+        self.host = host
+        self.port = port
+        self.client_name = client_name
+        self.timeout = timeout                      # Seconds to wait for the server, None waits forever
+        self.sock = None
+        self.version = None                         # Protocol version agreed with the server
+        self.offered_codecs = codecs                # Compression codecs offered to the server, empty for none
+        self.codecs = []                            # The ones the server supports as well
+        self.buffer_size = min(buffer_size, protocol.MAX_DATA_SIZE) # Transfer buffer and DATA frame size
+        self.receive_buffer = memoryview(bytearray(self.buffer_size)) # Reused by every download
+        self.request_ids = itertools.count(1)
+        self.calls = {}                             # Requests in flight by request id
+        self.send_lock = threading.Lock()           # Keeps frames from different threads whole
+        self.on_notice = on_notice                  # Called with the text of every notification
+        self.on_heartbeat = on_heartbeat            # Called for every heartbeat
+        self.on_disconnect = on_disconnect          # Called with the error when the connection is lost
+        self.last_heartbeat = None                  # Monotonic time of the last heartbeat
+        self.tls_context = tls_context              # ssl.SSLContext from tls.client_context(), None for a plaintext connection
+        self.tls_resumed = False                    # Whether the TLS handshake resumed an earlier session
+        self.receiver = None                        # Thread running receive_loop
+        self.events = None                          # Events subscribed to, subscribed to again after a reconnect
+        self.restarting = False                     # The server asked to reconnect, new requests wait until it is done
+        self.moved = threading.Condition()          # Notified when a request finishes and when the connection has moved
+        self.closed = False
+
+    def connect(self):
+        # Open the connection, negotiate the protocol version and start the receiver thread
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.tls_context is not None:
+                # Offers the last session with this server, resuming it skips the certificate and its signature
+                session = tls.SESSIONS.get(self.tls_context, self.host, self.port)
+                self.sock = self.tls_context.wrap_socket(self.sock, server_hostname=self.host, session=session)
+                self.tls_resumed = self.sock.session_reused
+            self.sock.sendall(protocol.preface())
+
+            reply = protocol.recv_exactly(self.sock, PREFACE_SIZE)
+            if not reply.startswith(MAGIC):
+                raise ProtocolError("Server does not speak the framed protocol")
+            self.version = reply[-1]
+            if not self.version:
+                raise ProtocolError("Server does not support this protocol version")
+
+            self.send_message(HELLO, 0, {"name": self.client_name, "compression": list(self.offered_codecs)})
+            frame = protocol.recv_frame(self.sock)
+            if frame.type == ERROR:
+                raise ServerError(frame.message().get("error"))
+            if frame.type != WELCOME:
+                raise ProtocolError(f"Unexpected frame type {frame.type} during handshake")
+        except Exception:
+            self.close()
+            raise
+
+        if self.tls_context is not None:
+            tls.SESSIONS.put(self.tls_context, self.host, self.port, self.sock.session) # Has its ticket by now, it came before WELCOME
+        self.codecs = compression.agree(frame.message().get("compression"), self.offered_codecs)
+        self.sock.settimeout(None) # The receiver thread waits for frames indefinitely
+        self.last_heartbeat = time.monotonic()
+        self.receiver = threading.Thread(target=self.receive_loop, daemon=True)
+        self.receiver.start()
+        return frame.message().get("message", "")
+
+    def close(self):
+        self.closed = True
+        if self.sock:
+            try:
+                socket.socket.shutdown(self.sock, socket.SHUT_RDWR) # Wakes up the receiver thread, without touching the TLS layer it reads from
+            except OSError:
+                pass
+            # A TLS connection torn down in the middle of a read spoils the resumption of its session
+            if self.receiver is not None and self.receiver is not threading.current_thread():
+                self.receiver.join(CLOSE_TIMEOUT)
+            self.sock.close()
+            self.sock = None
+
+    def receive_loop(self):
+        sock = self.sock
+        try:
+            while True:
+                frame = protocol.recv_header(sock)
+                if frame.type == DATA:
+                    call = self.calls.get(frame.request_id)
+                    if call is None or call.sink is None:
+                        raise ProtocolError(f"Unexpected data for request {frame.request_id}")
+                    codec_id = frame.flags & protocol.CODEC_FLAGS
+                    write = (lambda data: call.write_compressed(data, codec_id)) if codec_id else call.write
+                    protocol.recv_payload_into(sock, frame.length, self.receive_buffer, write)
+                    continue
+                frame.payload = protocol.recv_exactly(sock, frame.length) if frame.length else b""
+                if frame.type == HEARTBEAT:
+                    self.last_heartbeat = time.monotonic()
+                    self.send(protocol.encode_frame(HEARTBEAT, 0, frame.payload, version=self.version)) # The server measures the round trip
+                    if self.on_heartbeat:
+                        self.on_heartbeat()
+                elif frame.type == NOTICE:
+                    notice = frame.message()
+                    if notice.get("reconnect") and not self.restarting:
+                        self.restarting = True
+                        threading.Thread(target=self.move, daemon=True).start()
+                    if self.on_notice:
+                        self.on_notice(notice.get("message", ""))
+                elif frame.request_id in self.calls:
+                    call = self.calls[frame.request_id]
+                    if frame.type == END:
+                        call.end_data()
+                    elif frame.type == RESPONSE and call.open_sink is not None:
+                        call.sink = call.open_sink(frame.message()) # Before the DATA frames that follow it
+                        call.open_sink = None
+                    call.replies.put(frame)
+                else:
+                    raise ProtocolError(f"Reply for unknown request {frame.request_id}")
+        except Exception as e:
+            error = e if isinstance(e, ConnectionError) else ConnectionError(f"Connection lost: {str(e)}")
+            for call in list(self.calls.values()):
+                call.replies.put(error)
+            if not self.closed and not self.restarting: # A restarting server closes the connection, the move reconnects
+                self.closed = True
+                if self.on_disconnect:
+                    self.on_disconnect(error)
+
+    def move(self):
+        # Runs on a thread of its own once the server asked to reconnect
+        error = None
+        with self.moved:
+            while self.calls:
+                self.moved.wait()
+            try:
+                self.reconnect()
+            except Exception as e:
+                error = e
+            finally:
+                self.restarting = False
+                self.moved.notify_all()
+        if error is not None:
+            if self.on_disconnect:
+                self.on_disconnect(error if isinstance(error, ConnectionError) else ConnectionError(f"Reconnect failed: {str(error)}"))
+        elif self.events is not None:
+            self.subscribe(self.events)
+
+    def reconnect(self):
+        # Open a new connection to the same address, the server process taking over the port answers it
+        self.close()
+        for attempt in range(RECONNECT_ATTEMPTS):
+            self.closed = False
+            try:
+                return self.connect()
+            except (OSError, ProtocolError):
+                if attempt == RECONNECT_ATTEMPTS - 1:
+                    raise
+            time.sleep(RECONNECT_DELAY * 2 ** attempt)
+
+    def send(self, data):
+        if self.sock is None:
+            raise ConnectionError("Not connected")
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def send_message(self, frame_type, request_id, message):
+        self.send(protocol.encode_message(frame_type, request_id, message, self.version))
+
+    def start(self, message, sink=None, hasher=None, progress=None):
+        # Send a request and return the Call that collects its replies
+        call = Call(next(self.request_ids), sink, hasher, progress)
+        with self.moved: # The move waits for the calls it finds, a call starting later goes to the new connection
+            while self.restarting:
+                self.moved.wait()
+            self.calls[call.request_id] = call
+        try:
+            self.send_message(REQUEST, call.request_id, message)
+        except Exception:
+            self.finish(call)
+            raise
+        return call
+
+    def finish(self, call):
+        self.calls.pop(call.request_id, None)
+        if self.restarting:
+            with self.moved:
+                self.moved.notify_all()
+
+    def cancel(self, call):
+        # Stop a request and wait until the server has, the frames already on their way still arrive
+        #
+        # Returns the END frame of a request that finished before the server got to stop it, None otherwise.
+        self.send_message(REQUEST, call.request_id, {"cmd": "CANCEL"})
+        while True:
+            try:
+                frame = call.wait(self.timeout)
+            except ServerError:
+                return None
+            if frame.type == END:
+                return frame
+
+    def call(self, message):
+        # Send a request and wait for its single reply
+        call = self.start(message)
+        try:
+            return call.wait(self.timeout).message()
+        finally:
+            self.finish(call)
+
+    def list_page(self, owner=None, pattern=None, prefix=None, sort="key", descending=False, page_size=protocol.LIST_PAGE_SIZE, cursor=None):
+        # One page of the file list, returns the entries and the cursor of the next page (None on the last page)
+        #
+        # owner only lists the files of one client, prefix and pattern (a glob such as '*.txt') filter
+        # on the file name. Sorting is by key, name, owner, size or mtime.
+        request = {"cmd": "LIST", "sort": sort, "descending": descending, "page_size": page_size}
+        for name, value in (("owner", owner), ("pattern", pattern), ("prefix", prefix), ("cursor", cursor)):
+            if value is not None:
+                request[name] = value
+        call = self.start(request)
+        try:
+            files = []
+            while True: # The entries arrive in several RESPONSE frames
+                frame = call.wait(self.timeout)
+                if frame.type == END:
+                    return files, frame.message().get("cursor")
+                files.extend(frame.message()["files"])
+        finally:
+            self.finish(call)
+
+    def iter_pages(self, **filters):
+        # Pages of the file list, each one is only requested when the previous one has been consumed
+        cursor = None
+        while True:
+            files, cursor = self.list_page(cursor=cursor, **filters)
+            yield files
+            if cursor is None:
+                return
+
+    def list_files(self, **filters):
+        # The whole file list, takes the same filters as list_page
+        return [entry for page in self.iter_pages(**filters) for entry in page]
+
+    def upload(self, filepath, filename=None, resume=False, skip_existing=False, compress=True, delta=False, progress=None, cancel=None):
+        # Upload a file, returns the server's message. With resume only the bytes the server is missing are sent
+        #
+        # With skip_existing the file is hashed first, a server that already stores the same
+        # contents takes the file without receiving it. Otherwise it is hashed while it is sent.
+        # Either way the END frame carries the sha256 and the server only keeps a file that
+        # matches it. With compress the data is compressed when a sample of it shrinks enough
+        # with one of the codecs the server supports. With delta and an older version of the
+        # file on the server, only the blocks that changed are sent.
+        #
+        # progress is called with the bytes of the file done and its size as the data goes out.
+        # Setting the threading.Event cancel stops the upload with TransferCancelled, the server
+        # keeps what it received so far for a resumed upload.
+        filename = filename or os.path.basename(filepath)
+        with open(filepath, "rb") as f:
+            stat = os.fstat(f.fileno())
+            file_size = stat.st_size
+            etag = f"{file_size}-{stat.st_mtime_ns}" # A changed file never resumes an old partial upload
+            request = {"cmd": "UPLOAD", "filename": filename, "size": file_size, "etag": etag, "resume": resume}
+            if skip_existing:
+                request["sha256"] = hashlib.file_digest(f, "sha256").hexdigest()
+            check = checkpoint(progress, cancel, file_size)
+            if delta and file_size:
+                message = self.upload_delta(f, filename, file_size, etag, request.get("sha256"), check)
+                if message is not None:
+                    return message
+            call = self.start(request)
+            try:
+                reply = call.wait(self.timeout).message()
+                if reply.get("status") == "ok": # The server had the contents already
+                    return reply["message"]
+                offset = reply.get("offset", 0) # Server is ready to receive the data
+                hasher = None if skip_existing else hashlib.sha256()
+                if hasher and offset:
+                    hash_range(f, hasher, 0, offset, bytearray(min(self.buffer_size, offset))) # The part the server has
+                codec = None
+                if compress and self.codecs and file_size - offset >= compression.MIN_SIZE:
+                    f.seek(offset)
+                    codec = compression.choose(f.read(compression.SAMPLE_SIZE), self.codecs)
+                try:
+                    if codec:
+                        self.send_compressed_data(call.request_id, f, offset, file_size - offset, codec, hasher, check)
+                    else:
+                        self.send_file_data(call.request_id, f, offset, file_size - offset, hasher, check)
+                except TransferCancelled:
+                    self.cancel(call)
+                    raise
+                checksum = hasher.hexdigest() if hasher else request["sha256"]
+                self.send_message(END, call.request_id, {"sha256": checksum})
+                return call.wait(self.timeout).message()["message"]
+            finally:
+                self.finish(call)
+
+    def upload_batch(self, files, compress=True, progress=None, cancel=None):
+        # Upload many (filepath, filename) files, returns a result for every file
+        #
+        # Up to MAX_BATCH_FILES files go in one BATCH_UPLOAD request, their contents back to
+        # back as one stream, compressed as a whole when a sample of it shrinks enough. Each
+        # result is a dict with the filename, a status of "ok" or "error" and the error message.
+        # progress and cancel work like they do for upload, a cancelled batch leaves nothing
+        # behind on the server. Files are not resumed, skipped or sent as deltas in a batch.
+        files = [(filepath, filename or os.path.basename(filepath)) for filepath, filename in files]
+        sizes = [os.path.getsize(filepath) for filepath, _ in files]
+        check = checkpoint(progress, cancel, sum(sizes))
+        results, done = [], 0
+        for start in range(0, len(files), batch.MAX_BATCH_FILES):
+            end = start + batch.MAX_BATCH_FILES
+            results.extend(self.send_batch(files[start:end], sizes[start:end], compress, lambda position, done=done: check(done + position)))
+            done += sum(sizes[start:end])
+        return results
+
+    def send_batch(self, files, sizes, compress, check):
+        request = {"cmd": "BATCH_UPLOAD", "files": [{"filename": filename, "size": size} for (_, filename), size in zip(files, sizes)]}
+        sources = [(functools.partial(open, filepath, "rb"), size) for (filepath, _), size in zip(files, sizes)]
+        length = sum(sizes)
+        call = self.start(request)
+        try:
+            call.wait(self.timeout) # Server is ready to receive the data
+            reader = batch.ConcatenatedReader(sources, hash_files=True)
+            try:
+                codec = None
+                if compress and self.codecs and length >= compression.MIN_SIZE:
+                    sample = batch.ConcatenatedReader(sources)
+                    try:
+                        codec = compression.choose(sample.read(compression.SAMPLE_SIZE), self.codecs)
+                    finally:
+                        sample.close()
+                if codec:
+                    flags = compression.CODECS[codec].id
+                    for chunk in compression.compressed_chunks(reader, length, codec, self.buffer_size):
+                        check(reader.position)
+                        if chunk:
+                            self.send(protocol.encode_frame(DATA, call.request_id, chunk, flags, self.version))
+                else:
+                    while reader.position < length:
+                        check(reader.position)
+                        chunk = reader.read(min(self.buffer_size, length - reader.position))
+                        self.send(protocol.encode_frame(DATA, call.request_id, chunk, version=self.version))
+                checksums = reader.finish()
+            except Exception as e:
+                if not isinstance(e, ConnectionError):
+                    self.cancel(call) # The server stops waiting for the rest of the stream
+                raise
+            finally:
+                reader.close()
+            self.send_message(END, call.request_id, {"sha256": checksums})
+            return call.wait(self.timeout).message()["files"]
+        finally:
+            self.finish(call)
+
+    def upload_delta(self, f, filename, file_size, etag, checksum=None, check=None):
+        # Send what changed since the version the server has, returns None when there is no version to build on
+        try:
+            signature = self.signatures(filename)
+        except ServerError:
+            return None
+        if not signature.blocks:
+            return None
+        request = {"cmd": "UPLOAD", "filename": filename, "size": file_size, "etag": etag, "delta": signature.etag}
+        if checksum:
+            request["sha256"] = checksum
+        call = self.start(request)
+        try:
+            try:
+                reply = call.wait(self.timeout).message()
+            except ServerError:
+                return None # Changed since the signatures were made, a whole upload follows
+            if reply.get("status") == "ok":
+                return reply["message"]
+            hasher = hashlib.sha256()
+            f.seek(0)
+            try:
+                for op in delta.delta(f, signature, hasher):
+                    if check:
+                        check(f.tell()) # The delta reads ahead, the position is close enough for progress
+                    if op[0] == "copy":
+                        self.send(protocol.encode_frame(DATA, call.request_id, protocol.COPY_RANGE.pack(op[1], op[2]), protocol.DELTA_COPY, self.version))
+                        continue
+                    for start in range(0, len(op[1]), self.buffer_size):
+                        self.send(protocol.encode_frame(DATA, call.request_id, op[1][start:start + self.buffer_size], version=self.version))
+            except TransferCancelled:
+                self.cancel(call)
+                raise
+            self.send_message(END, call.request_id, {"sha256": checksum or hasher.hexdigest()})
+            return call.wait(self.timeout).message()["message"]
+        finally:
+            self.finish(call)
+
+    def signatures(self, filename):
+        # Block signatures of the server's version of one of this client's files, raises ServerError when there is none
+        call = self.start({"cmd": "SIGNATURES", "filename": filename})
+        try:
+            blocks = []
+            while True: # The signatures arrive in several RESPONSE frames
+                frame = call.wait(self.timeout)
+                if frame.type == END:
+                    reply = frame.message()
+                    return delta.Signature(reply["size"], reply["etag"], reply["block_size"], blocks)
+                blocks.extend(frame.message()["blocks"])
+        finally:
+            self.finish(call)
+
+    def send_file_data(self, request_id, f, offset, count, hasher=None, check=None):
+        # Each DATA frame body goes out with sendfile, which copies from the page cache without a user space buffer
+        #
+        # With a hasher every chunk is read and hashed right before it is sent, while it is still in the CPU cache.
+        # check is a checkpoint, called with the offset before every frame.
+        if self.tls_context is not None:
+            self.send_read_data(request_id, f, offset, count, hasher, check)
+            return
+        buffer = bytearray(min(self.buffer_size, count)) if hasher else None
+        end = offset + count
+        while offset < end:
+            if check:
+                check(offset)
+            length = min(self.buffer_size, end - offset)
+            if hasher:
+                hash_range(f, hasher, offset, length, buffer)
+            with self.send_lock:
+                self.sock.sendall(protocol.encode_header(DATA, request_id, length, version=self.version))
+                sent = self.sock.sendfile(f, offset, length)
+            if sent != length:
+                raise ConnectionError("File changed while it was being uploaded")
+            offset += length
+
+    def send_read_data(self, request_id, f, offset, count, hasher=None, check=None):
+        # Over TLS the data has to pass through user space to be encrypted, so it is read a frame at a time
+        f.seek(offset)
+        end = offset + count
+        while offset < end:
+            if check:
+                check(offset)
+            chunk = f.read(min(self.buffer_size, end - offset))
+            if not chunk:
+                raise ConnectionError("File changed while it was being uploaded")
+            if hasher:
+                hasher.update(chunk)
+            self.send(protocol.encode_frame(DATA, request_id, chunk, version=self.version))
+            offset += len(chunk)
+
+    def send_compressed_data(self, request_id, f, offset, count, codec, hasher=None, check=None):
+        # The bytes change on the way, so they are read and compressed here instead of going out with sendfile
+        f.seek(offset)
+        flags = compression.CODECS[codec].id
+        for chunk in compression.compressed_chunks(f, count, codec, self.buffer_size, hasher):
+            if check:
+                check(f.tell())
+            if chunk:
+                self.send(protocol.encode_frame(DATA, request_id, chunk, flags, self.version))
+
+    def upload_status(self, filename):
+        # How much of an unfinished upload the server has, as a dict with size, etag and offset
+        return self.call({"cmd": "UPLOAD_STATUS", "filename": filename})
+
+    def download(self, owner, filename, save_path, resume=False, progress=None, cancel=None):
+        # Download a file into save_path, returns the size of the file
+        #
+        # The data goes into save_path.part first. With resume a partial file left by an earlier
+        # attempt is continued, as long as the file on the server has not changed since. The
+        # data is checked against the file's sha256 as it arrives, a download that does not
+        # match raises ChecksumError and leaves no partial file behind. progress and cancel
+        # work like they do for upload, a cancelled download keeps its partial file.
+        partial_path = f"{save_path}.part"
+        etag_path = f"{partial_path}.etag"
+        offset, etag = 0, None
+        hasher = hashlib.sha256()
+        if resume and os.path.exists(partial_path) and os.path.exists(etag_path):
+            with open(etag_path) as f:
+                etag = f.read()
+            with open(partial_path, "rb") as f:
+                hasher = hashlib.file_digest(f, "sha256") # The part that is not downloaded again
+                offset = f.tell()
+
+        try:
+            try:
+                reply = self.download_range(owner, filename, partial_path, offset, etag=etag, etag_path=etag_path, hasher=hasher,
+                                            progress=progress, cancel=cancel)
+            except ServerError:
+                if etag is None:
+                    raise
+                reply = self.download_range(owner, filename, partial_path, 0, etag_path=etag_path, hasher=hashlib.sha256(),
+                                            progress=progress, cancel=cancel) # File changed, start over
+        except ChecksumError:
+            for path in (partial_path, etag_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        os.replace(partial_path, save_path)
+        os.remove(etag_path)
+        return reply["size"]
+
+    def download_range(self, owner, filename, save_path, offset=0, length=None, etag=None, etag_path=None, hasher=None, progress=None, cancel=None):
+        # Write the byte range starting at offset into save_path, which is appended to when offset is not 0
+        with open(save_path, "ab" if offset else "wb") as f:
+            f.truncate(offset)
+            reply = self.fetch(owner, filename, f, offset, length, etag, etag_path, hasher=hasher, progress=progress, cancel=cancel)
+        return reply
+
+    def read_range(self, owner, filename, offset, length):
+        # Return the bytes of a range of a file
+        buffer = io.BytesIO()
+        self.fetch(owner, filename, buffer, offset, length)
+        return buffer.getvalue()
+
+    def fetch(self, owner, filename, sink, offset=0, length=None, etag=None, etag_path=None, compress=True, hasher=None, progress=None, cancel=None):
+        # Write a file or a range of it into sink, the server compresses the data when it pays off unless compress is False
+        #
+        # A whole file is checked against the sha256 the server sends with it. A range that ends
+        # at the end of the file is checked when hasher already holds the bytes before offset.
+        # progress(done, size) is called on the receiver thread, done counts from the start of
+        # the file and size is None until the reply has arrived.
+        if hasher is None and offset == 0 and length is None:
+            hasher = hashlib.sha256()
+        request = {"cmd": "DOWNLOAD", "owner": owner, "filename": filename, "offset": offset}
+        if not compress:
+            request["compress"] = False
+        if length is not None:
+            request["length"] = length
+        if etag is not None:
+            request["etag"] = etag
+        report = (lambda received: progress(offset + received, None)) if progress else None
+        call = self.start(request, sink=sink, hasher=hasher, progress=report)
+        try:
+            reply = call.wait(self.timeout).message()
+            if progress:
+                progress(offset + call.received, reply["size"])
+            if etag_path:
+                with open(etag_path, "w") as f:
+                    f.write(reply["etag"])
+            frame = self.wait_end(call, cancel) # Large files take as long as they take
+            if frame.type != END:
+                raise ProtocolError(f"Unexpected frame type {frame.type} during download")
+        finally:
+            self.finish(call)
+        if call.error is not None:
+            raise call.error
+        if call.received != reply["length"]:
+            raise ProtocolError(f"Received {call.received} bytes, expected {reply['length']}")
+        if hasher is not None and reply.get("sha256") and offset + call.received == reply["size"]:
+            if hasher.hexdigest() != reply["sha256"]:
+                raise ChecksumError(f"{filename} does not match its checksum")
+        return reply
+
+    def download_batch(self, filenames, folder, compress=True, progress=None, cancel=None):
+        # Download many files into folder under their names, returns a result for every file
+        #
+        # Up to MAX_BATCH_FILES files come in one BATCH_DOWNLOAD request, their contents back to
+        # back as one stream. Every file is checked against its sha256 and renamed into place
+        # when it matches, results are like those of upload_batch. progress is told the total
+        # size once the manifest of the last request has arrived, cancel leaves no files behind.
+        filenames = list(filenames)
+        results, done = [], 0
+        for start in range(0, len(filenames), batch.MAX_BATCH_FILES):
+            if cancel is not None and cancel.is_set():
+                raise TransferCancelled("Transfer cancelled")
+            last = start + batch.MAX_BATCH_FILES >= len(filenames)
+            part, received = self.fetch_batch(filenames[start:start + batch.MAX_BATCH_FILES], folder, compress, progress, cancel, done, last)
+            results.extend(part)
+            done += received
+        return results
+
+    def fetch_batch(self, filenames, folder, compress, progress, cancel, done, last):
+        request = {"cmd": "BATCH_DOWNLOAD", "files": filenames}
+        if not compress:
+            request["compress"] = False
+        paths = []                                  # Partial file of every file in the stream
+        def open_sink(reply):
+            entries = [entry for entry in reply["files"] if entry.get("status") == "ok"]
+            paths.extend(os.path.join(folder, f"{os.path.basename(entry['filename'])}.part") for entry in entries)
+            return batch.StreamSplitter([entry["size"] for entry in entries], lambda index: open(paths[index], "wb"))
+        total = [None]                              # Known once the manifest of the last request has arrived
+        report = (lambda received: progress(done + received, total[0])) if progress else None
+        call = self.start(request, progress=report)
+        call.open_sink = open_sink
+        try:
+            try:
+                reply = call.wait(self.timeout).message()
+                if last:
+                    total[0] = done + reply["length"]
+                if progress:
+                    progress(done + call.received, total[0])
+                frame = self.wait_end(call, cancel)
+                if frame.type != END:
+                    raise ProtocolError(f"Unexpected frame type {frame.type} during download")
+                if call.error is not None:
+                    raise call.error
+                if not call.sink.finish() or call.received != reply["length"]:
+                    raise ProtocolError(f"Received {call.received} bytes, expected {reply['length']}")
+            finally:
+                self.finish(call)
+                if call.sink is not None:
+                    call.sink.close()
+        except BaseException:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+        results, index = [], 0
+        for entry in reply["files"]:
+            if entry.get("status") != "ok":
+                results.append({"filename": entry["filename"], "status": "error", "message": entry.get("message")})
+                continue
+            path = paths[index]
+            if entry.get("sha256") and entry["sha256"] != call.sink.checksums[index]:
+                os.remove(path)
+                results.append({"filename": entry["filename"], "status": "error", "message": "Checksum mismatch."})
+            else:
+                os.replace(path, path[:-len(".part")])
+                results.append({"filename": entry["filename"], "status": "ok", "size": entry["size"]})
+            index += 1
+        return results, call.received
+
+    def wait_end(self, call, cancel=None):
+        # Wait for the frame that ends a download, cancelling it once cancel is set
+        if cancel is None:
+            return call.wait()
+        while True:
+            try:
+                return call.wait(CANCEL_POLL)
+            except TimeoutError:
+                if cancel.is_set():
+                    frame = self.cancel(call)
+                    if frame is None:
+                        raise TransferCancelled("Transfer cancelled")
+                    return frame # All the data had arrived already
+
+    def delete(self, owner, filename):
+        return self.call({"cmd": "DELETE", "owner": owner, "filename": filename})["message"]
+
+    def subscribe(self, events):
+        # Choose what the server sends notices about: "download" (of the client's own files), "upload", "overwrite" and "delete"
+        self.events = list(events)
+        return self.call({"cmd": "SUBSCRIBE", "events": self.events})["events"]
+
+    def stats(self):
+        # The server's metrics and the round trip time of this connection's heartbeats
+        return self.call({"cmd": "STATS"})
+
+    def exit(self):
+        self.start({"cmd": "EXIT"})
+
+
+# One upload or download of a TransferQueue, watched and cancelled from other threads
+#
+# The worker thread running it updates the fields, and every REPORT_INTERVAL and whenever the
+# state changes the transfer itself is put on the queue's events queue. A GUI polls that queue
+# on a timer and reads the fields, which are always the latest ones.
+class Transfer:
+    def __init__(self, transfer_id, kind, name, events=None):
+        self.id = transfer_id
+        self.kind = kind                            # "upload" or "download"
+        self.name = name
+        self.events = events                        # Queue the transfer is put on when it reports, None for none
+        self.state = "queued"                       # queued, running, done, failed or cancelled
+        self.size = None                            # Bytes of the file, once known
+        self.done = 0                               # Bytes of the file done so far, a resumed part included
+        self.rate = 0.0                             # Smoothed bytes per second
+        self.result = None                          # What the transfer returned, once it is done
+        self.error = None                           # Why it failed or was cancelled
+        self.future = None                          # Future of the worker running it
+        self.cancelled = threading.Event()          # Set to stop the transfer
+        self.last_report = None                     # Monotonic time and bytes done of the last report
+        self.last_done = 0
+
+    def update(self, done, size=None):
+        # Progress callback of the connection, reports at most every REPORT_INTERVAL
+        self.done = done
+        if size is not None:
+            self.size = size
+        now = time.monotonic()
+        if self.last_report is None: # The first callback only sets the base, a resumed part is not counted as transferred
+            self.last_report, self.last_done = now, done
+            return
+        elapsed = now - self.last_report
+        if elapsed < REPORT_INTERVAL:
+            return
+        rate = (done - self.last_done) / elapsed
+        self.rate = rate if not self.rate else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+        self.last_report, self.last_done = now, done
+        self.report()
+
+    def eta(self):
+        # Seconds until the transfer is done at the current rate, None while that is unknown
+        if self.state != "running" or self.size is None or not self.rate:
+            return None
+        return max(self.size - self.done, 0) / self.rate
+
+    def report(self):
+        if self.events is not None:
+            self.events.put(self)
+
+    def cancel(self):
+        # A queued transfer never starts, a running one stops before its next DATA frame
+        self.cancelled.set()
+        if self.future is not None and self.future.cancel():
+            self.finish("cancelled", error=TransferCancelled("Transfer cancelled"))
+
+    def finish(self, state, result=None, error=None):
+        self.state = state
+        self.result = result
+        self.error = error
+        if state == "done" and self.size is not None:
+            self.done = self.size
+        self.report()
+
+
+# Runs uploads and downloads on a pool of threads, they share the connection and their DATA frames interleave
+#
+# Every transfer is returned as a Transfer. Pass a queue.Queue as events to receive their
+# progress, a script can also just wait for them.
+class TransferQueue:
+    def __init__(self, connection, parallelism=4, events=None):
+        self.connection = connection
+        self.parallelism = parallelism              # Transfers in flight at the same time
+        self.events = events                        # Queue every Transfer reports to
+        self.transfer_ids = itertools.count(1)
+        self.transfers = {}                         # Transfers that have not finished yet, by id
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="transfer")
+
+    def upload(self, filepath, filename=None, resume=False, skip_existing=False, delta=False):
+        # Queue an upload, its result is the server's message
+        transfer = Transfer(next(self.transfer_ids), "upload", filename or os.path.basename(filepath), self.events)
+        return self.submit(transfer, self.connection.upload, filepath, filename, resume, skip_existing, delta=delta)
+
+    def download(self, owner, filename, save_path, resume=False):
+        # Queue a download, its result is the size of the file
+        transfer = Transfer(next(self.transfer_ids), "download", filename, self.events)
+        return self.submit(transfer, self.connection.download, owner, filename, save_path, resume)
+
+    def upload_batch(self, files):
+        # Queue (filepath, filename) files as one transfer, its result is the result of every file
+        transfer = Transfer(next(self.transfer_ids), "upload", f"{len(files)} files", self.events)
+        return self.submit(transfer, self.connection.upload_batch, files)
+
+    def download_batch(self, filenames, folder):
+        # Queue a download of many files into folder as one transfer, its result is the result of every file
+        transfer = Transfer(next(self.transfer_ids), "download", f"{len(filenames)} files", self.events)
+        return self.submit(transfer, self.connection.download_batch, filenames, folder)
+
+    def submit(self, transfer, method, *args, **kwargs):
+        self.transfers[transfer.id] = transfer
+        transfer.report()
+        transfer.future = self.executor.submit(self.run, transfer, method, args, kwargs)
+        transfer.future.add_done_callback(lambda future: self.transfers.pop(transfer.id, None))
+        return transfer
+
+    def run(self, transfer, method, args, kwargs):
+        transfer.state = "running"
+        transfer.report()
+        try:
+            result = method(*args, progress=transfer.update, cancel=transfer.cancelled, **kwargs)
+        except TransferCancelled as e:
+            transfer.finish("cancelled", error=e)
+            raise
+        except Exception as e:
+            transfer.finish("failed", error=e)
+            raise
+        transfer.finish("done", result)
+        return result
+
+    def upload_folder(self, folder):
+        # Queue every file in a folder as batches, one for each worker, returns the transfers
+        files = [(entry.path, entry.name.replace(" ", "_")) for entry in sorted(os.scandir(folder), key=lambda entry: entry.name) if entry.is_file()]
+        size = max(1, min(batch.MAX_BATCH_FILES, -(-len(files) // self.parallelism)))
+        return [self.upload_batch(files[start:start + size]) for start in range(0, len(files), size)]
+
+    def wait(self, transfers, timeout=None):
+        # Wait for the given transfers, returns the (done, not_done) sets
+        transfers = list(transfers)
+        done, _ = concurrent.futures.wait([transfer.future for transfer in transfers], timeout=timeout)
+        return ({transfer for transfer in transfers if transfer.future in done},
+                {transfer for transfer in transfers if transfer.future not in done})
+
+    def cancel_all(self):
+        for transfer in list(self.transfers.values()):
+            transfer.cancel()
+
+    def shutdown(self, wait=True):
+        # Without wait the queued transfers are cancelled and the running ones asked to stop
+        if not wait:
+            self.cancel_all()
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
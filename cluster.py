@@ -0,0 +1,138 @@
+import collections
+import json
+import os
+import socket
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS claims (
+    name TEXT PRIMARY KEY,          -- 'session:<client>' or 'upload:<file key>'
+    worker INTEGER NOT NULL,        -- Worker that holds the claim
+    pid INTEGER NOT NULL
+);
+"""
+
+RETRY_INTERVAL = 0.01   # Seconds before a message waiting for a full worker socket is sent again
+MAX_PENDING = 10000     # Messages kept for a worker that does not read them, the oldest are dropped beyond that
+
+# Shared state of the worker processes of one server, used with --workers
+#
+# Client names and uploads in progress are claimed in a small SQLite database next to the
+# catalog, the primary key makes a claim atomic across processes. Notifications for clients
+# connected to another worker are forwarded to it as datagrams on a Unix socket per worker
+# in <storage>/.run. The catalog itself needs nothing extra, every worker has its own
+# connections to it and WAL keeps them consistent.
+class Cluster:
+    def __init__(self, storage_path, worker_id, workers, log=print):
+        self.storage_path = storage_path
+        self.worker_id = worker_id
+        self.workers = workers                      # Number of workers, their ids are 0 .. workers - 1
+        self.log = log
+        self.run_path = os.path.join(storage_path, ".run")
+        self.loop = None
+        self.pending = {}                           # Worker id -> messages waiting until its socket has room
+        os.makedirs(self.run_path, exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(storage_path, ".cluster.db"), isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.db.execute("DELETE FROM claims WHERE worker = ?", (worker_id,)) # Left behind by a worker with this id that died
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        path = self.socket_path(worker_id)
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock.bind(path)
+
+    @staticmethod
+    def reset(storage_path):
+        # Drop the state of an earlier run, called by the parent before it starts the workers
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(os.path.join(storage_path, f".cluster.db{suffix}"))
+            except FileNotFoundError:
+                pass
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.run_path, f"worker-{worker_id}.sock")
+
+    def start(self, loop, handler):
+        # Call handler on the event loop with every message forwarded by another worker
+        self.loop = loop
+        loop.add_reader(self.sock.fileno(), self.receive, handler)
+
+    def receive(self, handler):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+            handler(message)
+
+    def forward(self, message, worker_id=None):
+        # Send a message to one worker, or to all the others, a worker that is not running is skipped
+        data = json.dumps(message).encode()
+        targets = [worker_id] if worker_id is not None else range(self.workers)
+        for target in targets:
+            if target != self.worker_id:
+                self.send(target, data)
+
+    def send(self, target, data):
+        # A worker's socket only queues a few datagrams, the rest wait here until it has read them
+        pending = self.pending.get(target)
+        if pending is not None:
+            if len(pending) >= MAX_PENDING:
+                pending.popleft()
+                self.log(f"Worker {target} is not reading its messages, dropped one.")
+            pending.append(data)
+            return
+        try:
+            self.sock.sendto(data, self.socket_path(target))
+        except BlockingIOError:
+            self.pending[target] = collections.deque([data])
+            self.loop.call_later(RETRY_INTERVAL, self.flush, target)
+        except OSError:
+            pass # The worker is not running, it starts with an empty cache
+
+    def flush(self, target):
+        pending = self.pending[target]
+        while pending:
+            try:
+                self.sock.sendto(pending[0], self.socket_path(target))
+            except BlockingIOError:
+                self.loop.call_later(RETRY_INTERVAL, self.flush, target)
+                return
+            except OSError:
+                break
+            pending.popleft()
+        del self.pending[target]
+
+    def claim(self, name):
+        try:
+            self.db.execute("INSERT INTO claims (name, worker, pid) VALUES (?, ?, ?)", (name, self.worker_id, os.getpid()))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def release(self, name):
+        self.db.execute("DELETE FROM claims WHERE name = ? AND worker = ?", (name, self.worker_id))
+
+    def worker_of(self, name):
+        row = self.db.execute("SELECT worker FROM claims WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        if self.loop:
+            self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        try:
+            os.remove(self.socket_path(self.worker_id))
+        except FileNotFoundError:
+            pass
+        self.db.execute("DELETE FROM claims WHERE worker = ?", (self.worker_id,))
+        self.db.close()
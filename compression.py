@@ -0,0 +1,125 @@
+import bz2
+import lzma
+import zlib
+from protocol import ProtocolError
+
+# Streaming compression of transfers
+#
+# Both sides list the codecs they support in HELLO and WELCOME. For every transfer the
+# sender compresses a sample from the start of the data and picks the cheapest codec that
+# pays off, or none at all. Compressed DATA frames carry the id of their codec in the low
+# byte of the frame flags, the payloads of one transfer form a single compressed stream.
+
+SAMPLE_SIZE = 64 << 10      # Bytes from the start of a transfer used to pick a codec
+MIN_SIZE = 4 << 10          # Smaller transfers are sent as they are
+MIN_SAVING = 0.9            # The sample has to shrink to less than this fraction of its size
+HEAVIER_GAIN = 0.85         # A slower codec has to shrink the sample this much below the cheaper one
+
+
+class Codec:
+    def __init__(self, name, codec_id, compressor, decompressor, compress):
+        self.name = name
+        self.id = codec_id                          # Value of the DATA frame flags
+        self.compressor = compressor                # Factories of streaming objects
+        self.decompressor = decompressor
+        self.compress = compress                    # One-shot compression, used on the sample
+
+
+# Cheapest first, the slower ones are only worth it when they save clearly more
+CODECS = {codec.name: codec for codec in (
+    Codec("zlib", 1, lambda: zlib.compressobj(6), zlib.decompressobj, lambda data: zlib.compress(data, 6)),
+    Codec("bz2", 2, lambda: bz2.BZ2Compressor(9), bz2.BZ2Decompressor, lambda data: bz2.compress(data, 9)),
+    Codec("lzma", 3, lambda: lzma.LZMACompressor(preset=3), lzma.LZMADecompressor, lambda data: lzma.compress(data, preset=3)),
+)}
+CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+
+
+def agree(offered, supported=tuple(CODECS)):
+    # Codecs both sides support, in the order of preference
+    offered = set(offered) if isinstance(offered, (list, tuple)) else set()
+    return [name for name in CODECS if name in offered and name in supported]
+
+
+def choose(sample, codecs):
+    # Codec for a transfer that starts with sample, None when compression does not pay off
+    #
+    # A codec is only tried when the cheaper one before it paid off, data that zlib cannot
+    # shrink is taken to be compressed already and costs a single pass over the sample.
+    if len(sample) < MIN_SIZE:
+        return None
+    best, best_size = None, len(sample) * MIN_SAVING
+    for codec in CODECS.values():
+        if codec.name not in codecs:
+            continue
+        size = len(codec.compress(sample))
+        if size < (best_size * HEAVIER_GAIN if best else best_size):
+            best, best_size = codec.name, size
+        elif best is None:
+            return None
+    return best
+
+
+def decompressor(codec_id, limit):
+    codec = CODECS_BY_ID.get(codec_id)
+    if codec is None:
+        raise ProtocolError(f"Unknown compression codec {codec_id}")
+    return Decompressor(codec, limit)
+
+
+# Decompresses one transfer, handing the output on in pieces of at most `limit` bytes
+#
+# The output is bounded however well the input compresses, so a small frame can never
+# blow up into a large allocation.
+class Decompressor:
+    def __init__(self, codec, limit):
+        self.codec = codec
+        self.inner = codec.decompressor()
+        self.limit = limit
+
+    def feed(self, data, write):
+        try:
+            if self.codec.name == "zlib":
+                while data:
+                    write(self.inner.decompress(data, self.limit))
+                    data = self.inner.unconsumed_tail
+            elif not self.inner.eof:
+                write(self.inner.decompress(data, self.limit))
+                while not self.inner.needs_input and not self.inner.eof:
+                    write(self.inner.decompress(b"", self.limit))
+        except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+            raise ProtocolError(f"Corrupt {self.codec.name} data: {str(e)}")
+
+    def finish(self, write):
+        # Output that zlib still holds back at the end of the stream
+        if self.codec.name == "zlib":
+            try:
+                write(self.inner.flush())
+            except zlib.error as e:
+                raise ProtocolError(f"Corrupt zlib data: {str(e)}")
+
+
+def compressed_chunks(f, count, codec_name, chunk_size, hasher=None):
+    # Compressed stream of the next `count` bytes of a file, in pieces of at most chunk_size bytes
+    #
+    # hasher is updated with the uncompressed data as it is read.
+    #
+    # A piece is only yielded once the codec has output, for well compressible data that
+    # is after many reads. In between an empty piece is yielded after every read, callers
+    # skip it but get to check whether the transfer was cancelled.
+    compressor = CODECS[codec_name].compressor()
+    pending = bytearray()
+    while True:
+        data = f.read(min(chunk_size, count))
+        if count and not data:
+            raise ValueError("File changed while it was being compressed")
+        count -= len(data)
+        if hasher is not None:
+            hasher.update(data)
+        pending += compressor.compress(data) if data else compressor.flush()
+        if data and len(pending) < chunk_size:
+            yield b""
+        while len(pending) >= chunk_size or (pending and not data):
+            yield bytes(pending[:chunk_size])
+            del pending[:chunk_size]
+        if not data:
+            return
@@ -0,0 +1,139 @@
+import hashlib
+import math
+import zlib
+
+# Delta uploads of files the server already has an older version of, in the manner of rsync
+#
+# The server cuts its version into blocks and sends a weak and a strong checksum of each.
+# The client slides a window over its file: wherever the window matches a block the server
+# only gets told to copy that block, everything else is sent as literal data. The weak
+# checksum is Adler-32, which can be rolled one byte along in constant time, the strong one
+# is only computed where the weak one matches. Right after a match the next block is looked
+# up by its strong checksum directly, so the unchanged runs of a file are matched at the
+# speed of the hash instead of byte by byte.
+
+MIN_BLOCK_SIZE = 2 << 10
+MAX_BLOCK_SIZE = 128 << 10
+READ_SIZE = 1 << 20         # Bytes read from the file at a time, also the largest literal op
+ADLER_MOD = 65521
+
+
+def block_size(file_size):
+    # About the square root of the file size, like rsync: few signatures for large files, fine matches for small ones
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, 1 << math.isqrt(file_size).bit_length()))
+
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def signatures(reader, size, block):
+    # [weak, strong] of every block of a file, the last block can be shorter
+    blocks = []
+    while size > 0:
+        data = reader.read(min(block, size))
+        if not data:
+            raise ValueError("File changed while its signatures were computed")
+        blocks.append([zlib.adler32(data), strong_checksum(data)])
+        size -= len(data)
+    return blocks
+
+
+# The server's version of a file, as far as the client knows it
+class Signature:
+    def __init__(self, size, etag, block_size, blocks):
+        self.size = size
+        self.etag = etag                            # Version of the file the signatures belong to
+        self.block_size = block_size
+        self.blocks = blocks
+        self.weak = {weak for weak, _ in blocks}
+        self.strong = {}                            # Strong checksum -> index of the first block with it
+        for index, (_, strong) in reversed(list(enumerate(blocks))):
+            self.strong[strong] = index
+
+    def block_length(self, index):
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def find(self, window):
+        # Offset of a block of the server's file with the same contents as window, or None
+        index = self.strong.get(strong_checksum(window))
+        if index is None or self.block_length(index) != len(window):
+            return None
+        return index * self.block_size
+
+
+def delta(f, signature, hasher=None):
+    # Ops that turn the server's version into the rest of f, read from its current position
+    #
+    # Yields ("copy", offset, length) for a range of the server's file and ("data", bytes) for
+    # literal data, adjacent copies are merged. hasher is updated with everything read.
+    block = signature.block_size
+    buffer = b""
+    start = 0                                       # Start of the window in buffer
+    literal = 0                                     # Start of the data no op covers yet
+    copy = None                                     # [offset, length] of the last copy, it may still grow
+    weak = None                                     # Adler-32 of the window while rolling, None right after a match
+    end_of_file = False
+
+    while True:
+        if len(buffer) - start <= block and not end_of_file: # Rolling needs a byte past the window
+            data = f.read(READ_SIZE)
+            end_of_file = not data
+            if hasher is not None:
+                hasher.update(data)
+            if start - literal >= READ_SIZE: # A long unmatched run goes out before the buffer grows further
+                if copy:
+                    yield ("copy", *copy)
+                    copy = None
+                yield ("data", buffer[literal:start])
+                literal = start
+            buffer = buffer[literal:] + data
+            start -= literal
+            literal = 0
+            continue
+        if start >= len(buffer):
+            break
+
+        window = buffer[start:start + block]
+        check = weak is None or weak in signature.weak or len(window) < block # A short tail may still be the last block
+        offset = signature.find(window) if check else None
+        if offset is not None:
+            if literal < start:
+                if copy:
+                    yield ("copy", *copy)
+                    copy = None
+                yield ("data", buffer[literal:start])
+            if copy and copy[0] + copy[1] == offset:
+                copy[1] += len(window)
+            else:
+                if copy:
+                    yield ("copy", *copy)
+                copy = [offset, len(window)]
+            start += len(window)
+            literal = start
+            weak = None
+            continue
+
+        limit = len(buffer) - block
+        if start >= limit:
+            if end_of_file:
+                break # What is left matches nothing
+            continue
+        if weak is None:
+            weak = zlib.adler32(window)
+        # Roll the window one byte at a time until its weak checksum is one of a block
+        a, b = weak & 0xFFFF, weak >> 16
+        weak_set = signature.weak
+        while start < limit:
+            out, new = buffer[start], buffer[start + block]
+            a = (a - out + new) % ADLER_MOD
+            b = (b - block * out - 1 + a) % ADLER_MOD
+            start += 1
+            if b << 16 | a in weak_set:
+                break
+        weak = b << 16 | a
+
+    if copy:
+        yield ("copy", *copy)
+    if literal < len(buffer):
+        yield ("data", buffer[literal:])
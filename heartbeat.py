@@ -0,0 +1,71 @@
+import asyncio
+import heapq
+import itertools
+
+# Heartbeats for every session, driven by a heap of per-session deadlines
+#
+# Each session has one entry in the heap, due when its next heartbeat should go out. A tick
+# only pops the entries that are due, so the work per tick grows with the sessions that are
+# due, not with all connected sessions. A session is evicted when its entry comes up and
+# nothing has been received from it for longer than the timeout. Sessions that do not answer
+# heartbeats (answers_heartbeats is False) are only evicted once their connection closes.
+class HeartbeatScheduler:
+    def __init__(self, interval, timeout, on_timeout, log=print):
+        self.interval = interval                    # Seconds between heartbeats to a session
+        self.timeout = timeout                      # Seconds of silence after which a session is evicted
+        self.on_timeout = on_timeout                # Called with a session that is dead
+        self.log = log
+        self.heap = []                              # (deadline, sequence, session)
+        self.sessions = set()                       # Sessions that are scheduled, removed ones stay in the heap until they come up
+        self.sequence = itertools.count()           # Keeps sessions out of the heap comparisons
+        self.changed = asyncio.Event()              # Set when an entry is due earlier than the one the loop waits for
+
+    def add(self, session):
+        loop = asyncio.get_running_loop()
+        session.last_seen = loop.time()
+        self.sessions.add(session)
+        self.push(loop.time(), session) # The first heartbeat measures the round trip time right away
+
+    def remove(self, session):
+        self.sessions.discard(session)
+
+    def push(self, deadline, session):
+        if not self.heap or deadline < self.heap[0][0]:
+            self.changed.set()
+        heapq.heappush(self.heap, (deadline, next(self.sequence), session))
+
+    def answered(self, session, message):
+        # A heartbeat came back, it carries the loop time it was sent at. Returns the round trip time
+        now = asyncio.get_running_loop().time()
+        session.last_seen = now
+        try:
+            rtt = now - float(message["time"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        session.rtt = rtt if session.rtt is None else 0.8 * session.rtt + 0.2 * rtt # Smoothed like TCP's SRTT
+        return rtt
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.changed.clear()
+            now = loop.time()
+            if not self.heap or self.heap[0][0] > now:
+                delay = self.heap[0][0] - now if self.heap else None
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            while self.heap and self.heap[0][0] <= now:
+                _, _, session = heapq.heappop(self.heap)
+                if session not in self.sessions:
+                    continue
+                if session.is_closing() or (session.answers_heartbeats and now - session.last_seen > self.timeout):
+                    self.sessions.discard(session)
+                    if not session.is_closing():
+                        self.log(f"{session.client_name} did not answer heartbeats for {self.timeout}s.")
+                    self.on_timeout(session)
+                    continue
+                session.heartbeat(now)
+                heapq.heappush(self.heap, (now + self.interval, next(self.sequence), session))
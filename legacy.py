@@ -0,0 +1,177 @@
+import hashlib
+import time
+
+# Session for clients that speak the original text protocol, where every recv is treated as one command
+class LegacySession:
+    def __init__(self, engine, client_name, reader, command_writer, heartbeat_writer, notification_writer):
+        self.engine = engine
+        self.client_name = client_name
+        self.reader = reader
+        self.command_writer = command_writer
+        self.heartbeat_writer = heartbeat_writer
+        self.notification_writer = notification_writer
+        self.answers_heartbeats = False             # The original clients only receive heartbeats
+        self.last_seen = None
+        self.rtt = None
+        self.busy = False                           # Working on a command
+
+    def send(self, text):
+        self.command_writer.write(text.encode())
+
+    def heartbeat(self, now):
+        self.heartbeat_writer.write("HEARTBEAT".encode()) # Buffered by the transport, never blocks the loop
+
+    async def deliver(self, notice):
+        # Called by the notification bus, the original clients only get the text
+        self.notification_writer.write(notice["message"].encode())
+        await self.notification_writer.drain()
+
+    def is_closing(self):
+        return self.command_writer.is_closing() or self.heartbeat_writer.is_closing()
+
+    def is_idle(self):
+        return not self.busy
+
+    def close(self):
+        for writer in (self.command_writer, self.heartbeat_writer, self.notification_writer):
+            writer.close()
+
+    def abort(self):
+        for writer in (self.command_writer, self.heartbeat_writer, self.notification_writer):
+            writer.transport.abort()
+
+    async def run(self):
+        self.send("Welcome to the server!")
+        while True:
+            try:
+                await self.command_writer.drain()
+                command = (await self.reader.read(1024)).decode() # Receive command from client
+                if not command: # Client disconnected
+                    break
+                self.busy = True
+                start = time.monotonic()
+                if command == "LIST":
+                    self.send_file_list()
+                elif command.startswith("UPLOAD"):
+                    await self.handle_upload(command)
+                elif command.startswith("DOWNLOAD"):
+                    await self.handle_download(command)
+                elif command.startswith("DELETE"):
+                    self.handle_delete(command)
+                elif command == "EXIT":
+                    break
+                else:
+                    continue
+                self.engine.request_latency.observe(time.monotonic() - start, command=command.split(" ", 1)[0])
+            except (ConnectionError, UnicodeDecodeError):
+                break
+            finally:
+                self.busy = False
+
+    def send_file_list(self):
+        # Construct the file list
+        file_list = "\n".join([f"{entry['key']}: {entry['owner']}" for entry in self.engine.list_files()])
+
+        if not file_list: # Check if the file list is empty
+            self.send("No files available.")
+            return
+
+        self.send(file_list)
+
+    async def handle_upload(self, command):
+        try:
+            _, filename, file_size = command.split(" ", 2) # Extract the file name and file size from the command
+            file_size = int(file_size)
+
+            file_key = self.engine.file_key(self.client_name, filename)
+            self.engine.file_path(file_key) # Rejects names that point outside the storage folder
+            if not self.engine.may_write(file_key, self.client_name):
+                raise ValueError(f"{file_key} belongs to another client")
+            file_exists = self.engine.file_exists(file_key)
+            if not self.engine.claim_upload(file_key, self):
+                raise ValueError(f"{file_key} is already being uploaded")
+
+            try:
+                f, _ = self.engine.begin_partial(file_key, file_size, "", resume=False) # Keeps the old file until the upload is complete
+                hasher = hashlib.sha256()
+                with f:
+                    received = 0
+                    # Receive the file data in chunks and write to the file
+                    while received < file_size:
+                        data = await self.reader.read(min(1024, file_size - received))
+                        if not data:
+                            raise ConnectionError("Client disconnected during upload")
+                        f.write(data)
+                        hasher.update(data)
+                        received += len(data)
+                        self.engine.bytes_received.inc(len(data))
+                await self.engine.commit_partial(file_key, self.client_name, filename, hasher.hexdigest())
+            finally:
+                self.engine.release_upload(file_key)
+
+            self.engine.notify_change("overwrite" if file_exists else "upload", file_key, self.client_name)
+            if file_exists:
+                self.engine.log(f"Upload successful, {self.client_name} overwrote {filename}.", client=self.client_name, cmd="UPLOAD", bytes=file_size)
+                self.send(f"Upload successful, {filename} was overwritten")
+            else:
+                self.engine.log(f"{self.client_name} uploaded {filename}.", client=self.client_name, cmd="UPLOAD", bytes=file_size)
+                self.send("Upload successful.")
+
+        except ConnectionError:
+            raise
+        except Exception as e:
+            self.engine.log(f"Error during upload: {str(e)}", client=self.client_name, cmd="UPLOAD", error=type(e).__name__)
+            self.send("UPLOAD_FAILED")
+
+    async def handle_download(self, command):
+        try:
+            # Extract owner and filename, the filename is the 'owner_filename' key
+            _, owner, file_key = command.split(" ", 2)
+            source = self.engine.open_file(file_key)
+
+            flow = self.engine.scheduler.flow(self.client_name) # Shaped like the downloads of framed clients
+            try:
+                self.send(f"OK {source.size}") # Send file size to client
+                await self.command_writer.drain()
+
+                if source.buffer is not None: # Cached, sent from memory
+                    for start in range(0, source.size, self.engine.frame_size):
+                        chunk = source.buffer[start:start + self.engine.frame_size]
+                        await flow.acquire(len(chunk))
+                        self.command_writer.write(chunk)
+                        self.engine.bytes_sent.inc(len(chunk))
+                        await self.command_writer.drain()
+                else:
+                    while chunk := source.file.read(1024): # Read and send file in chunks
+                        await flow.acquire(len(chunk))
+                        self.command_writer.write(chunk)
+                        self.engine.bytes_sent.inc(len(chunk))
+                        await self.command_writer.drain()
+            finally:
+                flow.close()
+                source.close()
+
+            self.engine.log(f"File {file_key} sent to {self.client_name}.", client=self.client_name, cmd="DOWNLOAD", bytes=source.size)
+            self.engine.notify_download(self.engine.owner_of(file_key) or owner, file_key, self.client_name)
+
+        except ConnectionError:
+            raise
+        except Exception as e:
+            self.engine.log(f"Error during download: {str(e)}", client=self.client_name, cmd="DOWNLOAD", error=type(e).__name__)
+            self.send("ERROR: Download failed.")
+
+    def handle_delete(self, command):
+        try:
+            _, owner, file_key = command.split(" ", 2)
+
+            if owner != self.client_name or self.engine.owner_of(file_key) not in (None, self.client_name): # Check if the file was uploaded by the client
+                self.send("ERROR: You do not have permission to delete this file.")
+                return
+
+            self.engine.delete_file(file_key)
+            self.send("File deleted successfully.")
+            self.engine.log(f"{self.client_name} deleted {file_key}.", client=self.client_name, cmd="DELETE")
+            self.engine.notify_change("delete", file_key, self.client_name)
+        except Exception as e:
+            self.engine.log(f"Error during deletion: {str(e)}", client=self.client_name, cmd="DELETE", error=type(e).__name__)
+            self.send("ERROR: Deletion failed.")
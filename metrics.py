@@ -0,0 +1,191 @@
+import asyncio
+import bisect
+import collections
+import time
+
+# Counters, gauges and histograms of the server, rendered in the Prometheus text format
+#
+# Metrics are created once and kept as attributes by the code that updates them, so the hot
+# paths only do an addition. Labels are keyword arguments, e.g. latency.observe(0.2, command="LIST").
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = collections.defaultdict(int)     # Sorted label pairs -> value
+
+    def inc(self, value=1, **labels):
+        self.values[tuple(sorted(labels.items()))] += value
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+    def snapshot(self):
+        return {label_text(labels) or "total": value for labels, value in self.values.items()}
+
+
+class Gauge:
+    # Value read when the metrics are collected, so nothing has to keep it up to date
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        return [(self.name, (), self.read())]
+
+    def snapshot(self):
+        return self.read()
+
+
+class CounterValue(Gauge):
+    # Counter kept by another object, e.g. the hits of the file cache, read when the metrics are collected
+    pass
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}                            # Sorted label pairs -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def quantile(self, fraction, key):
+        # Upper bound of the bucket the quantile falls into
+        counts, _, count = self.series[key]
+        rank, seen = fraction * count, 0
+        for bound, bucket in zip(self.buckets, counts):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                samples.append((f"{self.name}_bucket", labels + (("le", bound),), cumulative))
+            samples.append((f"{self.name}_bucket", labels + (("le", "+Inf"),), count))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+    def snapshot(self):
+        return {label_text(key) or "total": {"count": series[2], "sum": series[1], "p50": self.quantile(0.5, key),
+                                             "p99": self.quantile(0.99, key)}
+                for key, series in self.series.items()}
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = {}                           # Metrics by name, in the order they were created
+        self.started = time.time()
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, read):
+        return self.add(Gauge(name, help, read))
+
+    def counter_value(self, name, help, read):
+        return self.add(CounterValue(name, help, read))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def snapshot(self):
+        # Plain dict of every metric, the STATS reply
+        return {"uptime": time.time() - self.started, **{name: metric.snapshot() for name, metric in self.metrics.items()}}
+
+    def render(self):
+        kinds = {Counter: "counter", CounterValue: "counter", Gauge: "gauge", Histogram: "histogram"}
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kinds[type(metric)]}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        # Minimal HTTP endpoint for scrapers, GET /metrics returns the text format
+        return await asyncio.start_server(self.handle_scrape, host, port)
+
+    async def handle_scrape(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] in (b"/metrics", b"/"):
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# Log that stays cheap under load
+#
+# Messages are passed on to the sink (print, a queue, ...) as "message key=value" lines. A
+# token bucket limits how many get through per second, the ones over the limit are counted
+# and reported with the next message that gets through. The most recent records are kept
+# in a bounded buffer for STATS.
+class EventLog:
+    def __init__(self, sink=print, rate=100, burst=200, keep=1000):
+        self.sink = sink
+        self.rate = rate                            # Messages per second that get through
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.suppressed = 0                         # Messages dropped since the last one that got through
+        self.dropped = 0                            # Messages dropped in total
+        self.recent = collections.deque(maxlen=keep)
+
+    def __call__(self, message, **fields):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            self.dropped += 1
+            return
+        self.tokens -= 1
+        if fields:
+            message = f"{message} " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if self.suppressed:
+            message = f"{message} ({self.suppressed} log messages suppressed)"
+            self.suppressed = 0
+        self.recent.append((time.time(), message))
+        try:
+            self.sink(message)
+        except Exception: # A full or closed sink must never take the server down
+            self.dropped += 1
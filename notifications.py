@@ -0,0 +1,132 @@
+import asyncio
+import collections
+import itertools
+
+EVENTS = ("download", "upload", "overwrite", "delete") # Event types clients can subscribe to
+DEFAULT_EVENTS = ("download",)  # What the original server notified about
+COALESCE_WINDOW = 2.0           # Seconds a subscriber's events are collected for after a delivery
+MAX_QUEUED = 256                # Distinct pending notifications per subscriber, the oldest are dropped beyond that
+NAMED_CLIENTS = 3               # Clients a merged notice names, the others are counted
+PAST = {"download": "downloaded", "upload": "uploaded", "overwrite": "overwritten", "delete": "deleted"}
+
+
+# Pending notifications of one client, delivered by a task of its own
+#
+# Events about the same file and of the same type are merged while they wait, so a burst of
+# downloads becomes one notification. A subscriber that does not read its connection only
+# holds up its own task, never the client that caused the event.
+class Subscriber:
+    def __init__(self, client_name, session, events):
+        self.client_name = client_name
+        self.session = session                      # Delivers a notice dict, see FramedSession.deliver
+        self.events = set(events)                   # Event types the client wants
+        self.pending = collections.OrderedDict()    # (event, filename) -> [count, clients, first time, clients that left]
+        self.dropped = 0                            # Notifications dropped since the last delivery
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def add(self, event, filename, client_name, now):
+        key = (event, filename)
+        entry = self.pending.get(key)
+        if entry is None:
+            if len(self.pending) >= MAX_QUEUED:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            entry = self.pending[key] = [0, {}, now, 0]
+        entry[0] += 1
+        entry[1][client_name] = None # A dict keeps the clients in the order they came
+        self.wakeup.set()
+
+    def forget(self, client_name):
+        # A client that disconnected is only counted from now on, unless it is one of the names a notice shows
+        for entry in self.pending.values():
+            clients = entry[1]
+            if client_name in clients and client_name not in itertools.islice(clients, NAMED_CLIENTS):
+                del clients[client_name]
+                entry[3] += 1
+
+    def take(self):
+        pending, dropped = self.pending, self.dropped
+        self.pending, self.dropped = collections.OrderedDict(), 0
+        self.wakeup.clear()
+        return pending, dropped
+
+
+# Fans events out to the connected clients that subscribed to them
+class NotificationBus:
+    def __init__(self, log=print, window=COALESCE_WINDOW):
+        self.log = log
+        self.window = window
+        self.subscribers = {}                       # Subscribers by client name
+        self.dropped = 0                            # Notifications dropped because a queue was full
+
+    def subscribe(self, client_name, session, events=DEFAULT_EVENTS):
+        # Called on the event loop, replaces the events of an existing subscription of the same session
+        subscriber = self.subscribers.get(client_name)
+        if subscriber is not None and subscriber.session is session:
+            subscriber.events = set(events)
+            return subscriber
+        self.unsubscribe(client_name)
+        subscriber = self.subscribers[client_name] = Subscriber(client_name, session, events)
+        subscriber.task = asyncio.create_task(self.deliver(subscriber))
+        return subscriber
+
+    def unsubscribe(self, client_name, session=None):
+        subscriber = self.subscribers.get(client_name)
+        if subscriber is None or (session is not None and subscriber.session is not session):
+            return
+        del self.subscribers[client_name]
+        subscriber.task.cancel()
+        if session is not None: # The session ended, without one subscribe() is replacing it with a new one
+            for other in self.subscribers.values():
+                other.forget(client_name)
+
+    def queued(self):
+        return sum(len(subscriber.pending) for subscriber in list(self.subscribers.values()))
+
+    def publish(self, event, filename, client_name, owner=None):
+        # Queue an event caused by client_name, never waits
+        #
+        # Downloads are only of interest to the owner of the file, the other events go to every
+        # subscriber except the client that caused them.
+        now = asyncio.get_running_loop().time()
+        if owner is not None:
+            recipients = [self.subscribers[owner]] if owner in self.subscribers else []
+        else:
+            recipients = list(self.subscribers.values())
+        for subscriber in recipients:
+            if subscriber.client_name != client_name and event in subscriber.events:
+                subscriber.add(event, filename, client_name, now)
+
+    async def deliver(self, subscriber):
+        # The first event goes out at once, what arrives during the following window is sent together
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await subscriber.wakeup.wait()
+                pending, dropped = subscriber.take()
+                now = loop.time()
+                for (event, filename), (count, clients, first, departed) in pending.items():
+                    clients = list(clients)
+                    await subscriber.session.deliver({
+                        "event": event, "filename": filename, "count": count, "clients": clients,
+                        "message": self.describe(event, filename, count, clients, departed, now - first)})
+                if dropped:
+                    self.dropped += dropped
+                    self.log(f"Dropped {dropped} notifications for {subscriber.client_name}.")
+                    await subscriber.session.deliver({"event": "dropped", "count": dropped,
+                                                      "message": f"NOTICE: {dropped} notifications were dropped."})
+                await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e: # The connection is gone, the session cleans up after itself
+            self.log(f"Could not notify {subscriber.client_name}: {str(e)}")
+
+    def describe(self, event, filename, count, clients, departed, elapsed):
+        # departed counts the clients that disconnected before the notice went out and were not named
+        subject = f"Your file '{filename}'" if event == "download" else f"File '{filename}'"
+        if count == 1:
+            return f"NOTICE: {subject} has been {PAST[event]} by {clients[0]}."
+        others = max(len(clients) - NAMED_CLIENTS, 0) + departed
+        who = ", ".join(clients[:NAMED_CLIENTS]) + (f" and {others} others" if others else "")
+        return f"NOTICE: {subject} has been {PAST[event]} {count} times in the last {max(elapsed, 1):.0f}s by {who}."
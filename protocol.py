@@ -0,0 +1,185 @@
+import asyncio
+import json
+import struct
+
+# Wire format shared by the server engine and the client
+#
+# A framed connection starts with the preface MAGIC + highest supported version.
+# The server answers with MAGIC + the version both sides will use, after that
+# every message is a frame: a fixed size header followed by `length` payload bytes.
+#
+# Version 2 carries the heartbeat and notification channels as frame types on the
+# command connection, version 1 needed a socket for each of them and is not served.
+
+MAGIC = b"TFSP"
+VERSION = 2
+MIN_VERSION = 2
+PREFACE_SIZE = len(MAGIC) + 1
+
+# Header: version, frame type, flags, request id, payload length
+HEADER = struct.Struct("!BBHIQ")
+
+# Frame types
+HELLO = 1       # Client name, first frame of a session
+WELCOME = 2     # Server accepted the session
+REQUEST = 3     # JSON command from the client
+RESPONSE = 4    # JSON reply to a request
+DATA = 5        # Raw file bytes belonging to a request
+END = 6         # End of the data belonging to a request
+ERROR = 7       # JSON error reply, ends a request
+HEARTBEAT = 8   # Heartbeat channel
+NOTICE = 9      # Notification channel, JSON message from the server
+
+# DATA frame flags: the low byte is the id of the codec a compressed payload is in, 0 for raw bytes
+CODEC_FLAGS = 0x00FF
+DELTA_COPY = 0x0100     # Delta upload: copy a range of the stored version, the payload is COPY_RANGE
+COPY_RANGE = struct.Struct("!QQ")   # Offset and length
+
+MAX_MESSAGE_SIZE = 1 << 20      # Largest JSON payload accepted
+MAX_DATA_SIZE = 16 << 20        # Largest DATA payload accepted
+BUFFER_SIZE = 1 << 20           # Default transfer buffer, also the size of the DATA frames sent
+LIST_PAGE_SIZE = 200            # Entries in a LIST page when the client does not ask for a size
+MAX_LIST_PAGE_SIZE = 1000       # Largest LIST page served
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Error reported by the server for a request
+class ServerError(Exception):
+    pass
+
+
+# Data that does not match the checksum it was sent with
+class ChecksumError(Exception):
+    pass
+
+
+# A transfer stopped at the client's request
+class TransferCancelled(Exception):
+    pass
+
+
+# A frame header, payload is None until it has been read
+class Frame:
+    __slots__ = ("version", "type", "flags", "request_id", "length", "payload")
+
+    def __init__(self, version, frame_type, flags, request_id, length, payload=None):
+        self.version = version
+        self.type = frame_type
+        self.flags = flags
+        self.request_id = request_id
+        self.length = length
+        self.payload = payload
+
+    def message(self):
+        return decode_message(self.payload)
+
+
+def preface(version=VERSION):
+    return MAGIC + bytes([version])
+
+
+def negotiate(client_preface):
+    # Pick the version both sides support, 0 means there is none
+    client_version = client_preface[len(MAGIC)]
+    if client_version < MIN_VERSION:
+        return 0
+    return min(client_version, VERSION)
+
+
+def encode_header(frame_type, request_id, length, flags=0, version=VERSION):
+    return HEADER.pack(version, frame_type, flags, request_id, length)
+
+
+def encode_frame(frame_type, request_id=0, payload=b"", flags=0, version=VERSION):
+    return encode_header(frame_type, request_id, len(payload), flags, version) + payload
+
+
+def encode_message(frame_type, request_id, message, version=VERSION):
+    return encode_frame(frame_type, request_id, json.dumps(message).encode(), version=version)
+
+
+def decode_message(payload):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        raise ProtocolError("Malformed message payload")
+    if not isinstance(message, dict):
+        raise ProtocolError("Message payload must be an object")
+    return message
+
+
+def parse_header(header):
+    version, frame_type, flags, request_id, length = HEADER.unpack(header)
+    if version < MIN_VERSION or version > VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    limit = MAX_DATA_SIZE if frame_type == DATA else MAX_MESSAGE_SIZE
+    if length > limit:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the limit of {limit}")
+    return Frame(version, frame_type, flags, request_id, length)
+
+
+async def read_header(reader):
+    # Read one frame header from an asyncio stream, returns None on a clean end of stream
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        return None
+    return parse_header(header)
+
+
+async def read_payload(reader, frame):
+    try:
+        frame.payload = await reader.readexactly(frame.length) if frame.length else b""
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    return frame
+
+
+async def read_frame(reader):
+    # Read one whole frame from an asyncio stream, returns None on a clean end of stream
+    frame = await read_header(reader)
+    if frame is None:
+        return None
+    return await read_payload(reader, frame)
+
+
+def recv_exactly(sock, size):
+    # Blocking read of exactly `size` bytes from a socket
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Connection closed by the server")
+        received += count
+    return bytes(buffer)
+
+
+def recv_header(sock):
+    # Blocking read of one frame header from a socket
+    return parse_header(recv_exactly(sock, HEADER.size))
+
+
+def recv_frame(sock):
+    # Blocking read of one whole frame from a socket
+    frame = recv_header(sock)
+    frame.payload = recv_exactly(sock, frame.length) if frame.length else b""
+    return frame
+
+
+def recv_payload_into(sock, length, buffer, write):
+    # Stream `length` payload bytes to write() through a reusable memoryview, without allocating per chunk
+    remaining = length
+    while remaining:
+        count = sock.recv_into(buffer, min(remaining, len(buffer)))
+        if not count:
+            raise ConnectionError("Connection closed by the server")
+        write(buffer[:count])
+        remaining -= count
+    return length
@@ -0,0 +1,99 @@
+import threading
+
+SHARDS = 16 # Locks per map, threads working on different keys rarely wait for each other
+
+# Dict split into shards that each have their own lock
+#
+# Every operation is atomic, including the conditional ones (add, remove) that replace
+# check-then-act sequences. snapshot() copies one shard at a time, so iterating never holds
+# up writers for long and never sees a dict change size underneath it.
+class ShardedDict:
+    def __init__(self, shards=SHARDS):
+        self.shards = [({}, threading.Lock()) for _ in range(shards)]
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key, default=None):
+        entries, lock = self.shard(key)
+        with lock:
+            return entries.get(key, default)
+
+    def __contains__(self, key):
+        entries, lock = self.shard(key)
+        with lock:
+            return key in entries
+
+    def __setitem__(self, key, value):
+        entries, lock = self.shard(key)
+        with lock:
+            entries[key] = value
+
+    def add(self, key, value):
+        # Insert the key only if it is not there yet, returns whether it was inserted
+        entries, lock = self.shard(key)
+        with lock:
+            if key in entries:
+                return False
+            entries[key] = value
+            return True
+
+    def pop(self, key, default=None):
+        entries, lock = self.shard(key)
+        with lock:
+            return entries.pop(key, default)
+
+    def remove(self, key, value):
+        # Delete the key only if it still maps to this very value, returns whether it was deleted
+        entries, lock = self.shard(key)
+        with lock:
+            if entries.get(key) is not value:
+                return False
+            del entries[key]
+            return True
+
+    def __len__(self):
+        return sum(len(entries) for entries, _ in self.shards)
+
+    def snapshot(self):
+        # List of the (key, value) pairs, consistent within each shard
+        items = []
+        for entries, lock in self.shards:
+            with lock:
+                items.extend(entries.items())
+        return items
+
+
+RESERVED = object() # Placeholder for a name that is being set up
+
+# Connected sessions by client name
+#
+# A name is reserved before the session is set up and attached once it is ready, so two
+# clients that connect with the same name at the same time can never both get it.
+class SessionRegistry:
+    def __init__(self, shards=SHARDS):
+        self.entries = ShardedDict(shards)
+
+    def reserve(self, client_name):
+        return self.entries.add(client_name, RESERVED)
+
+    def attach(self, client_name, session):
+        self.entries[client_name] = session
+
+    def release(self, client_name, session=RESERVED):
+        # Remove the name, only if it still belongs to the given session (or reservation)
+        return self.entries.remove(client_name, session)
+
+    def get(self, client_name):
+        session = self.entries.get(client_name)
+        return None if session is RESERVED else session
+
+    def __contains__(self, client_name):
+        return client_name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def snapshot(self):
+        # (client name, session) pairs of the sessions that are set up
+        return [(client_name, session) for client_name, session in self.entries.snapshot() if session is not RESERVED]
@@ -0,0 +1,102 @@
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+
+# Graceful restarts and shutdowns of the headless server
+#
+# On SIGHUP the server starts its successor with the listening socket as --inherit-fd and waits
+# until the successor listens on it, so no connection is refused in between. From then on the
+# kernel hands every new connection to the successor. The old process stops accepting, sends a
+# NOTICE asking its clients to reconnect once their requests are done and keeps serving them.
+# It closes each session once it has been idle for DRAIN_IDLE and exits after the last one, or
+# after --drain-timeout. SIGTERM and SIGINT drain the same way without a successor.
+#
+# The catalog and unfinished uploads are on disk already. What a new process would otherwise
+# have to build up again, the hot entries of the read cache and the subscriptions of the
+# clients, is written to a snapshot in the storage folder and read back when the next process starts.
+
+READY_TIMEOUT = 30              # Seconds the successor has to start listening before the restart is given up
+DRAIN_TIMEOUT = 60              # Seconds sessions get to finish their requests, the rest are closed
+DRAIN_IDLE = 2.0                # Seconds a session may stay idle while draining before the server closes it
+DRAIN_POLL = 0.2                # Seconds between looks at the draining sessions
+CLOSE_TIMEOUT = 2               # Seconds closed connections get to finish closing before they are aborted
+ONE_OFF_OPTIONS = {"--rescan": 0, "--inherit-fd": 1, "--ready-fd": 1} # Not passed on to the successor, with their number of values
+
+
+def snapshot_path(storage_path, worker_id=0):
+    return os.path.join(storage_path, f".snapshot.{worker_id}.json")
+
+
+def save_snapshot(path, state):
+    # Written to a temporary file and renamed, the next process reads a whole snapshot or none
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(dict(state, pid=os.getpid(), time=time.time()), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def load_snapshot(path):
+    # The snapshot of the previous process, None if there is none. It is only used once.
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return state if isinstance(state, dict) else None
+
+
+def successor_command(argv, fds, ready_fd):
+    # Command line of the process taking over: the arguments of this one without the one-off options
+    args = []
+    skip = 0
+    for arg in argv:
+        if skip:
+            skip -= 1
+            continue
+        name = arg.split("=", 1)[0]
+        if name in ONE_OFF_OPTIONS:
+            skip = ONE_OFF_OPTIONS[name] if "=" not in arg else 0
+            continue
+        args.append(arg)
+    for fd in fds:
+        args += ["--inherit-fd", str(fd)]
+    return [sys.executable, os.path.abspath(sys.argv[0]), *args, "--ready-fd", str(ready_fd)]
+
+
+def spawn_successor(argv, fds, timeout=READY_TIMEOUT):
+    # Start the successor and wait until it listens, runs on a worker thread
+    #
+    # Returns the process, or None when it exited or did not get ready in time.
+    ready_read, ready_write = os.pipe()
+    try:
+        process = subprocess.Popen(successor_command(argv, fds, ready_write), pass_fds=(*fds, ready_write))
+    finally:
+        os.close(ready_write)
+    try:
+        readable, _, _ = select.select([ready_read], [], [], timeout)
+        ready = bool(readable) and os.read(ready_read, 1) == b"1" # A successor that dies closes the pipe without a byte
+    finally:
+        os.close(ready_read)
+    if not ready:
+        process.kill()
+        process.wait()
+        return None
+    return process
+
+
+def notify_ready(fd):
+    # Called by the successor once it listens and has read the snapshot
+    try:
+        os.write(fd, b"1")
+    finally:
+        os.close(fd)
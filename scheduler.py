@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import itertools
+
+# Bandwidth shaping of the file data the server sends
+#
+# Every download is a flow. Before one of its DATA frames goes out the flow takes the bytes
+# from the token bucket of its client and then from the global one. Flows waiting for the
+# global bucket are served in the order of their virtual finish times (self-clocked fair
+# queuing): every client gets an equal share of the rate and the transfers of one client
+# split its share. Replies, heartbeats and notices never wait here, and a waiting flow does
+# not hold its session's stream, so control frames always go out ahead of file data. With the
+# global rate a little below the uplink the queue builds up here instead of in the socket
+# buffers, and the latency of everybody else's requests stays flat while a few clients
+# download as fast as they are allowed to.
+
+QUANTUM = 0.02                  # Longest a DATA frame may take at the lowest rate, in seconds
+MIN_FRAME_SIZE = 16 << 10       # Shaped DATA frames are never smaller than this
+BURST = 0.1                     # Seconds of its rate a bucket may save up while it is idle
+PRUNE_INTERVAL = 10.0           # Seconds between looks for client buckets that are no longer needed
+
+
+class TokenBucket:
+    def __init__(self, rate, loop_time):
+        self.rate = rate                            # Bytes per second
+        self.capacity = rate * BURST
+        self.tokens = self.capacity                 # Goes below 0 when a frame larger than the tokens is let through
+        self.updated = loop_time
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        # Seconds until the bucket has paid back what it owes
+        self.refill(now)
+        return max(0.0, -self.tokens / self.rate)
+
+    def take(self, size, now):
+        self.refill(now)
+        self.tokens -= size
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+# One download, the unit fair queuing shares the rate between
+class Flow:
+    def __init__(self, scheduler, client):
+        self.scheduler = scheduler
+        self.client = client
+        self.finish = None                          # Virtual finish time of the last frame it was let through
+
+    async def acquire(self, size):
+        # Wait until size bytes of file data may go out
+        if self.scheduler.limited:
+            await self.scheduler.acquire(self, size)
+
+    def close(self):
+        self.scheduler.close(self)
+
+
+# Only used on the event loop, with --workers every worker shapes its own share of the rate
+class TransferScheduler:
+    def __init__(self, rate=None, client_rate=None):
+        self.rate = rate                            # Bytes per second all downloads share, None for no limit
+        self.client_rate = client_rate              # Bytes per second of each client, None for no limit
+        self.limited = bool(rate or client_rate)
+        self.bucket = None                          # Global bucket, created on the event loop
+        self.clients = {}                           # Client name -> its open flows
+        self.buckets = {}                           # Client name -> its bucket, kept with its debt after the client's flows closed
+        self.pruned = None                          # Loop time of the last look for buckets to drop
+        self.queue = []                             # Flows waiting for the global bucket: (finish, sequence, size, future)
+        self.sequence = itertools.count()           # Keeps the heap stable for equal finish times
+        self.virtual_time = 0.0                     # Finish time of the last frame let through
+        self.timer = None                           # Pending dispatch while the global bucket is in debt
+        self.flows = 0                              # Open flows
+        self.waited = 0.0                           # Seconds flows spent waiting for tokens
+
+    def frame_size(self, buffer_size):
+        # DATA frame size while shaping, small enough that a frame never holds the stream for long
+        rates = [rate for rate in (self.rate, self.client_rate) if rate]
+        if not rates:
+            return buffer_size
+        return min(buffer_size, max(MIN_FRAME_SIZE, int(min(rates) * QUANTUM)))
+
+    def flow(self, client):
+        self.clients[client] = self.clients.get(client, 0) + 1
+        self.flows += 1
+        return Flow(self, client)
+
+    def close(self, flow):
+        self.clients[flow.client] -= 1
+        self.flows -= 1
+        if not self.clients[flow.client]:
+            del self.clients[flow.client]
+        self.prune(asyncio.get_running_loop().time())
+
+    def prune(self, now):
+        # A bucket of a client without downloads is dropped once it is full, a new one would be the same
+        if self.pruned is not None and now - self.pruned < PRUNE_INTERVAL:
+            return
+        self.pruned = now
+        for client in [client for client, bucket in self.buckets.items() if client not in self.clients and bucket.is_full(now)]:
+            del self.buckets[client]
+
+    def queued(self):
+        return len(self.queue)
+
+    async def acquire(self, flow, size):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        if self.client_rate:
+            bucket = self.buckets.get(flow.client)
+            if bucket is None:
+                bucket = self.buckets[flow.client] = TokenBucket(self.client_rate, start)
+            delay = bucket.delay(start)
+            if delay:
+                await asyncio.sleep(delay)
+            bucket.take(size, loop.time())
+
+        if self.rate:
+            if self.bucket is None:
+                self.bucket = TokenBucket(self.rate, start)
+            # A flow is away from the queue while its frame is sent. It keeps a lag of up to BURST
+            # seconds of the rate instead of starting over at the virtual time and losing its turn.
+            begin = self.virtual_time if flow.finish is None else max(self.virtual_time - self.rate * BURST, flow.finish)
+            flow.finish = begin + size * self.clients[flow.client] # The client's share is split between its flows
+            if not self.queue and not self.bucket.delay(loop.time()):
+                self.bucket.take(size, loop.time())
+                self.virtual_time = max(self.virtual_time, flow.finish)
+            else:
+                future = loop.create_future()
+                heapq.heappush(self.queue, (flow.finish, next(self.sequence), size, future))
+                if self.timer is None:
+                    self.dispatch()
+                await future
+        self.waited += loop.time() - start
+
+    def dispatch(self):
+        # Let the waiting flows through in finish time order, as fast as the global bucket allows
+        self.timer = None
+        loop = asyncio.get_running_loop()
+        while self.queue:
+            finish, _, size, future = self.queue[0]
+            if future.done(): # Its download was cancelled while it waited
+                heapq.heappop(self.queue)
+                continue
+            delay = self.bucket.delay(loop.time())
+            if delay:
+                self.timer = loop.call_later(delay, self.dispatch)
+                return
+            heapq.heappop(self.queue)
+            self.bucket.take(size, loop.time())
+            self.virtual_time = max(self.virtual_time, finish)
+            future.set_result(None)
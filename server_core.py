@@ -0,0 +1,1595 @@
+import asyncio
+import argparse
+import collections
+import functools
+import hashlib
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import protocol
+import compression
+import delta
+import batch
+import tls
+import restart
+from catalog import Catalog
+from storage import BACKENDS, fsync_file, fsync_directory
+from cache import FileCache, DiskFile, DEFAULT_BUDGET, etag_of
+from scheduler import TransferScheduler
+from notifications import EVENTS, DEFAULT_EVENTS, NotificationBus
+from heartbeat import HeartbeatScheduler
+from registry import SessionRegistry, ShardedDict
+from cluster import Cluster
+from metrics import Metrics, EventLog
+from protocol import MAGIC, PREFACE_SIZE, HELLO, WELCOME, REQUEST, RESPONSE, DATA, END, ERROR, HEARTBEAT, NOTICE, ProtocolError, ChecksumError, TransferCancelled
+from legacy import LegacySession
+
+LEGACY_GRACE = 0.25         # Seconds a new connection may stay silent before it counts as a legacy side connection
+LEGACY_SIDE_TIMEOUT = 5     # Seconds a legacy client has to open its heartbeat and notification connections
+MAX_ACTIVE_REQUESTS = 16    # Requests of one session that are worked on at the same time
+LIST_BATCH_SIZE = 50        # Catalog entries per RESPONSE frame of a LIST reply
+SIGNATURE_BATCH_SIZE = 2000 # Block signatures per RESPONSE frame of a SIGNATURES reply
+STATS_LOG_LINES = 50        # Recent log messages in a STATS reply
+KEY_SEPARATOR = "_"         # Between the client name and the file name in a file key
+INVALID_NAME = f"Client names cannot be empty, start with '.' or contain '{KEY_SEPARATOR}', '/' or '\\'."
+
+# Headless server engine, serves every client on a single asyncio event loop
+class ServerEngine:
+    def __init__(self, storage_path, port, host="0.0.0.0", log=print, heartbeat_interval=2, backlog=1024, buffer_size=protocol.BUFFER_SIZE,
+                 rescan=False, backend="flat", heartbeat_timeout=10, worker_id=0, workers=1, metrics_port=None, metrics_host="127.0.0.1",
+                 log_rate=100, compress=True, cache_size=DEFAULT_BUDGET, rate_limit=None, client_rate_limit=None, tls_cert=None, tls_key=None,
+                 listen_fd=None, ready_fd=None, restart_argv=None, handle_signals=False, drain_timeout=restart.DRAIN_TIMEOUT, pid_file=None):
+        self.storage_path = storage_path            # Path for storing uploaded files
+        self.partial_path = os.path.join(storage_path, ".partial") # Unfinished uploads that can be resumed
+        self.port = port                            # Port to listen on
+        self.host = host                            # Interface to bind to
+        self.log = EventLog(log, rate=log_rate)     # Rate limited, passes the messages that get through on to log
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout  # Seconds a framed client may stay silent before it is disconnected
+        self.heartbeats = None                      # Created on the event loop
+        self.backlog = backlog                      # Listen backlog, large enough for reconnect storms
+        self.listen_fd = listen_fd                  # Listening socket handed over by the previous process, None to open one
+        self.ready_fd = ready_fd                    # Pipe that tells the previous process this one listens
+        self.restart_argv = restart_argv            # Command line arguments of the successor, None when SIGHUP does not restart
+        self.handle_signals = handle_signals        # SIGTERM and SIGINT drain the sessions, SIGHUP restarts
+        self.drain_timeout = drain_timeout          # Seconds sessions get to finish their requests when the server stops
+        self.pid_file = pid_file                    # Gets the process id once the server listens, follows restarts
+        self.draining = False                       # Set once the server stops accepting and waits for its sessions
+        self.drain_task = None
+        self.drain_deadline = None                  # Loop time the remaining sessions are closed at
+        self.snapshot_path = restart.snapshot_path(storage_path, worker_id) # State handed to the next process
+        self.restored_subscriptions = {}            # Events of the clients subscribed before the restart, by client name
+        self.tls_context = tls.server_context(tls_cert, tls_key) if tls_cert else None # None for a plaintext listener
+        self.buffer_size = min(buffer_size, protocol.MAX_DATA_SIZE) # Transfer buffer and DATA frame size
+        self.scheduler = TransferScheduler(rate_limit, client_rate_limit) # Shapes the file data sent, rates in bytes per second
+        self.frame_size = self.scheduler.frame_size(self.buffer_size) # Size of the DATA frames of downloads
+        self.sessions = SessionRegistry()           # Connected client sessions by client name, safe to read from other threads
+        self.notifications = NotificationBus(self.log) # Queues and delivers notifications to the connected clients
+        self.catalog = Catalog(os.path.join(storage_path, ".catalog.db")) # Uploaded files, their owners and checksums
+        self.rescan = rescan                        # Reconcile the catalog with the storage folder at startup
+        if backend == "flat" and self.catalog.blob_count():
+            raise ValueError("The storage folder holds content-addressed files, use the content backend")
+        self.storage = BACKENDS[backend](storage_path, self.catalog) # Where the contents of the files live
+        self.cache = FileCache(cache_size)          # Hot files kept in memory or mapped, only used on the event loop
+        self.active_uploads = ShardedDict()         # Keys of the files that are being uploaded right now, with the session uploading them
+        self.side_connections = collections.deque() # Silent connections waiting for a legacy client to claim them
+        self.session_tasks = {}                     # Task running each session -> the session
+        self.side_connection_added = asyncio.Event()
+        self.server = None                          # asyncio server object
+        self.loop = None                            # Event loop the engine runs on
+        self.running = False                        # Flag to control server running state
+        self.started = threading.Event()            # Set once the server is listening
+        self.stopped = threading.Event()            # Set once the server has stopped
+        self.thread = None                          # Thread running the engine, with start()
+        self.worker_id = worker_id                  # Which of the worker processes this engine is
+        self.cluster = Cluster(storage_path, worker_id, workers, self.log) if workers > 1 else None # Shared with the other workers
+        self.metrics_port = metrics_port            # Port of the Prometheus endpoint, None for none
+        self.metrics_host = metrics_host
+        self.codecs = tuple(compression.CODECS) if compress else () # Codecs transfers may be compressed with
+        self.setup_metrics()
+        os.makedirs(self.partial_path, exist_ok=True)
+
+    def setup_metrics(self):
+        metrics = self.metrics = Metrics()
+        self.bytes_received = metrics.counter("tfs_bytes_received_total", "File bytes received from clients")
+        self.bytes_sent = metrics.counter("tfs_bytes_sent_total", "File bytes sent to clients")
+        self.connections = metrics.counter("tfs_connections_total", "Sessions opened, by protocol")
+        self.errors = metrics.counter("tfs_errors_total", "Failed requests, protocol errors and heartbeat timeouts, by kind")
+        self.compressed_transfers = metrics.counter("tfs_compressed_transfers_total", "Transfers sent compressed, by codec and direction")
+        self.compression_saved = metrics.counter("tfs_compression_saved_bytes_total", "Bytes compression kept off the wire, by codec and direction")
+        self.delta_copied = metrics.counter("tfs_delta_copied_bytes_total", "Bytes of delta uploads copied from the stored version instead of sent")
+        self.tls_handshakes = metrics.counter("tfs_tls_handshakes_total", "Completed TLS handshakes, by whether they resumed a session")
+        self.cancelled_requests = metrics.counter("tfs_cancelled_requests_total", "Requests cancelled by the client, by command")
+        self.request_latency = metrics.histogram("tfs_request_seconds", "Time from request to reply or end of transfer, by command")
+        self.heartbeat_rtt = metrics.histogram("tfs_heartbeat_rtt_seconds", "Heartbeat round trip time")
+        metrics.gauge("tfs_sessions", "Connected sessions", lambda: len(self.sessions))
+        metrics.gauge("tfs_active_uploads", "Uploads in progress", lambda: len(self.active_uploads))
+        metrics.gauge("tfs_active_requests", "Requests being worked on",
+                      lambda: sum(len(getattr(session, "tasks", ())) for _, session in self.sessions.snapshot()))
+        metrics.gauge("tfs_queued_frames", "Frames waiting for a DATA body to be sent",
+                      lambda: sum(len(session.out.pending) for _, session in self.sessions.snapshot() if hasattr(session, "out")))
+        metrics.gauge("tfs_queued_notifications", "Notifications waiting to be delivered", lambda: self.notifications.queued())
+        metrics.gauge("tfs_dropped_notifications", "Notifications dropped because a queue was full", lambda: self.notifications.dropped)
+        metrics.gauge("tfs_side_connections", "Silent connections waiting for a legacy client", lambda: len(self.side_connections))
+        metrics.counter_value("tfs_cache_hits_total", "Downloads served from the file cache", lambda: self.cache.hits)
+        metrics.counter_value("tfs_cache_misses_total", "Downloads of files the cache did not hold", lambda: self.cache.misses)
+        metrics.counter_value("tfs_cache_evictions_total", "Files evicted from the cache to stay within its budget", lambda: self.cache.evictions)
+        metrics.gauge("tfs_cache_hit_ratio", "Fraction of downloads served from the file cache", lambda: self.cache.hit_ratio())
+        metrics.gauge("tfs_cache_bytes", "Bytes of file contents in the cache", lambda: self.cache.used)
+        metrics.gauge("tfs_cache_files", "Files in the cache", lambda: len(self.cache))
+        metrics.gauge("tfs_shaped_transfers", "Downloads sharing the rate limits", lambda: self.scheduler.flows)
+        metrics.gauge("tfs_shaping_queue", "DATA frames waiting for the global rate limit", lambda: self.scheduler.queued())
+        metrics.counter_value("tfs_shaping_wait_seconds_total", "Seconds downloads waited for the rate limits", lambda: self.scheduler.waited)
+        metrics.gauge("tfs_dropped_log_messages", "Log messages dropped by the rate limit", lambda: self.log.dropped)
+
+    async def import_files(self):
+        # Bring files that were in the storage folder before the catalog into it, clients are served in between batches
+        for _ in self.catalog.import_directory(self.storage_path, prune=self.rescan, path=self.storage.path):
+            await asyncio.sleep(0)
+        if self.rescan:
+            self.storage.collect_garbage()
+            self.cache.clear()
+        self.log(f"Catalog holds {self.catalog.count()} files.")
+
+    async def serve(self):
+        # Start listening and serve clients until the server is closed
+        self.loop = asyncio.get_running_loop()
+        heartbeat_task = sweep_task = metrics_server = None
+        try:
+            if self.listen_fd is not None: # Accepts on the socket of the previous process, connections waiting in its backlog included
+                address = dict(sock=socket.socket(fileno=self.listen_fd))
+            else:
+                address = dict(host=self.host, port=self.port, reuse_port=self.cluster is not None) # Workers share the port, the kernel spreads the connections
+            try:
+                self.server = await asyncio.start_server(self.accept_connection, **address, backlog=self.backlog, limit=self.buffer_size,
+                                                         ssl=self.tls_context, ssl_handshake_timeout=self.tls_context and tls.HANDSHAKE_TIMEOUT)
+            except OSError as e:
+                self.log(f"Could not listen on port {self.port}: {str(e)}")
+                return
+            self.port = self.server.sockets[0].getsockname()[1] # Resolves port 0 to the port picked by the OS
+            self.running = True
+            self.log(f"Server started on port {self.port}" + (" with TLS" if self.tls_context else "")
+                     + (f", taking over from process {os.getppid()}" if self.listen_fd is not None else ""))
+            self.restore_snapshot()
+            if self.handle_signals:
+                for signum in (signal.SIGTERM, signal.SIGINT):
+                    self.loop.add_signal_handler(signum, self.shutdown)
+                if self.restart_argv is not None:
+                    self.loop.add_signal_handler(signal.SIGHUP, self.shutdown, True)
+            if self.pid_file:
+                with open(self.pid_file, "w") as f:
+                    f.write(f"{os.getpid()}\n")
+            if self.ready_fd is not None:
+                restart.notify_ready(self.ready_fd)
+            self.started.set()
+            self.heartbeats = HeartbeatScheduler(self.heartbeat_interval, self.heartbeat_timeout, self.evict, self.log)
+            if self.metrics_port is not None:
+                try:
+                    metrics_server = await self.metrics.serve(self.metrics_host, self.metrics_port)
+                    self.log(f"Metrics on http://{self.metrics_host}:{metrics_server.sockets[0].getsockname()[1]}/metrics")
+                except OSError as e:
+                    self.log(f"Could not serve the metrics on port {self.metrics_port}: {str(e)}")
+            heartbeat_task = asyncio.create_task(self.heartbeats.run())
+            sweep_task = asyncio.create_task(self.sweep_side_connections())
+            if self.cluster:
+                self.cluster.start(self.loop, self.receive_forwarded)
+            if self.worker_id == 0 and (self.rescan or not self.catalog.is_imported()):
+                asyncio.create_task(self.import_files())
+            try:
+                async with self.server:
+                    await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+            if self.drain_task: # The listener was closed to drain, the sessions are still served
+                await self.drain_task
+        finally:
+            self.running = False
+            for task in (heartbeat_task, sweep_task):
+                if task:
+                    task.cancel()
+            if metrics_server:
+                metrics_server.close()
+            if self.cluster:
+                self.cluster.close()
+            self.log("Server stopped.")
+            self.stopped.set()
+
+    def run(self):
+        # Run the engine on the calling thread until it is stopped
+        asyncio.run(self.serve())
+
+    def start(self):
+        # Run the engine on a background thread, used by the GUI front end
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def is_stopped(self):
+        # Also true when the engine thread died before it could say so
+        return self.stopped.is_set() or (self.thread is not None and not self.thread.is_alive())
+
+    def stop(self):
+        # Thread-safe request to stop the server right away, transfers in progress are cut off
+        if self.loop and self.server and not self.stopped.is_set():
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    def shutdown(self, restart=False):
+        # Thread-safe request to stop gracefully, with restart after handing the listening socket to a successor
+        #
+        # Asking again while the sessions drain closes the remaining ones right away.
+        if self.loop and not self.stopped.is_set():
+            try:
+                self.loop.call_soon_threadsafe(self.begin_drain, restart)
+            except RuntimeError: # The loop closed in between
+                pass
+
+    def begin_drain(self, handover):
+        if self.drain_task is None or self.drain_task.done():
+            self.drain_task = asyncio.create_task(self.drain(handover))
+        elif self.draining:
+            self.drain_deadline = self.loop.time()
+
+    async def drain(self, handover):
+        # Stop accepting connections, let the requests in progress finish and close the sessions
+        #
+        # A restart first starts the successor, and the server goes on as before when it fails.
+        if not self.running:
+            return
+        self.save_snapshot()
+        if handover:
+            if len(self.server.sockets) != 1:
+                self.log("Restart needs a single listening socket, use --host with one address.")
+                return
+            self.log("Restarting, starting the new server process.")
+            process = await asyncio.to_thread(restart.spawn_successor, self.restart_argv, [self.server.sockets[0].fileno()])
+            if process is None:
+                self.log("The new server process did not start, this one goes on serving.")
+                return
+            self.log(f"Process {process.pid} took over the port.")
+        self.draining = True
+        self.drain_deadline = self.loop.time() + self.drain_timeout
+        self.server.close() # Ends serve_forever, serve() waits for this task
+        while self.side_connections:
+            self.side_connections.popleft()[1].close()
+
+        if handover:
+            notice = {"message": "The server is restarting, reconnect once your transfers are done.", "event": "restart", "reconnect": True}
+        else:
+            notice = {"message": "The server is shutting down.", "event": "shutdown", "reconnect": False}
+        sessions = self.sessions.snapshot()
+        self.log(f"Draining {len(sessions)} sessions.")
+        announcements = [asyncio.create_task(self.announce(session, notice)) for _, session in sessions] # A client that is not reading holds up only its own
+
+        idle_since = {}
+        while len(self.sessions) and self.loop.time() < self.drain_deadline:
+            now = self.loop.time()
+            for client_name, session in self.sessions.snapshot():
+                if not session.is_idle():
+                    idle_since.pop(session, None)
+                elif now - idle_since.setdefault(session, now) >= restart.DRAIN_IDLE:
+                    self.disconnect_client(client_name, session)
+            await asyncio.sleep(restart.DRAIN_POLL)
+        remaining = self.sessions.snapshot()
+        if remaining:
+            self.log(f"Closed {len(remaining)} sessions that were still busy after {self.drain_timeout:g}s.")
+        for client_name, session in remaining:
+            self.disconnect_client(client_name, session)
+
+        # A TLS connection is only done once the client answered the close, cut off the ones that do not
+        if self.session_tasks:
+            await asyncio.wait(list(self.session_tasks), timeout=restart.CLOSE_TIMEOUT)
+        for session in list(self.session_tasks.values()):
+            session.abort()
+        if self.session_tasks:
+            await asyncio.wait(list(self.session_tasks), timeout=restart.CLOSE_TIMEOUT)
+        if announcements: # Done by now, their connections are closed
+            _, pending = await asyncio.wait(announcements, timeout=restart.CLOSE_TIMEOUT)
+            for task in pending:
+                task.cancel()
+
+    async def announce(self, session, notice):
+        # Tell a client that the server is going away, like NotificationBus.deliver it gives up on a closed connection
+        try:
+            await session.deliver(notice)
+        except (ConnectionError, RuntimeError) as e:
+            self.log(f"Could not notify {session.client_name}: {str(e) or type(e).__name__}")
+
+    def save_snapshot(self):
+        # State the next process would otherwise have to build up again
+        subscriptions = {client_name: sorted(subscriber.events) for client_name, subscriber in self.notifications.subscribers.items()}
+        try:
+            restart.save_snapshot(self.snapshot_path, {"cache": self.cache.snapshot(), "subscriptions": subscriptions})
+        except OSError as e:
+            self.log(f"Could not save the snapshot: {str(e)}")
+
+    def restore_snapshot(self):
+        state = restart.load_snapshot(self.snapshot_path)
+        if state is None:
+            return
+        self.restored_subscriptions = {client_name: [event for event in events if event in EVENTS]
+                                       for client_name, events in state.get("subscriptions", {}).items()}
+        cache = state.get("cache", {})
+        asyncio.create_task(self.warm_cache(cache.get("entries", []), cache.get("seen", [])))
+        self.log(f"Restored the state of process {state.get('pid')}: {len(cache.get('entries', []))} cached files, "
+                 f"{len(self.restored_subscriptions)} subscriptions.")
+
+    async def warm_cache(self, keys, seen):
+        # Cache the files the previous process had cached, least recently used first like they were
+        for file_key in keys:
+            try:
+                with open(self.file_path(file_key), "rb") as f:
+                    checksum = (self.catalog.get(file_key) or {}).get("checksum")
+                    self.cache.put(file_key, f, os.fstat(f.fileno()), checksum, admit=True)
+            except (OSError, ValueError):
+                pass # Deleted or replaced in between
+            await asyncio.sleep(0)
+        self.cache.remember(seen)
+
+    async def accept_connection(self, reader, writer):
+        # Every connection is a client on its own, except the silent heartbeat and notification connections of legacy clients
+        #
+        # With TLS the handshake is done by the time a connection gets here.
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is not None:
+            self.tls_handshakes.inc(resumed=str(ssl_object.session_reused).lower())
+        try:
+            opening = await asyncio.wait_for(self.read_opening(reader), LEGACY_GRACE)
+        except asyncio.TimeoutError:
+            self.side_connections.append((self.loop.time(), writer))
+            self.side_connection_added.set()
+            return
+        except ConnectionError:
+            writer.close()
+            return
+        await self.handle_client(opening, reader, writer)
+
+    async def claim_side_connection(self):
+        # Legacy clients connect the heartbeat and notification sockets right after sending their name
+        deadline = self.loop.time() + LEGACY_SIDE_TIMEOUT
+        while True:
+            self.expire_side_connections()
+            if self.side_connections:
+                return self.side_connections.popleft()[1]
+            self.side_connection_added.clear()
+            await asyncio.wait_for(self.side_connection_added.wait(), max(deadline - self.loop.time(), 0))
+
+    def expire_side_connections(self):
+        while self.side_connections and self.loop.time() - self.side_connections[0][0] > LEGACY_SIDE_TIMEOUT:
+            self.side_connections.popleft()[1].close()
+
+    async def read_opening(self, reader):
+        # A framed client sends the preface and waits for ours, a legacy client sends its name
+        data = await reader.read(1024)
+        if not data:
+            raise ConnectionError("Connection closed before the handshake")
+        while 0 < len(data) < PREFACE_SIZE and MAGIC.startswith(data[:len(MAGIC)]):
+            try:
+                more = await asyncio.wait_for(reader.read(PREFACE_SIZE - len(data)), 0.5)
+            except asyncio.TimeoutError:
+                break # A short legacy name that happens to look like the magic
+            if not more:
+                break
+            data += more
+        return data
+
+    async def handle_client(self, opening, reader, writer):
+        # Work out which protocol the client speaks and run its session
+        writers = [writer]
+        try:
+            if opening.startswith(MAGIC):
+                session = await self.open_framed_session(opening, reader, writer)
+            else:
+                writers.append(await self.claim_side_connection())   # Heartbeat connection
+                writers.append(await self.claim_side_connection())   # Notification connection
+                session = self.open_legacy_session(opening, reader, *writers)
+        except (ConnectionError, ProtocolError, UnicodeDecodeError, asyncio.TimeoutError) as e:
+            self.log(f"Rejected a connection: {str(e) or type(e).__name__}", error=type(e).__name__)
+            session = None
+        if session is None:
+            for writer in writers:
+                writer.close()
+            return
+
+        task = asyncio.current_task()
+        self.session_tasks[task] = session
+        try:
+            await session.run()
+        finally:
+            self.disconnect_client(session.client_name, session) # Clean up on disconnect
+            del self.session_tasks[task]
+
+    def open_legacy_session(self, opening, reader, command_writer, heartbeat_writer, notification_writer):
+        client_name = opening.decode()
+        if not valid_client_name(client_name):
+            self.log(f"Rejected the client name {client_name!r}.")
+            command_writer.write(f"ERROR: {INVALID_NAME}".encode())
+            return None
+        if not self.reserve_name(client_name):
+            command_writer.write("ERROR: Name already in use.".encode())
+            return None
+        session = LegacySession(self, client_name, reader, command_writer, heartbeat_writer, notification_writer)
+        self.sessions.attach(client_name, session)
+        self.notifications.subscribe(client_name, session, self.restored_subscriptions.pop(client_name, DEFAULT_EVENTS))
+        self.heartbeats.add(session)
+        self.connections.inc(protocol="legacy")
+        self.log(f"{client_name} connected.", client=client_name, protocol="legacy")
+        return session
+
+    async def open_framed_session(self, opening, reader, writer):
+        if len(opening) != PREFACE_SIZE:
+            raise ProtocolError("Client sent data before the handshake completed")
+        version = protocol.negotiate(opening)
+        writer.write(protocol.preface(version))
+        if not version:
+            raise ProtocolError(f"No common protocol version with client version {opening[-1]}")
+
+        hello = await protocol.read_frame(reader)
+        if hello is None or hello.type != HELLO:
+            raise ProtocolError("Expected HELLO frame")
+        hello = hello.message()
+        client_name = str(hello.get("name", ""))
+        if not valid_client_name(client_name):
+            self.log(f"Rejected the client name {client_name!r}.")
+            writer.write(protocol.encode_message(ERROR, 0, {"error": f"ERROR: {INVALID_NAME}"}, version))
+            return None
+        if not self.reserve_name(client_name):
+            writer.write(protocol.encode_message(ERROR, 0, {"error": "ERROR: Name already in use."}, version))
+            return None
+        codecs = tuple(compression.agree(hello.get("compression"), self.codecs))
+        session = FramedSession(self, client_name, version, reader, writer, codecs)
+        self.sessions.attach(client_name, session)
+        self.notifications.subscribe(client_name, session, self.restored_subscriptions.pop(client_name, DEFAULT_EVENTS))
+        self.heartbeats.add(session)
+        self.connections.inc(protocol="framed")
+        self.log(f"{client_name} connected.", client=client_name, protocol="framed")
+        session.send_message(WELCOME, 0, {"message": "Welcome to the server!", "version": version, "compression": codecs})
+        return session
+
+    def reserve_name(self, client_name):
+        # Take the client name if it is free, the session is attached to it once it is set up
+        if client_name and self.sessions.reserve(client_name):
+            if self.cluster is None or self.cluster.claim(f"session:{client_name}"):
+                return True
+            self.sessions.release(client_name) # Connected to another worker
+        self.log(f"{client_name} is already in use. The new client was not accepted.")
+        return False
+
+    def claim_upload(self, file_key, session):
+        # Only one upload of a file at a time, two writers would mix their data in one partial file
+        if not self.active_uploads.add(file_key, session):
+            return False
+        if self.cluster and not self.cluster.claim(f"upload:{file_key}"):
+            self.active_uploads.pop(file_key)
+            return False
+        return True
+
+    def release_upload(self, file_key):
+        self.active_uploads.pop(file_key)
+        if self.cluster:
+            self.cluster.release(f"upload:{file_key}")
+
+    async def sweep_side_connections(self):
+        # Close silent connections that no legacy client claimed
+        while self.running:
+            self.expire_side_connections()
+            await asyncio.sleep(LEGACY_SIDE_TIMEOUT)
+
+    def evict(self, session):
+        # Called by the heartbeat scheduler for sessions that closed or stopped answering
+        if not session.is_closing():
+            self.errors.inc(kind="heartbeat_timeout")
+        self.disconnect_client(session.client_name, session)
+
+    def disconnect_client(self, client_name, session):
+        if self.sessions.release(client_name, session):
+            if self.cluster:
+                self.cluster.release(f"session:{client_name}")
+            self.log(f"{client_name} has been disconnected.", client=client_name)
+        self.notifications.unsubscribe(client_name, session)
+        self.heartbeats.remove(session)
+        session.close()
+
+    def notify_download(self, owner, filename, client_name):
+        # Notify the owner of the file about the download only if the downloader is not the owner
+        if owner == client_name:
+            return
+        self.notifications.publish("download", filename, client_name, owner=owner)
+        if self.cluster and self.sessions.get(owner) is None:
+            worker_id = self.cluster.worker_of(f"session:{owner}")
+            if worker_id is not None:
+                self.cluster.forward({"event": "download", "filename": filename, "client": client_name, "owner": owner}, worker_id)
+
+    def notify_change(self, event, file_key, client_name):
+        # Tell the subscribed clients about an upload, overwrite or delete
+        self.notifications.publish(event, file_key, client_name)
+        if self.cluster:
+            self.cluster.forward({"event": event, "filename": file_key, "client": client_name})
+
+    def receive_forwarded(self, message):
+        # An event from another worker for clients connected to this one, a file it changed is dropped from the cache
+        if message.get("event") != "download":
+            self.cache.invalidate(message.get("filename"))
+        self.notifications.publish(message.get("event"), message.get("filename"), message.get("client"), owner=message.get("owner"))
+
+    def file_key(self, client_name, filename):
+        # Client names never contain the separator, so the owner is everything before the first one
+        return f"{client_name}{KEY_SEPARATOR}{filename}"
+
+    def may_write(self, file_key, client_name):
+        # Only the owner of a file may replace it, keys of files from before the name rules can collide
+        return self.owner_of(file_key) in (None, client_name)
+
+    def file_path(self, file_key):
+        # Keys come from clients, never let them point outside the storage folder
+        if not file_key or os.path.basename(file_key) != file_key or file_key.startswith("."):
+            raise ValueError(f"Invalid file name: {file_key}")
+        return self.storage.path(file_key)
+
+    def partial_file(self, file_key):
+        # Uploads are written here and renamed into place once complete, the metadata says which upload it belongs to
+        return os.path.join(self.partial_path, f"{file_key}.part")
+
+    def partial_state(self, file_key):
+        # Declared size, etag and committed offset of an unfinished upload, None if there is none
+        partial_file = self.partial_file(file_key)
+        try:
+            with open(f"{partial_file}.json") as f:
+                state = json.load(f)
+            state["offset"] = os.path.getsize(partial_file)
+        except (OSError, ValueError):
+            return None
+        return state
+
+    def begin_partial(self, file_key, file_size, etag, resume):
+        # Open the partial file of an upload, returns the file and the offset the data continues from
+        partial_file = self.partial_file(file_key)
+        state = self.partial_state(file_key) if resume else None
+        if state and state.get("size") == file_size and state.get("etag") == etag:
+            offset = min(state["offset"], file_size)
+            f = open(partial_file, "r+b")
+            f.truncate(offset)
+            f.seek(offset)
+            return f, offset
+        f = open(partial_file, "wb")
+        with open(f"{partial_file}.json", "w") as meta:
+            json.dump({"size": file_size, "etag": etag}, meta)
+        return f, 0
+
+    async def commit_partial(self, file_key, owner, filename, checksum):
+        # Hand a finished upload to the storage backend, which moves it into place and records it in the catalog
+        #
+        # The data is flushed to disk before the rename and the folder after it, so after a crash
+        # the key has either the old or the new contents, never a part of them. The flushes run on
+        # a worker thread, the rename and the catalog update on the event loop, so a download sees
+        # the file and its checksum change together.
+        self.file_path(file_key)
+        partial_file = self.partial_file(file_key)
+        await asyncio.to_thread(fsync_file, partial_file)
+        path = self.storage.commit(file_key, partial_file, owner, filename, checksum)
+        self.cache.invalidate(file_key)
+        self.discard_partial(file_key)
+        await asyncio.to_thread(fsync_directory, os.path.dirname(path))
+
+    async def commit_batch(self, files, owner):
+        # commit_partial for the (key, filename, checksum) files of a batch upload
+        #
+        # Flushes and renames happen in the same order, but for the whole batch at once: one
+        # worker thread flushes the data of every file, the catalog records them in one
+        # transaction and each folder they went into is flushed once.
+        partial_files = [self.partial_file(file_key) for file_key, _, _ in files]
+        await asyncio.to_thread(flush_all, fsync_file, partial_files)
+        paths = self.storage.commit_many([(file_key, partial_file, owner, filename, checksum)
+                                          for (file_key, filename, checksum), partial_file in zip(files, partial_files)])
+        for file_key, _, _ in files:
+            self.cache.invalidate(file_key)
+            self.discard_partial(file_key)
+        await asyncio.to_thread(flush_all, fsync_directory, {os.path.dirname(path) for path in paths})
+
+    def link_existing(self, file_key, owner, filename, checksum, size):
+        # Store a file from contents the backend already has, returns False when it has not
+        if not self.storage.link_existing(file_key, owner, filename, checksum, size):
+            return False
+        self.cache.invalidate(file_key)
+        return True
+
+    def discard_partial(self, file_key):
+        partial_file = self.partial_file(file_key)
+        for path in (partial_file, f"{partial_file}.json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def hash_prefix(self, path, length):
+        # sha256 state of the first `length` bytes of a file, used when an upload is resumed
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            while length > 0:
+                chunk = f.read(min(self.buffer_size, length))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                length -= len(chunk)
+        return hasher
+
+    def file_exists(self, file_key):
+        return self.catalog.get(file_key) is not None
+
+    def owner_of(self, file_key):
+        # Owner recorded in the catalog, the owner named in a request is only what the client claims
+        entry = self.catalog.get(file_key)
+        return entry["owner"] if entry else None
+
+    def list_files(self):
+        return self.catalog.list()
+
+    def delete_file(self, file_key):
+        self.file_path(file_key)
+        self.cache.invalidate(file_key)
+        self.storage.delete(file_key)
+
+    def cached(self, file_key):
+        # Cache entry of a file, None when there is none or it is not the version in the catalog
+        #
+        # Another worker that replaced the file forwards an invalidation, which can arrive after
+        # the next download. The catalog is shared and always current, so with --workers it decides.
+        entry = self.cache.get(file_key)
+        if entry is None or self.cluster is None:
+            return entry
+        row = self.catalog.get(file_key)
+        if (row is None or row["checksum"] != entry.checksum or row["size"] != entry.size
+                or row["checksum"] is None and row["mtime"] != entry.mtime): # Imported files have no checksum to go by
+            self.cache.invalidate(file_key)
+            return None
+        return entry
+
+    def open_file(self, file_key):
+        # Contents of a file to send, from the cache when it holds them, otherwise a DiskFile
+        entry = self.cached(file_key)
+        if entry is not None:
+            return entry
+        f = open(self.file_path(file_key), "rb")
+        try:
+            stat = os.fstat(f.fileno())
+            checksum = (self.catalog.get(file_key) or {}).get("checksum")
+            entry = self.cache.put(file_key, f, stat, checksum)
+        except BaseException:
+            f.close()
+            raise
+        if entry is None:
+            return DiskFile(f, stat, checksum)
+        f.close()
+        return entry
+
+    def batch_source(self, file_key):
+        # A file of a batch download: how to read it, its size, etag and checksum
+        #
+        # Cached contents are read from memory. Other files are only looked at here and opened
+        # when the stream reaches them, so a batch never holds more than one of them open.
+        entry = self.cached(file_key)
+        if entry is not None:
+            return functools.partial(entry.reader, 0), entry.size, entry.etag, entry.checksum
+        path = self.file_path(file_key)
+        stat = os.stat(path)
+        checksum = (self.catalog.get(file_key) or {}).get("checksum")
+        return functools.partial(open, path, "rb"), stat.st_size, etag_of(stat), checksum
+
+
+# Serializes frames from every channel of a session onto its one stream
+class FrameWriter:
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = asyncio.Lock()  # Held while a frame body is being sent, sendfile needs the transport to itself
+        self.pending = []           # Small frames written while the stream was busy
+
+    def write(self, data):
+        # Never waits, frames written while the stream is busy go out as soon as it is free
+        if self.lock.locked():
+            self.pending.append(data)
+        else:
+            self.writer.write(data)
+
+    async def __aenter__(self):
+        await self.lock.acquire()
+        return self.writer
+
+    async def __aexit__(self, *exc_info):
+        for data in self.pending:
+            self.writer.write(data)
+        self.pending.clear()
+        self.lock.release()
+
+
+# Destination of an upload's DATA frames, filled by the session's receive loop
+class UploadSink:
+    def __init__(self, f, hasher, expected, codecs=(), limit=protocol.BUFFER_SIZE, base=None):
+        self.file = f
+        self.hasher = hasher        # sha256 of the data, computed as it streams in
+        self.expected = expected    # Bytes the client said it would send
+        self.codecs = codecs        # Codecs the client may compress the data with
+        self.limit = limit          # Largest piece of decompressed data written at once
+        self.decompressor = None    # Set by the first compressed DATA frame
+        self.received = 0           # Bytes received so far, after decompression
+        self.wire_bytes = 0         # Bytes received so far as they came over the connection
+        self.checksum = None        # sha256 the client computed while sending, from the END frame
+        self.base = base            # Stored version a delta upload copies ranges from
+        self.copied = 0             # Bytes copied from it
+        self.error = None           # Error while writing, the rest of the data is still drained
+        self.done = asyncio.get_running_loop().create_future() # Resolved by the END frame
+
+    def receive(self, data, codec_id):
+        # Payload of a DATA frame, raw or compressed with the codec named by its flags
+        self.wire_bytes += len(data)
+        if self.decompressor is None and not codec_id:
+            self.write(data)
+            return
+        if self.decompressor is None:
+            self.decompressor = compression.decompressor(codec_id, self.limit)
+            if self.decompressor.codec.name not in self.codecs:
+                raise ProtocolError(f"Codec {self.decompressor.codec.name} was not agreed on")
+        elif codec_id != self.decompressor.codec.id:
+            raise ProtocolError("Compression changed in the middle of an upload")
+        if self.error is None:
+            try:
+                self.decompressor.feed(data, self.write_decompressed)
+            except (ProtocolError, ValueError) as e:
+                self.error = e
+
+    async def copy(self, offset, length):
+        # A range of the stored version, read and written on a worker thread
+        if self.base is None:
+            raise ProtocolError("Copy frame outside a delta upload")
+        if self.error is not None:
+            return
+        if offset + length > self.base.size or self.received + length > self.expected:
+            self.error = ValueError(f"Copy of {length} bytes at {offset} is out of range")
+            return
+        await asyncio.to_thread(self.copy_range, offset, length)
+        self.copied += length
+
+    def copy_range(self, offset, length):
+        reader = self.base.reader(offset)
+        while length > 0 and self.error is None:
+            data = reader.read(min(self.limit, length))
+            if not data:
+                self.error = ValueError("Stored version is shorter than it was")
+                return
+            self.write(data)
+            length -= len(data)
+
+    def write_decompressed(self, data):
+        # Stops a stream that decompresses to more than was declared, before it fills the disk
+        self.write(data)
+        if self.received > self.expected:
+            raise ValueError(f"Upload decompresses to more than {self.expected} bytes")
+
+    def write(self, data):
+        self.received += len(data)
+        if self.error is None:
+            try:
+                self.file.write(data)
+                self.hasher.update(data)
+            except OSError as e:
+                self.error = e
+
+    def finish(self, message):
+        checksum = message.get("sha256")
+        if checksum is not None:
+            self.checksum = str(checksum)
+        if self.decompressor is not None and self.error is None:
+            try:
+                self.decompressor.finish(self.write_decompressed)
+            except (ProtocolError, ValueError) as e:
+                self.error = e
+        if not self.done.done():
+            self.done.set_result(None)
+
+    def abort(self, error):
+        if not self.done.done():
+            self.done.set_exception(error)
+
+
+# Destination of a batch upload, a StreamSplitter cuts the stream into the partial files of its members
+class BatchSink(UploadSink):
+    def __init__(self, splitter, expected, codecs=(), limit=protocol.BUFFER_SIZE):
+        super().__init__(splitter, None, expected, codecs, limit)
+        self.checksums = None       # sha256 of every file the client computed while sending, from the END frame
+
+    def write(self, data):
+        self.received += len(data)
+        if self.error is None:
+            try:
+                self.file.write(data)
+            except (OSError, ValueError) as e:
+                self.error = e
+
+    def finish(self, message):
+        checksums = message.get("sha256")
+        if isinstance(checksums, list):
+            self.checksums = [str(checksum) for checksum in checksums]
+        super().finish({})
+
+
+# Session for clients that speak the length-prefixed framed protocol, all channels share one connection
+#
+# Every request runs in its own task, so several transfers can be in flight at once. Their
+# DATA frames interleave on the connection: the FrameWriter lock takes turns between the
+# downloads, and the receive loop hands upload data to the UploadSink of its request id.
+class FramedSession:
+    def __init__(self, engine, client_name, version, reader, writer, codecs=()):
+        self.engine = engine
+        self.client_name = client_name
+        self.version = version                      # Negotiated protocol version
+        self.codecs = codecs                        # Compression codecs agreed with the client
+        self.reader = reader
+        self.command_writer = writer
+        self.out = FrameWriter(writer)
+        self.loop = asyncio.get_running_loop()
+        self.tasks = {}                             # Running requests by request id
+        self.uploads = {}                           # Sinks of the uploads waiting for data by request id
+        self.cancelled = set()                      # Ids of the running requests the client cancelled
+        self.slots = asyncio.Semaphore(MAX_ACTIVE_REQUESTS)
+        self.answers_heartbeats = True              # Clients echo every heartbeat
+        self.last_seen = self.loop.time()           # Loop time of the last frame from the client
+        self.rtt = None                             # Smoothed heartbeat round trip time in seconds
+        self.handlers = {
+            "LIST": self.send_file_list,
+            "UPLOAD": self.handle_upload,
+            "DOWNLOAD": self.handle_download,
+            "DELETE": self.handle_delete,
+            "UPLOAD_STATUS": self.send_upload_status,
+            "SUBSCRIBE": self.handle_subscribe,
+            "STATS": self.send_stats,
+            "SIGNATURES": self.send_signatures,
+            "BATCH_UPLOAD": self.handle_batch_upload,
+            "BATCH_DOWNLOAD": self.handle_batch_download,
+        }
+
+    def send_message(self, frame_type, request_id, message):
+        self.out.write(protocol.encode_message(frame_type, request_id, message, self.version))
+
+    def send_error(self, request_id, text):
+        self.engine.errors.inc(kind="request")
+        self.send_message(ERROR, request_id, {"error": text})
+
+    def heartbeat(self, now):
+        # The client sends the frame back as it is, which gives the round trip time
+        self.send_message(HEARTBEAT, 0, {"time": now})
+
+    async def deliver(self, notice):
+        # Called by the notification bus, waits while the client is not reading
+        self.send_message(NOTICE, 0, notice)
+        await self.command_writer.drain()
+
+    def is_closing(self):
+        return self.command_writer.is_closing()
+
+    def is_idle(self):
+        # No request in progress, the session can be closed without breaking a transfer
+        return not self.tasks
+
+    def close(self):
+        self.command_writer.close()
+
+    def abort(self):
+        self.command_writer.transport.abort()
+
+    async def run(self):
+        # Receive loop: starts a task for every request and feeds upload data to its sink
+        try:
+            while True:
+                frame = await protocol.read_header(self.reader)
+                if frame is None: # Client disconnected
+                    break
+                self.last_seen = self.loop.time()
+                if frame.type in (DATA, END):
+                    await self.receive_upload_frame(frame)
+                    continue
+                await protocol.read_payload(self.reader, frame)
+                if frame.type == HEARTBEAT:
+                    rtt = self.engine.heartbeats.answered(self, frame.message())
+                    if rtt is not None:
+                        self.engine.heartbeat_rtt.observe(rtt)
+                    continue
+                if frame.type != REQUEST:
+                    raise ProtocolError(f"Unexpected frame type {frame.type}")
+                request = frame.message()
+                command = request.get("cmd")
+                if command == "EXIT":
+                    break
+                if command == "CANCEL": # Carries the id of the request to stop
+                    self.cancel(frame.request_id)
+                    continue
+                handler = self.handlers.get(command) if isinstance(command, str) else None # A list or object is not hashable
+                if handler is None:
+                    self.send_error(frame.request_id, f"ERROR: Unknown command {command}.")
+                    continue
+                if frame.request_id in self.tasks:
+                    raise ProtocolError(f"Request id {frame.request_id} is already in use")
+                self.tasks[frame.request_id] = asyncio.create_task(self.run_request(handler, frame.request_id, request))
+        except ProtocolError as e:
+            self.engine.errors.inc(kind="protocol")
+            self.engine.log(f"Protocol error from {self.client_name}: {str(e)}", client=self.client_name, error="protocol")
+        except ConnectionError:
+            pass
+        finally:
+            for upload in list(self.uploads.values()):
+                upload.abort(ConnectionError("Client disconnected during upload"))
+            for task in list(self.tasks.values()):
+                task.cancel()
+
+    def cancel(self, request_id):
+        # An upload stops waiting for data right away, a download before its next DATA frame
+        #
+        # Either way the request ends with an ERROR frame. A request that has finished
+        # already has its END or ERROR frame on the way, the client waits for that instead.
+        if request_id not in self.tasks:
+            return
+        self.cancelled.add(request_id)
+        upload = self.uploads.pop(request_id, None)
+        if upload is not None:
+            upload.abort(TransferCancelled(f"Upload {request_id} cancelled"))
+
+    def check_cancelled(self, request_id):
+        if request_id in self.cancelled:
+            raise TransferCancelled(f"Download {request_id} cancelled")
+
+    async def run_request(self, handler, request_id, request):
+        start = self.loop.time()
+        try:
+            async with self.slots:
+                await handler(request_id, request)
+            self.engine.request_latency.observe(self.loop.time() - start, command=request["cmd"])
+        except TransferCancelled:
+            self.engine.cancelled_requests.inc(command=request["cmd"])
+            self.engine.log(f"{request['cmd']} from {self.client_name} cancelled.", client=self.client_name, cmd=request["cmd"])
+            self.send_message(ERROR, request_id, {"error": "ERROR: Cancelled."})
+        except ConnectionError:
+            self.close() # The receive loop notices and ends the session
+        except Exception as e:
+            self.engine.log(f"Error during {request.get('cmd')} from {self.client_name}: {str(e)}", client=self.client_name,
+                            cmd=request.get("cmd"), error=type(e).__name__)
+            self.send_error(request_id, "ERROR: Request failed.")
+        finally:
+            self.tasks.pop(request_id, None)
+            self.cancelled.discard(request_id)
+
+    async def receive_upload_frame(self, frame):
+        # Hand the payload to the upload's sink as it arrives, DATA frames are never buffered whole
+        upload = self.uploads.get(frame.request_id)
+        if upload is None:
+            raise ProtocolError(f"Unexpected upload data for request {frame.request_id}")
+        if frame.type == END:
+            await protocol.read_payload(self.reader, frame)
+            del self.uploads[frame.request_id]
+            upload.finish(frame.message() if frame.length else {})
+            return
+        if frame.flags & protocol.DELTA_COPY:
+            if frame.length != protocol.COPY_RANGE.size:
+                raise ProtocolError(f"Copy frame of {frame.length} bytes")
+            await protocol.read_payload(self.reader, frame)
+            await upload.copy(*protocol.COPY_RANGE.unpack(frame.payload))
+            return
+        remaining = frame.length
+        while remaining:
+            data = await self.reader.read(min(remaining, self.engine.buffer_size))
+            if not data:
+                raise ConnectionError("Client disconnected during upload")
+            remaining -= len(data)
+            self.engine.bytes_received.inc(len(data))
+            upload.receive(data, frame.flags & protocol.CODEC_FLAGS)
+
+    async def send_file_list(self, request_id, request):
+        # One page of the catalog, streamed as RESPONSE frames of a few entries and closed by END with the next cursor
+        try:
+            page_size = min(max(int(request.get("page_size", protocol.LIST_PAGE_SIZE)), 1), protocol.MAX_LIST_PAGE_SIZE)
+            entries, cursor = self.engine.catalog.page(
+                owner=request.get("owner"), pattern=request.get("pattern"), prefix=request.get("prefix"),
+                sort=request.get("sort", "key"), descending=bool(request.get("descending")),
+                limit=page_size, cursor=request.get("cursor"))
+        except (TypeError, ValueError) as e:
+            self.engine.log(f"Invalid file list request from {self.client_name}: {str(e)}")
+            self.send_error(request_id, "ERROR: Invalid file list request.")
+            return
+
+        async with self.out as writer:
+            for start in range(0, len(entries), LIST_BATCH_SIZE):
+                files = [{"filename": entry["key"], "owner": entry["owner"], "name": entry["name"], "size": entry["size"], "mtime": entry["mtime"]}
+                         for entry in entries[start:start + LIST_BATCH_SIZE]]
+                writer.write(protocol.encode_message(RESPONSE, request_id, {"files": files}, self.version))
+                await writer.drain() # A slow reader holds back the listing, not the server's memory
+            writer.write(protocol.encode_message(END, request_id, {"cursor": cursor}, self.version))
+
+    async def handle_upload(self, request_id, request):
+        # The data goes into a partial file that survives a dropped connection, with resume the upload continues where it stopped
+        try:
+            filename = str(request["filename"])
+            file_size = int(request["size"])
+            etag = str(request.get("etag", ""))     # Identifies the version of the client's file
+            delta_base = request.get("delta")       # Etag of the stored version a delta upload builds on
+            resume = bool(request.get("resume")) and delta_base is None
+            file_key = self.engine.file_key(self.client_name, filename)
+            filepath = self.engine.file_path(file_key)
+        except (KeyError, ValueError) as e:
+            self.engine.log(f"Error during upload: {str(e)}", client=self.client_name, cmd="UPLOAD", error=type(e).__name__)
+            self.send_error(request_id, "UPLOAD_FAILED")
+            return
+        if not self.engine.may_write(file_key, self.client_name):
+            self.send_error(request_id, "ERROR: The file belongs to another client.")
+            return
+
+        if not self.engine.claim_upload(file_key, self):
+            self.send_error(request_id, "ERROR: File is already being uploaded.")
+            return
+        try:
+            file_exists = self.engine.file_exists(file_key)
+            checksum = request.get("sha256")        # Lets the server skip contents it already stores
+            if checksum and self.engine.link_existing(file_key, self.client_name, filename, str(checksum), file_size):
+                self.engine.discard_partial(file_key)
+                self.engine.log(f"{self.client_name} uploaded {filename}, the contents were already stored.", client=self.client_name,
+                                cmd="UPLOAD", bytes=file_size)
+                self.engine.notify_change("overwrite" if file_exists else "upload", file_key, self.client_name)
+                message = f"Upload successful, {filename} was overwritten" if file_exists else "Upload successful."
+                self.send_message(RESPONSE, request_id, {"status": "ok", "message": message})
+                return
+
+            base = None
+            if delta_base is not None:
+                try:
+                    base = self.engine.open_file(file_key)
+                except OSError:
+                    pass
+                if base is None or base.etag != delta_base:
+                    if base is not None:
+                        base.close()
+                    self.send_error(request_id, "ERROR: File has changed.")
+                    return
+
+            try:
+                f, offset = self.engine.begin_partial(file_key, file_size, etag, resume)
+                hasher = hashlib.sha256()
+                if offset: # Hashing what is already there takes a while for a large file, the other sessions go on meanwhile
+                    hasher = await asyncio.to_thread(self.engine.hash_prefix, self.engine.partial_file(file_key), offset)
+            except OSError as e:
+                if base is not None:
+                    base.close()
+                self.engine.log(f"Error during upload: {str(e)}", client=self.client_name, cmd="UPLOAD", error=type(e).__name__)
+                self.send_error(request_id, "UPLOAD_FAILED")
+                return
+
+            upload = UploadSink(f, hasher, file_size - offset, self.codecs, self.engine.buffer_size, base)
+            self.uploads[request_id] = upload
+            try:
+                self.send_message(RESPONSE, request_id, {"status": "ready", "offset": offset})
+                await upload.done
+            finally:
+                self.uploads.pop(request_id, None)
+                f.close()
+                if base is not None:
+                    base.close()
+            if upload.copied:
+                self.engine.delta_copied.inc(upload.copied)
+
+            error = upload.error
+            received = offset + upload.received
+            checksum = upload.checksum or (str(request["sha256"]) if request.get("sha256") else None)
+            if error is None and received != file_size:
+                error = ValueError(f"Received {received} bytes, expected {file_size}")
+            if received > file_size:
+                self.engine.discard_partial(file_key)
+            elif error is None and checksum is not None and checksum != upload.hasher.hexdigest():
+                error = ChecksumError(f"{file_key} does not match the checksum sent by {self.client_name}")
+                self.engine.discard_partial(file_key) # Resuming would keep the corrupt part
+            if upload.decompressor is not None:
+                self.engine.compressed_transfers.inc(codec=upload.decompressor.codec.name, direction="upload")
+                self.engine.compression_saved.inc(upload.received - upload.wire_bytes, codec=upload.decompressor.codec.name, direction="upload")
+            if error is None:
+                try:
+                    await self.engine.commit_partial(file_key, self.client_name, filename, upload.hasher.hexdigest())
+                except OSError as e:
+                    error = e
+        finally:
+            self.engine.release_upload(file_key)
+
+        if error is not None:
+            self.engine.log(f"Error during upload: {str(error)}", client=self.client_name, cmd="UPLOAD", error=type(error).__name__)
+            self.send_error(request_id, "ERROR: Checksum mismatch." if isinstance(error, ChecksumError) else "UPLOAD_FAILED")
+            return
+
+        self.engine.notify_change("overwrite" if file_exists else "upload", file_key, self.client_name)
+        if file_exists:
+            self.engine.log(f"Upload successful, {self.client_name} overwrote {filename}.", client=self.client_name, cmd="UPLOAD", bytes=file_size)
+            message = f"Upload successful, {filename} was overwritten"
+        else:
+            self.engine.log(f"{self.client_name} uploaded {filename}.", client=self.client_name, cmd="UPLOAD", bytes=file_size)
+            message = "Upload successful."
+        if upload.copied:
+            self.engine.log(f"{upload.copied} of {file_size} bytes of {filename} were copied from the stored version.")
+        self.send_message(RESPONSE, request_id, {"status": "ok", "message": message})
+
+    async def handle_batch_upload(self, request_id, request):
+        # Many files in one request: a list of names and sizes, then their contents back to back as one stream
+        #
+        # Every file is written to its own partial file as the stream passes it. A file whose
+        # checksum does not match is left out, the others are committed together at the end.
+        try:
+            members = request["files"]
+            if not isinstance(members, list) or not 0 < len(members) <= batch.MAX_BATCH_FILES:
+                raise ValueError(f"A batch holds 1 to {batch.MAX_BATCH_FILES} files")
+            if not all(isinstance(member, dict) and isinstance(member.get("filename"), str) for member in members):
+                raise ValueError("Every file of a batch needs a file name")
+            filenames = [member["filename"] for member in members]
+            sizes = [int(member["size"]) for member in members]
+            file_keys = [self.engine.file_key(self.client_name, filename) for filename in filenames]
+            for file_key, size in zip(file_keys, sizes):
+                self.engine.file_path(file_key)
+                if size < 0:
+                    raise ValueError(f"Invalid size of {file_key}")
+            if len(set(file_keys)) != len(file_keys):
+                raise ValueError("A file is in the batch twice")
+        except (KeyError, TypeError, ValueError) as e:
+            self.engine.log(f"Error during batch upload: {str(e)}", client=self.client_name, cmd="BATCH_UPLOAD", error=type(e).__name__)
+            self.send_error(request_id, "UPLOAD_FAILED")
+            return
+
+        claimed = []
+        try:
+            for file_key in file_keys:
+                if not self.engine.may_write(file_key, self.client_name):
+                    self.send_error(request_id, f"ERROR: {file_key} belongs to another client.")
+                    return
+                if not self.engine.claim_upload(file_key, self):
+                    self.send_error(request_id, f"ERROR: {file_key} is already being uploaded.")
+                    return
+                claimed.append(file_key)
+            try:
+                await self.receive_batch(request_id, file_keys, filenames, sizes)
+            finally:
+                for file_key in file_keys:
+                    self.engine.discard_partial(file_key) # Whatever was not committed
+        finally:
+            for file_key in claimed:
+                self.engine.release_upload(file_key)
+
+    async def receive_batch(self, request_id, file_keys, filenames, sizes):
+        # The stream of a batch upload whose files are claimed, up to the reply
+        exists = [self.engine.file_exists(file_key) for file_key in file_keys]
+        splitter = batch.StreamSplitter(sizes, lambda index: open(self.engine.partial_file(file_keys[index]), "wb"))
+        upload = BatchSink(splitter, sum(sizes), self.codecs, self.engine.buffer_size)
+        self.uploads[request_id] = upload
+        try:
+            self.send_message(RESPONSE, request_id, {"status": "ready"})
+            await upload.done
+        finally:
+            self.uploads.pop(request_id, None)
+            splitter.close()
+
+        error = upload.error
+        try:
+            if error is None and (not splitter.finish() or upload.received != upload.expected):
+                error = ValueError(f"Received {upload.received} bytes, expected {upload.expected}")
+        except OSError as e:
+            error = e
+        if error is None and upload.checksums is not None and len(upload.checksums) != len(file_keys):
+            error = ValueError(f"Received {len(upload.checksums)} checksums for {len(file_keys)} files")
+        if upload.decompressor is not None:
+            self.engine.compressed_transfers.inc(codec=upload.decompressor.codec.name, direction="upload")
+            self.engine.compression_saved.inc(upload.received - upload.wire_bytes, codec=upload.decompressor.codec.name, direction="upload")
+
+        results, commits = [], []
+        if error is None:
+            for index, (file_key, filename, checksum) in enumerate(zip(file_keys, filenames, splitter.checksums)):
+                if upload.checksums is not None and upload.checksums[index] != checksum:
+                    results.append({"filename": filename, "status": "error", "message": "ERROR: Checksum mismatch."})
+                else:
+                    results.append({"filename": filename, "status": "ok", "overwritten": exists[index]})
+                    commits.append((file_key, filename, checksum))
+            try:
+                await self.engine.commit_batch(commits, self.client_name)
+            except OSError as e:
+                error = e
+        if error is not None:
+            self.engine.log(f"Error during batch upload: {str(error)}", client=self.client_name, cmd="BATCH_UPLOAD", error=type(error).__name__)
+            self.send_error(request_id, "UPLOAD_FAILED")
+            return
+
+        for index, file_key in enumerate(file_keys):
+            if results[index]["status"] == "ok":
+                self.engine.notify_change("overwrite" if exists[index] else "upload", file_key, self.client_name)
+        failed = len(file_keys) - len(commits)
+        self.engine.log(f"{self.client_name} uploaded {len(commits)} files in a batch" + (f", {failed} did not match their checksums." if failed else "."),
+                        client=self.client_name, cmd="BATCH_UPLOAD", bytes=sum(sizes))
+        message = f"Uploaded {len(commits)} of {len(file_keys)} files."
+        self.send_message(RESPONSE, request_id, {"status": "ok", "message": message, "files": results})
+
+    async def send_signatures(self, request_id, request):
+        # Block signatures of the client's stored version of a file, the start of a delta upload
+        try:
+            file_key = self.engine.file_key(self.client_name, str(request["filename"]))
+            source = self.engine.open_file(file_key)
+        except (KeyError, ValueError, OSError):
+            self.send_error(request_id, "ERROR: No such file.")
+            return
+        try:
+            block_size = delta.block_size(source.size)
+            blocks = await asyncio.to_thread(delta.signatures, source.reader(0), source.size, block_size)
+        finally:
+            source.close()
+
+        async with self.out as writer:
+            for start in range(0, len(blocks), SIGNATURE_BATCH_SIZE):
+                writer.write(protocol.encode_message(RESPONSE, request_id, {"blocks": blocks[start:start + SIGNATURE_BATCH_SIZE]}, self.version))
+                await writer.drain()
+            writer.write(protocol.encode_message(END, request_id, {"size": source.size, "etag": source.etag, "block_size": block_size}, self.version))
+
+    async def send_upload_status(self, request_id, request):
+        # Lets a client find out how much of an unfinished upload the server already has
+        try:
+            file_key = self.engine.file_key(self.client_name, str(request["filename"]))
+            self.engine.file_path(file_key)
+        except (KeyError, ValueError):
+            self.send_error(request_id, "ERROR: Invalid file name.")
+            return
+        state = self.engine.partial_state(file_key) or {"size": None, "etag": None, "offset": 0}
+        self.send_message(RESPONSE, request_id, state)
+
+    async def handle_download(self, request_id, request):
+        # Sends the whole file, or the byte range given by offset and length
+        try:
+            owner = str(request["owner"])
+            file_key = str(request["filename"])
+            offset = int(request.get("offset", 0))
+            length = request.get("length")
+            etag = request.get("etag")              # Only continue a download of the same version of the file
+            source = self.engine.open_file(file_key)
+        except (KeyError, ValueError, TypeError, OSError) as e:
+            self.engine.log(f"Error during download: {str(e)}", client=self.client_name, cmd="DOWNLOAD", error=type(e).__name__)
+            self.send_error(request_id, "ERROR: Download failed.")
+            return
+
+        try:
+            if etag is not None and etag != source.etag:
+                self.send_error(request_id, "ERROR: File has changed.")
+                return
+            if offset < 0 or offset > source.size:
+                self.send_error(request_id, "ERROR: Invalid range.")
+                return
+            length = source.size - offset if length is None else max(0, min(int(length), source.size - offset))
+            codec = None
+            if self.codecs and request.get("compress", True) and length >= compression.MIN_SIZE:
+                codec = await self.choose_codec(source, offset, length)
+            reply = {"status": "ok", "size": source.size, "offset": offset, "length": length, "etag": source.etag}
+            if source.checksum:
+                reply["sha256"] = source.checksum  # Of the whole file, the client checks it as the data streams in
+            if codec:
+                reply["encoding"] = codec
+            self.send_message(RESPONSE, request_id, reply)
+            flow = self.engine.scheduler.flow(self.client_name)
+            try:
+                if codec:
+                    await self.send_compressed_data(request_id, source.reader(offset), length, codec, flow)
+                elif source.buffer is not None:
+                    await self.send_buffer_data(request_id, source.buffer, offset, length, flow)
+                elif self.engine.tls_context is not None: # The data has to be encrypted, sendfile cannot help
+                    await self.send_stream_data(request_id, source.reader(offset), length, flow)
+                else:
+                    await self.send_file_data(request_id, source.file, offset, length, flow)
+            finally:
+                flow.close()
+        finally:
+            source.close()
+        self.out.write(protocol.encode_frame(END, request_id, version=self.version))
+
+        self.engine.log(f"File {file_key} sent to {self.client_name}.", client=self.client_name, cmd="DOWNLOAD", bytes=length)
+        self.engine.notify_download(self.engine.owner_of(file_key) or owner, file_key, self.client_name)
+
+    async def handle_batch_download(self, request_id, request):
+        # Many files in one request: a manifest of their sizes and checksums, then their contents back to back as one stream
+        try:
+            file_keys = request["files"]
+            if not isinstance(file_keys, list) or not 0 < len(file_keys) <= batch.MAX_BATCH_FILES:
+                raise ValueError(f"A batch holds 1 to {batch.MAX_BATCH_FILES} files") # A string would be taken one character at a time
+            if not all(isinstance(file_key, str) for file_key in file_keys):
+                raise ValueError("The files of a batch are named by their keys")
+        except (KeyError, TypeError, ValueError) as e:
+            self.engine.log(f"Error during batch download: {str(e)}", client=self.client_name, cmd="BATCH_DOWNLOAD", error=type(e).__name__)
+            self.send_error(request_id, "ERROR: Download failed.")
+            return
+
+        manifest, sources = [], []
+        for file_key in file_keys:
+            try:
+                opener, size, etag, checksum = self.engine.batch_source(file_key)
+            except (ValueError, OSError):
+                manifest.append({"filename": file_key, "status": "error", "message": "ERROR: No such file."})
+                continue
+            entry = {"filename": file_key, "status": "ok", "size": size, "etag": etag}
+            if checksum:
+                entry["sha256"] = checksum
+            manifest.append(entry)
+            sources.append((opener, size))
+        length = sum(size for _, size in sources)
+
+        codec = None
+        if self.codecs and request.get("compress", True) and length >= compression.MIN_SIZE:
+            sample = await asyncio.to_thread(batch.ConcatenatedReader(sources).read, compression.SAMPLE_SIZE)
+            codec = await asyncio.to_thread(compression.choose, sample, self.codecs)
+        reply = {"status": "ok", "files": manifest, "length": length}
+        if codec:
+            reply["encoding"] = codec
+        self.send_message(RESPONSE, request_id, reply)
+
+        reader = batch.ConcatenatedReader(sources)
+        flow = self.engine.scheduler.flow(self.client_name)
+        try:
+            if codec:
+                await self.send_compressed_data(request_id, reader, length, codec, flow)
+            else:
+                await self.send_stream_data(request_id, reader, length, flow)
+        finally:
+            flow.close()
+            reader.close()
+        self.out.write(protocol.encode_frame(END, request_id, version=self.version))
+
+        self.engine.log(f"{len(sources)} files sent to {self.client_name} in a batch.", client=self.client_name, cmd="BATCH_DOWNLOAD", bytes=length)
+        for entry in manifest:
+            if entry["status"] == "ok":
+                self.engine.notify_download(self.engine.owner_of(entry["filename"]), entry["filename"], self.client_name)
+
+    async def send_stream_data(self, request_id, reader, count, flow):
+        # Data read on a worker thread a frame at a time, e.g. the files of a batch one after another
+        while count > 0:
+            self.check_cancelled(request_id)
+            chunk = await asyncio.to_thread(reader.read, min(self.engine.frame_size, count))
+            if not chunk:
+                raise ValueError("File changed while it was being sent")
+            await flow.acquire(len(chunk))
+            async with self.out as writer:
+                writer.write(protocol.encode_frame(DATA, request_id, chunk, version=self.version))
+                await writer.drain()
+            self.engine.bytes_sent.inc(len(chunk))
+            count -= len(chunk)
+
+    async def send_file_data(self, request_id, f, offset, count, flow):
+        # Each DATA frame body goes out with sendfile, asyncio falls back to read/send where it is unavailable
+        #
+        # The flow waits for the rate limits before the stream is taken, other frames of the session go out meanwhile.
+        end = offset + count
+        while offset < end:
+            self.check_cancelled(request_id)
+            length = min(self.engine.frame_size, end - offset)
+            await flow.acquire(length)
+            async with self.out as writer:
+                writer.write(protocol.encode_header(DATA, request_id, length, version=self.version))
+                sent = await self.loop.sendfile(writer.transport, f, offset, length)
+            self.engine.bytes_sent.inc(sent)
+            if sent != length:
+                raise ConnectionError("File changed while it was being sent") # The frame stream is out of sync now
+            offset += length
+            # sendfile pauses reading and drops a read the loop has queued already. Two passes of the
+            # loop poll the socket and run the read, so the client's frames get in between the DATA
+            # frames of a long download, CANCEL and heartbeats among them.
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+
+    async def send_buffer_data(self, request_id, buffer, offset, count, flow):
+        # Files in the cache go out from memory, without touching the disk
+        end = offset + count
+        while offset < end:
+            self.check_cancelled(request_id)
+            length = min(self.engine.frame_size, end - offset)
+            await flow.acquire(length)
+            async with self.out as writer:
+                writer.write(protocol.encode_header(DATA, request_id, length, version=self.version))
+                writer.write(buffer[offset:offset + length])
+                await writer.drain()
+            self.engine.bytes_sent.inc(length)
+            offset += length
+
+    async def choose_codec(self, source, offset, length):
+        # The choice for a whole file is kept with a cached file, hot files are only sampled once
+        whole = offset == 0 and length == source.size
+        if whole and self.codecs in source.choices:
+            return source.choices[self.codecs]
+        sample = source.reader(offset).read(min(compression.SAMPLE_SIZE, length))
+        codec = await asyncio.to_thread(compression.choose, sample, self.codecs)
+        if whole:
+            source.choices[self.codecs] = codec
+        return codec
+
+    async def send_compressed_data(self, request_id, reader, count, codec, flow):
+        # The data is compressed one buffer at a time on a worker thread, a DATA frame goes out whenever the codec has output
+        chunks = compression.compressed_chunks(reader, count, codec, self.engine.frame_size)
+        flags = compression.CODECS[codec].id
+        sent = 0
+        while True:
+            self.check_cancelled(request_id)
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            if not chunk: # The codec had no output for the last read
+                continue
+            await flow.acquire(len(chunk)) # Compressed bytes, they are what takes up the link
+            async with self.out as writer:
+                writer.write(protocol.encode_frame(DATA, request_id, chunk, flags, self.version))
+                await writer.drain()
+            sent += len(chunk)
+            self.engine.bytes_sent.inc(len(chunk))
+        self.engine.compressed_transfers.inc(codec=codec, direction="download")
+        self.engine.compression_saved.inc(count - sent, codec=codec, direction="download")
+
+    async def handle_delete(self, request_id, request):
+        try:
+            owner = str(request["owner"])
+            file_key = str(request["filename"])
+
+            if owner != self.client_name or self.engine.owner_of(file_key) not in (None, self.client_name): # Check if the file was uploaded by the client
+                self.send_error(request_id, "ERROR: You do not have permission to delete this file.")
+                return
+
+            self.engine.delete_file(file_key)
+            self.send_message(RESPONSE, request_id, {"message": "File deleted successfully."})
+            self.engine.log(f"{self.client_name} deleted {file_key}.", client=self.client_name, cmd="DELETE")
+            self.engine.notify_change("delete", file_key, self.client_name)
+        except (KeyError, ValueError, OSError) as e:
+            self.engine.log(f"Error during deletion: {str(e)}", client=self.client_name, cmd="DELETE", error=type(e).__name__)
+            self.send_error(request_id, "ERROR: Deletion failed.")
+
+    async def handle_subscribe(self, request_id, request):
+        # Choose the events the client is notified about, downloads of its own files are the default
+        events = request.get("events", [])
+        if not isinstance(events, list) or not set(events) <= set(EVENTS):
+            self.send_error(request_id, f"ERROR: Events must be a list of {', '.join(EVENTS)}.")
+            return
+        self.engine.notifications.subscribe(self.client_name, self, events)
+        self.send_message(RESPONSE, request_id, {"events": events})
+
+    async def send_stats(self, request_id, request):
+        # The server's metrics and most recent log messages, with the round trip time of this client's heartbeats
+        log = list(self.engine.log.recent)[-STATS_LOG_LINES:]
+        self.send_message(RESPONSE, request_id, {"stats": self.engine.metrics.snapshot(), "rtt": self.rtt, "log": log})
+
+
+def valid_client_name(client_name):
+    return bool(client_name) and not client_name.startswith(".") and not any(c in client_name for c in (KEY_SEPARATOR, "/", "\\"))
+
+
+def flush_all(flush, paths):
+    # Run on a worker thread, one thread for all the files of a batch instead of one per file
+    for path in paths:
+        flush(path)
+
+
+def raise_file_limit():
+    # Idle connections are cheap on the event loop, the descriptor limit is usually what runs out first
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless TCP file storage server")
+    parser.add_argument("--port", type=int, required=True, help="port to listen on")
+    parser.add_argument("--storage", required=True, help="folder for storing uploaded files")
+    parser.add_argument("--host", default="0.0.0.0", help="interface to bind to")
+    parser.add_argument("--heartbeat-interval", type=float, default=2, help="seconds between heartbeats")
+    parser.add_argument("--heartbeat-timeout", type=float, default=10, help="seconds without a reply after which a client is disconnected")
+    parser.add_argument("--buffer-size", type=int, default=protocol.BUFFER_SIZE, help="transfer buffer size in bytes")
+    parser.add_argument("--rescan", action="store_true", help="reconcile the catalog with the files in the storage folder")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the port, needs fork and SO_REUSEPORT")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics over HTTP on this port, every worker uses the next one")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="interface of the metrics endpoint")
+    parser.add_argument("--log-rate", type=float, default=100, help="log messages per second, the rest are counted and dropped")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_BUDGET >> 20, help="MiB of hot files kept in memory, 0 turns the cache off")
+    parser.add_argument("--no-compression", dest="compress", action="store_false", help="never compress transfers")
+    parser.add_argument("--rate-limit", type=float, help="MiB/s all downloads share, set it a little below the uplink")
+    parser.add_argument("--client-rate-limit", type=float, help="MiB/s of the downloads of each client")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="flat",
+                        help="storage layout, 'content' stores identical files once")
+    parser.add_argument("--tls-cert", help="certificate chain in PEM format, the listener only accepts TLS then")
+    parser.add_argument("--tls-key", help="private key of the certificate in PEM format")
+    parser.add_argument("--drain-timeout", type=float, default=restart.DRAIN_TIMEOUT,
+                        help="seconds transfers get to finish when the server stops or restarts")
+    parser.add_argument("--pid-file", help="file that gets the id of the process serving the port, updated by restarts")
+    parser.add_argument("--inherit-fd", type=int, help=argparse.SUPPRESS)   # Listening socket of the previous process
+    parser.add_argument("--ready-fd", type=int, help=argparse.SUPPRESS)     # Pipe to tell it this one listens
+    args = parser.parse_args(argv)
+    if bool(args.tls_cert) != bool(args.tls_key):
+        parser.error("--tls-cert and --tls-key go together")
+    if args.inherit_fd is not None and args.workers > 1:
+        parser.error("--workers cannot take over a listening socket")
+    args.argv = list(sys.argv[1:] if argv is None else argv) # The successor of a restart gets the same arguments
+    return args
+
+
+def run_engine(args, worker_id=0):
+    log = print if args.workers == 1 else (lambda message: print(f"[worker {worker_id}] {message}", flush=True))
+    engine = ServerEngine(args.storage, args.port, host=args.host, heartbeat_interval=args.heartbeat_interval,
+                          heartbeat_timeout=args.heartbeat_timeout, buffer_size=args.buffer_size,
+                          rescan=args.rescan, backend=args.backend, log=log, worker_id=worker_id, workers=args.workers,
+                          metrics_port=None if args.metrics_port is None else args.metrics_port + worker_id,
+                          metrics_host=args.metrics_host, log_rate=args.log_rate,
+                          compress=args.compress, cache_size=args.cache_size << 20,
+                          rate_limit=args.rate_limit and args.rate_limit * (1 << 20) / args.workers, # Every worker shapes its share
+                          client_rate_limit=args.client_rate_limit and args.client_rate_limit * (1 << 20),
+                          tls_cert=args.tls_cert, tls_key=args.tls_key, listen_fd=args.inherit_fd, ready_fd=args.ready_fd,
+                          restart_argv=args.argv if args.workers == 1 else None, handle_signals=True, # SIGHUP restarts a single process only
+                          drain_timeout=args.drain_timeout, pid_file=args.pid_file if args.workers == 1 else None) # The parent of --workers writes it
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        pass
+    if not engine.started.is_set():
+        raise SystemExit(1)
+
+
+def run_workers(args):
+    # Fork the workers and start a new one whenever one dies, until the parent is interrupted or terminated
+    #
+    # Every worker opens the catalog itself, nothing that holds a SQLite connection or an event
+    # loop crosses the fork.
+    Cluster.reset(args.storage)
+    workers = {}
+    if args.pid_file:
+        with open(args.pid_file, "w") as f:
+            f.write(f"{os.getpid()}\n")
+
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            try: # SIGTERM from the parent drains the sessions of the worker before it exits
+                run_engine(args, worker_id)
+            finally:
+                os._exit(0)
+        workers[pid] = worker_id
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    for worker_id in range(args.workers):
+        spawn(worker_id)
+    try:
+        while workers:
+            pid, status = os.wait()
+            worker_id = workers.pop(pid, None)
+            if worker_id is not None:
+                print(f"Worker {worker_id} exited with status {status}, starting it again.", flush=True)
+                time.sleep(1) # A worker that cannot start at all should not spin
+                spawn(worker_id)
+    except KeyboardInterrupt:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(workers):
+            os.waitpid(pid, 0)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.storage, exist_ok=True)
+    raise_file_limit()
+    if args.workers > 1:
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            raise SystemExit("--workers needs fork and SO_REUSEPORT")
+        if not args.port:
+            raise SystemExit("--workers needs a fixed --port")
+        run_workers(args)
+    else:
+        run_engine(args)
+
+
+if __name__ == "__main__":
+    main()
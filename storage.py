@@ -0,0 +1,178 @@
+import os
+import time
+
+# Storage backends, they decide where the contents of a catalog entry live on disk
+#
+# Both backends receive finished uploads as a partial file in the storage folder and record
+# them in the catalog. The engine only asks them for the path of a key, everything it sends
+# is read from that path.
+
+
+def fsync_file(path):
+    # Flush a file's data to disk, done before it is renamed into place
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(path):
+    # Make a rename in a folder durable, folders cannot be opened on Windows, where renames need no flush
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# Every file is stored under its key, '<client>_<filename>', the layout of the original server
+class FlatStorage:
+    name = "flat"
+
+    def __init__(self, storage_path, catalog):
+        self.storage_path = storage_path
+        self.catalog = catalog
+
+    def path(self, file_key):
+        return os.path.join(self.storage_path, file_key)
+
+    def commit(self, file_key, partial_file, owner, filename, checksum):
+        # Move a finished upload into place and record it, returns the path it was moved to
+        path = self.path(file_key)
+        os.replace(partial_file, path) # Atomic, readers see the old file or the new one
+        stat = os.stat(path)
+        self.catalog.add(file_key, owner, filename, stat.st_size, stat.st_mtime, checksum)
+        return path
+
+    def commit_many(self, files):
+        # commit() for many (key, partial file, owner, filename, checksum) uploads, recorded in one transaction
+        rows, paths = [], []
+        for file_key, partial_file, owner, filename, checksum in files:
+            path = self.path(file_key)
+            os.replace(partial_file, path)
+            stat = os.stat(path)
+            rows.append((file_key, owner, filename, stat.st_size, stat.st_mtime, checksum))
+            paths.append(path)
+        self.catalog.add_many(rows)
+        return paths
+
+    def link_existing(self, file_key, owner, filename, checksum, size):
+        # Store a file from contents the server already has, the flat layout cannot share contents
+        return False
+
+    def delete(self, file_key):
+        try:
+            os.remove(self.path(file_key))
+        except FileNotFoundError:
+            if self.catalog.get(file_key) is None:
+                raise
+        self.catalog.remove(file_key)
+
+    def collect_garbage(self):
+        pass
+
+
+# Contents are stored once as blobs named by their sha256, every key that has the same contents refers to the same blob
+#
+# The blobs table of the catalog counts the references, a blob is removed with its last one.
+# With --workers other processes link and remove blobs too. A blob file is only removed in a
+# write transaction that finds no row for it, and a link checks the file and is recorded in
+# one, so no entry is left pointing at a removed blob. Entries from before the backend was switched on keep their flat files until they are
+# overwritten or deleted.
+class ContentAddressedStorage(FlatStorage):
+    name = "content"
+
+    def __init__(self, storage_path, catalog):
+        super().__init__(storage_path, catalog)
+        self.blob_path_root = os.path.join(storage_path, ".blobs")
+        os.makedirs(self.blob_path_root, exist_ok=True)
+
+    def blob_path(self, checksum):
+        return os.path.join(self.blob_path_root, checksum[:2], checksum) # Two levels keep the folders small
+
+    def path(self, file_key):
+        entry = self.catalog.get(file_key)
+        if entry and entry["checksum"] and self.catalog.get_blob(entry["checksum"]):
+            return self.blob_path(entry["checksum"])
+        return super().path(file_key)
+
+    def commit(self, file_key, partial_file, owner, filename, checksum):
+        return self.commit_many([(file_key, partial_file, owner, filename, checksum)])[0]
+
+    def commit_many(self, files):
+        rows, paths = [], []
+        with self.catalog.write_transaction(): # The blobs cannot be removed between storing and linking them
+            for file_key, partial_file, owner, filename, checksum in files:
+                blob_path = self.store_blob(partial_file, checksum)
+                rows.append((file_key, owner, filename, os.path.getsize(blob_path), time.time(), checksum))
+                paths.append(blob_path)
+            released = self.catalog.link_many(rows)
+        for file_key, *_ in files:
+            self.remove_flat_file(file_key)
+        for checksum in released:
+            self.remove_blob(checksum)
+        return paths
+
+    def store_blob(self, partial_file, checksum):
+        # Only called inside a write transaction, a blob file that exists then is not removed before it commits
+        blob_path = self.blob_path(checksum)
+        if os.path.exists(blob_path):
+            os.remove(partial_file) # Already stored, the new copy is not needed
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(partial_file, blob_path)
+        return blob_path
+
+    def link_existing(self, file_key, owner, filename, checksum, size):
+        # Store a file without receiving it when a blob with the same checksum and size exists
+        with self.catalog.write_transaction():
+            blob = self.catalog.get_blob(checksum)
+            if blob is None or blob["size"] != size or not os.path.exists(self.blob_path(checksum)):
+                return False
+            released = self.catalog.link(file_key, owner, filename, size, time.time(), checksum)
+        self.remove_flat_file(file_key)
+        if released:
+            self.remove_blob(released)
+        return True
+
+    def delete(self, file_key):
+        if self.catalog.get(file_key) is None:
+            raise FileNotFoundError(f"No such file: {file_key}")
+        released = self.catalog.unlink(file_key)
+        self.remove_flat_file(file_key)
+        if released:
+            self.remove_blob(released)
+
+    def remove_flat_file(self, file_key):
+        # The file an entry had before it was stored as a blob
+        try:
+            os.remove(super().path(file_key))
+        except FileNotFoundError:
+            pass
+
+    def remove_blob(self, checksum):
+        # Only once it has no references, another entry may have been linked to it since it lost its last one
+        with self.catalog.write_transaction():
+            if self.catalog.get_blob(checksum) is not None:
+                return
+            try:
+                os.remove(self.blob_path(checksum))
+            except FileNotFoundError:
+                pass
+
+    def collect_garbage(self):
+        # Remove blobs that lost their last reference without being deleted, e.g. when the server stopped in between
+        for folder in os.scandir(self.blob_path_root):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if self.catalog.get_blob(entry.name) is None:
+                    self.remove_blob(entry.name)
+
+
+BACKENDS = {backend.name: backend for backend in (FlatStorage, ContentAddressedStorage)}
@@ -0,0 +1,72 @@
+import ssl
+import subprocess
+import threading
+import weakref
+
+# Optional TLS for the framed protocol
+#
+# The server wraps its listener with the context from server_context(), the client wraps its
+# one socket with the context from client_context(). A full handshake costs the server a
+# signature and a key exchange, a resumed one only the key exchange. Clients keep the last
+# session of every server and offer it when they connect again, the server answers with a
+# session ticket it can decrypt later, so it keeps no state per client. Tickets are encrypted
+# with keys every server process makes up when it starts, the stdlib cannot set them: after a
+# restart, or with --workers on another worker, the next connection is a full handshake again.
+# ECDSA certificates keep those cheap as well.
+
+HANDSHAKE_TIMEOUT = 10          # Seconds a client has to complete the TLS handshake
+TICKETS = 1                     # Session tickets sent after a full handshake, clients only keep the last one
+
+
+def server_context(certfile, keyfile):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = TICKETS
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    # Trusts the system's certificate authorities, or only cafile, e.g. a self-signed server certificate
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+# Sessions can only be resumed with the context they were made with, so they are kept by context
+class SessionCache:
+    def __init__(self):
+        self.sessions = weakref.WeakKeyDictionary() # Context -> {(host, port): last session}
+        self.lock = threading.Lock()
+
+    def get(self, context, host, port):
+        with self.lock:
+            return self.sessions.get(context, {}).get((host, port))
+
+    def put(self, context, host, port, session):
+        if session is None:
+            return
+        with self.lock:
+            self.sessions.setdefault(context, {})[(host, port)] = session
+
+    def clear(self):
+        # Forget every session, the next connections are full handshakes
+        with self.lock:
+            self.sessions.clear()
+
+
+SESSIONS = SessionCache()       # Shared by every connection of the process, a new Connection resumes as well
+
+
+def generate_self_signed(certfile, keyfile, hosts=("localhost", "127.0.0.1"), days=365, key_type="ec"):
+    # A self-signed certificate for tests and benchmarks, made with the openssl command line tool
+    #
+    # key_type "ec" makes an ECDSA P-256 key, "rsa" an RSA 2048 key, whose signatures cost the server a lot more.
+    names = ",".join(f"IP:{host}" if host.replace(".", "").isdigit() or ":" in host else f"DNS:{host}" for host in hosts)
+    key = ["-newkey", "rsa:2048"] if key_type == "rsa" else ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"]
+    subprocess.run(["openssl", "req", "-x509", *key, "-nodes",
+                    "-days", str(days), "-subj", f"/CN={hosts[0]}", "-addext", f"subjectAltName={names}",
+                    "-keyout", keyfile, "-out", certfile], check=True, capture_output=True)